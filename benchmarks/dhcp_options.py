@@ -0,0 +1,62 @@
+"""
+DHCP option encoding micro-benchmark: hex string based implementation
+(as it was) against ztp2.utils.dhcp_options. Equivalence of the two
+is checked by tests/test_dhcp_options.py.
+
+    python benchmarks/dhcp_options.py
+"""
+import ipaddress
+import timeit
+
+from ztp2.utils.dhcp_options import encode_address, firmware_options
+
+
+def legacy_hexstring_to_bytea(hexstring: str) -> bytes:
+    answer = [int(hexstring[i:i + 2], 16) for i in range(0, len(hexstring), 2)]
+    return bytes(answer)
+
+
+def legacy_option_125(firmware_filename: str):
+    dlink_id = '000000AB'
+    suboption_length = hex(1 + 1 + len(firmware_filename))[2:].upper().zfill(2)
+    suboption_code = '01'
+    filename_length = hex(len(firmware_filename))[2:].upper().zfill(2)
+    hex_filename = ''.join([hex(ord(letter))[2:].upper().zfill(2)
+                            for letter in firmware_filename])
+    return dlink_id + suboption_length + suboption_code + filename_length \
+        + hex_filename
+
+
+def legacy_address(address: str) -> bytes:
+    hexed = hex(int(ipaddress.IPv4Address(address)))[2:].zfill(8)
+    return legacy_hexstring_to_bytea(hexed)
+
+
+def legacy_firmware_options(fw_tftp_server: str, fw_filename: str):
+    return ((125, legacy_hexstring_to_bytea(legacy_option_125(fw_filename))),
+            (150, legacy_address(fw_tftp_server)))
+
+
+def main(hosts: int = 5000, number: int = 5):
+    firmwares = [f'firmwares/DES-3200-{revision}_{build}.had'
+                 for revision in ('A1', 'B1', 'C1')
+                 for build in ('4.37', '4.39', '4.48')]
+    server = '10.0.0.2'
+
+    jobs = [firmwares[index % len(firmwares)] for index in range(hosts)]
+    cases = {
+        'options legacy': lambda: [legacy_firmware_options(server, firmware)
+                                   for firmware in jobs],
+        'options encoder': lambda: [firmware_options(server, firmware)
+                                    for firmware in jobs],
+        'gateway legacy': lambda: [legacy_address(server) for _ in jobs],
+        'gateway encoder': lambda: [encode_address(server) for _ in jobs],
+    }
+    print(f'{hosts} hosts, {len(firmwares)} firmwares, best of {number}')
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=1, repeat=number))
+        print(f'{name:>20}: {best * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
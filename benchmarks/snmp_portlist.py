@@ -0,0 +1,66 @@
+"""
+PortList codec micro-benchmark: string based implementation (as it was)
+against ztp2.utils.snmp.PortList.
+
+    python benchmarks/snmp_portlist.py
+"""
+import random
+import timeit
+
+from ztp2.utils.snmp import bytes_to_portlist, portlist_to_bytes, PortList
+
+
+def legacy_bytes_to_portlist(snmp_response: bytes):
+    hexed_response = map(lambda x: hex(x)[2:].zfill(2), snmp_response)
+    hexed_response = ''.join(hexed_response)
+    bined_response = map(lambda x: bin(int(x, 16))[2:].zfill(4), hexed_response)
+    bined_response = ''.join(bined_response)
+    return [index
+            for index, value in enumerate(bined_response, 1)
+            if value == '1']
+
+
+def legacy_portlist_to_bytes(portlist: list[int], hexlen: int) -> bytes:
+    resultlist = ['1' if i in portlist else '0'
+                  for i in range(1, hexlen * 4 + 1)]
+    resultlist = ''.join(resultlist)
+    resultlist = list(resultlist[8*x:8*(x+1)] for x in range(hexlen // 2))
+    resultlist = [int(chunk, 2).to_bytes(1, 'big') for chunk in resultlist]
+    return b''.join(resultlist)
+
+
+def random_row(octets: int, ports: int = 52) -> bytes:
+    # Like a real access switch: a few member ports per VLAN
+    members = random.sample(range(1, ports + 1), random.randint(1, 8))
+    return PortList.from_ports(members, octets).to_bytes()
+
+
+def main(vlans: int = 4000, octets: int = 128, number: int = 3):
+    random.seed(0)
+    table = [random_row(octets) for _ in range(vlans)]
+    portlists = [legacy_bytes_to_portlist(row) for row in table]
+    hexlen = octets * 2
+
+    for row, ports in zip(table, portlists):
+        assert bytes_to_portlist(row) == ports
+        assert portlist_to_bytes(ports, hexlen) == row
+
+    cases = {
+        'decode legacy': lambda: [legacy_bytes_to_portlist(row)
+                                  for row in table],
+        'decode PortList': lambda: [bytes_to_portlist(row) for row in table],
+        'encode legacy': lambda: [legacy_portlist_to_bytes(ports, hexlen)
+                                  for ports in portlists],
+        'encode PortList': lambda: [portlist_to_bytes(ports, hexlen)
+                                    for ports in portlists],
+        'contains PortList': lambda: [50 in PortList.from_bytes(row)
+                                      for row in table],
+    }
+    print(f'{vlans} VLANs x {octets * 8} ports, best of {number}')
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=1, repeat=number))
+        print(f'{name:>20}: {best * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+-- Tables of Kea DHCPv4 host backend used by ztp2.utils.kea,
+-- as created by Kea's dhcpdb_create.pgsql (schema 2.x), columns
+-- of dhcp4_subnet the module does not touch are left out
+
+CREATE TABLE host_identifier_type (
+  type SMALLINT PRIMARY KEY NOT NULL,
+  name VARCHAR(32) DEFAULT NULL
+);
+INSERT INTO host_identifier_type VALUES (0, 'hw-address');
+INSERT INTO host_identifier_type VALUES (1, 'duid');
+INSERT INTO host_identifier_type VALUES (2, 'circuit-id');
+INSERT INTO host_identifier_type VALUES (3, 'client-id');
+INSERT INTO host_identifier_type VALUES (4, 'flex-id');
+
+CREATE TABLE dhcp_option_scope (
+  scope_id SMALLINT PRIMARY KEY NOT NULL,
+  scope_name VARCHAR(32) DEFAULT NULL
+);
+INSERT INTO dhcp_option_scope VALUES (0, 'global');
+INSERT INTO dhcp_option_scope VALUES (1, 'subnet');
+INSERT INTO dhcp_option_scope VALUES (2, 'client-class');
+INSERT INTO dhcp_option_scope VALUES (3, 'host');
+INSERT INTO dhcp_option_scope VALUES (4, 'pool');
+INSERT INTO dhcp_option_scope VALUES (5, 'shared-network');
+
+CREATE TABLE hosts (
+  host_id SERIAL PRIMARY KEY NOT NULL,
+  dhcp_identifier BYTEA NOT NULL,
+  dhcp_identifier_type SMALLINT NOT NULL,
+  dhcp4_subnet_id BIGINT DEFAULT NULL,
+  dhcp6_subnet_id BIGINT DEFAULT NULL,
+  ipv4_address BIGINT DEFAULT NULL,
+  hostname VARCHAR(255) DEFAULT NULL,
+  dhcp4_client_classes VARCHAR(255) DEFAULT NULL,
+  dhcp6_client_classes VARCHAR(255) DEFAULT NULL,
+  dhcp4_next_server BIGINT DEFAULT NULL,
+  dhcp4_server_hostname VARCHAR(64) DEFAULT NULL,
+  dhcp4_boot_file_name VARCHAR(128) DEFAULT NULL,
+  user_context TEXT DEFAULT NULL,
+  auth_key VARCHAR(32) DEFAULT NULL,
+  CONSTRAINT fk_host_identifier_type FOREIGN KEY (dhcp_identifier_type)
+    REFERENCES host_identifier_type (type) ON DELETE CASCADE
+);
+CREATE UNIQUE INDEX key_dhcp4_identifier_subnet_id ON hosts
+  (dhcp_identifier ASC, dhcp_identifier_type ASC, dhcp4_subnet_id ASC)
+  WHERE (dhcp4_subnet_id IS NOT NULL AND dhcp4_subnet_id <> 0);
+CREATE UNIQUE INDEX key_dhcp6_identifier_subnet_id ON hosts
+  (dhcp_identifier ASC, dhcp_identifier_type ASC, dhcp6_subnet_id ASC)
+  WHERE (dhcp6_subnet_id IS NOT NULL AND dhcp6_subnet_id <> 0);
+CREATE INDEX key_dhcp4_ipv4_address_subnet_id ON hosts
+  (ipv4_address ASC, dhcp4_subnet_id ASC);
+
+CREATE TABLE dhcp4_options (
+  option_id SERIAL PRIMARY KEY NOT NULL,
+  code SMALLINT NOT NULL,
+  value BYTEA,
+  formatted_value TEXT DEFAULT NULL,
+  space VARCHAR(128) DEFAULT NULL,
+  persistent BOOLEAN NOT NULL DEFAULT 'f',
+  dhcp_client_class VARCHAR(128) DEFAULT NULL,
+  dhcp4_subnet_id BIGINT DEFAULT NULL,
+  host_id INT DEFAULT NULL,
+  scope_id SMALLINT NOT NULL,
+  user_context TEXT DEFAULT NULL,
+  shared_network_name VARCHAR(128) DEFAULT NULL,
+  pool_id BIGINT DEFAULT NULL,
+  modification_ts TIMESTAMP WITH TIME ZONE NOT NULL
+    DEFAULT CURRENT_TIMESTAMP,
+  CONSTRAINT fk_options_host1 FOREIGN KEY (host_id)
+    REFERENCES hosts (host_id) ON DELETE CASCADE,
+  CONSTRAINT fk_dhcp4_option_scode FOREIGN KEY (scope_id)
+    REFERENCES dhcp_option_scope (scope_id) ON DELETE CASCADE
+);
+
+CREATE TABLE dhcp4_subnet (
+  subnet_id BIGINT PRIMARY KEY NOT NULL,
+  subnet_prefix VARCHAR(64) UNIQUE NOT NULL,
+  interface VARCHAR(128) DEFAULT NULL,
+  shared_network_name VARCHAR(128) DEFAULT NULL,
+  modification_ts TIMESTAMP WITH TIME ZONE NOT NULL
+    DEFAULT CURRENT_TIMESTAMP
+);
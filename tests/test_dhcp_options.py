@@ -0,0 +1,87 @@
+"""
+DHCP option encoders against the hex string based implementation
+they replaced
+"""
+import ipaddress
+
+import pytest
+
+from ztp2.utils.dhcp_options import encode_option_125, decode_option_125, \
+    encode_address, encode_text, firmware_options, config_server_option, \
+    isc_hex, DLINK_ENTERPRISE_ID, DLINK_FIRMWARE_SUBOPTION
+
+FIRMWARES = [f'firmwares/DES-3200-{revision}_{build}.had'
+             for revision in ('A1', 'B1', 'C1')
+             for build in ('4.37', '4.39', '4.48')] + ['', 'x' * 200]
+ADDRESSES = ['0.0.0.0', '10.0.0.1', '10.0.0.2', '255.255.255.255']
+SERVERS = ['tftp.example', '10.0.0.2']
+
+
+def legacy_hexstring_to_bytea(hexstring: str) -> bytes:
+    answer = [int(hexstring[i:i + 2], 16) for i in range(0, len(hexstring), 2)]
+    return bytes(answer)
+
+
+def legacy_option_125(firmware_filename: str):
+    dlink_id = '000000AB'
+    suboption_length = hex(1 + 1 + len(firmware_filename))[2:].upper().zfill(2)
+    suboption_code = '01'
+    filename_length = hex(len(firmware_filename))[2:].upper().zfill(2)
+    hex_filename = ''.join([hex(ord(letter))[2:].upper().zfill(2)
+                            for letter in firmware_filename])
+    return dlink_id + suboption_length + suboption_code + filename_length \
+        + hex_filename
+
+
+def legacy_isc_option_125(firmware_filename: str):
+    hexed = legacy_option_125(firmware_filename)
+    return ':'.join(hexed[i:i + 2] for i in range(0, len(hexed), 2))
+
+
+def legacy_address(address: str) -> bytes:
+    hexed = hex(int(ipaddress.IPv4Address(address)))[2:].zfill(8)
+    return legacy_hexstring_to_bytea(hexed)
+
+
+# (option, encoder, legacy encoder, inputs)
+OPTIONS = [
+    ('3 gateway', encode_address, legacy_address, ADDRESSES),
+    ('66 config server', encode_text,
+     lambda server: bytes(server, 'utf-8'), SERVERS),
+    ('125 firmware', encode_option_125,
+     lambda firmware: legacy_hexstring_to_bytea(legacy_option_125(firmware)),
+     FIRMWARES),
+    ('125 firmware ISC', lambda firmware: isc_hex(encode_option_125(firmware)),
+     legacy_isc_option_125, FIRMWARES),
+    ('150 firmware server', encode_address, legacy_address, ADDRESSES),
+]
+
+
+@pytest.mark.parametrize('option, encoder, legacy, inputs', OPTIONS,
+                         ids=[option[0] for option in OPTIONS])
+def test_encoder_matches_legacy(option, encoder, legacy, inputs):
+    for value in inputs:
+        assert encoder(value) == legacy(value), value
+
+
+@pytest.mark.parametrize('firmware', FIRMWARES)
+def test_option_125_round_trip(firmware: str):
+    enterprise_id, suboptions = decode_option_125(encode_option_125(firmware))
+    assert enterprise_id == DLINK_ENTERPRISE_ID
+    assert suboptions == {DLINK_FIRMWARE_SUBOPTION: firmware.encode()}
+
+
+@pytest.mark.parametrize('address', ADDRESSES)
+def test_address_round_trip(address: str):
+    assert ipaddress.IPv4Address(encode_address(address)).exploded == address
+
+
+@pytest.mark.parametrize('firmware', FIRMWARES)
+def test_firmware_options(firmware: str):
+    assert firmware_options('10.0.0.2', firmware) \
+        == ((125, legacy_hexstring_to_bytea(legacy_option_125(firmware))),
+            (150, legacy_address('10.0.0.2')))
+
+
+def test_config_server_option():
+    assert config_server_option('tftp.example') == (66, b'tftp.example')
@@ -0,0 +1,139 @@
+"""
+Entries lookup plans check. Seeds a migrated database with synthetic
+switches inside a transaction, runs EXPLAIN for the queries behind
+entry listing and duplicate checks, and rolls everything back.
+
+    ZTP_TEST_DATABASE=postgresql+asyncpg://... python -m pytest tests
+"""
+import asyncio
+import json
+import os
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+DATABASE = os.environ.get('ZTP_TEST_DATABASE')
+
+pytestmark = pytest.mark.skipif(not DATABASE,
+                                reason='ZTP_TEST_DATABASE is not set')
+
+EMPLOYEES = 50
+ENTRIES = 100000
+
+SEED = [
+    """
+    INSERT INTO users (userside_id, name)
+    SELECT 900000 + n, 'Benchmark ' || n
+    FROM generate_series(1, :employees) n
+    """,
+    """
+    INSERT INTO models DEFAULT VALUES RETURNING id
+    """,
+    """
+    INSERT INTO entries (status, employee_id, serial_number, model_id,
+                         mac_address, ip_address, task_id, node_id,
+                         autochange_vlans)
+    SELECT (ARRAY['WAITING', 'IN_PROGRESS', 'DONE']::ztp_status[])[
+               CASE WHEN n % 20 = 0 THEN 1 WHEN n % 20 = 1 THEN 2
+                    ELSE 3 END],
+           900000 + 1 + n % :employees,
+           'BENCH' || lpad(n::text, 9, '0'),
+           :model_id,
+           ('0200' || lpad(to_hex(n), 8, '0'))::macaddr,
+           '100.64.0.0'::inet + n,
+           n / 40,
+           n,
+           false
+    FROM generate_series(1, :entries) n
+    """,
+]
+
+# (name, query, index expected in plan).
+# Cursor is in the middle of seeded ids, sequence is not rolled back
+CASES = [
+    ('employee waiting list',
+     "SELECT * FROM entries WHERE employee_id = 900007 AND status = 'WAITING'"
+     " ORDER BY id DESC LIMIT 10",
+     'ix_entries_employee_status_id'),
+    ('employee keyset page',
+     "SELECT * FROM entries WHERE employee_id = 900007 AND status = 'DONE'"
+     ' AND id < {cursor} ORDER BY id DESC LIMIT 10',
+     'ix_entries_employee_status_id'),
+    ('status list',
+     "SELECT * FROM entries WHERE status = 'IN_PROGRESS'"
+     ' ORDER BY id DESC LIMIT 100',
+     'ix_entries_status_id'),
+    ('serial number duplicate',
+     "SELECT * FROM entries WHERE serial_number = 'BENCH000012345'"
+     ' ORDER BY id DESC LIMIT 100',
+     'ix_entries_serial_number'),
+    ('MAC address duplicate',
+     "SELECT * FROM entries WHERE mac_address = '02:00:00:00:30:39'::macaddr"
+     ' ORDER BY id DESC LIMIT 100',
+     'ix_entries_mac_address'),
+    ('IP address duplicate',
+     "SELECT * FROM entries WHERE ip_address = '100.64.48.57'::inet"
+     ' ORDER BY id DESC LIMIT 100',
+     'ix_entries_ip_address'),
+    ('task report page',
+     'SELECT * FROM entries WHERE task_id = 300'
+     ' ORDER BY id DESC LIMIT 500',
+     'ix_entries_task_id'),
+]
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+async def explain_cases() -> dict[str, list[dict]]:
+    """
+    Plan nodes of every case, all on the same seeded data
+    """
+    plans = {}
+    engine = create_async_engine(DATABASE)
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        try:
+            await connection.execute(text(SEED[0]),
+                                     {'employees': EMPLOYEES})
+            model_id = await connection.scalar(text(SEED[1]))
+            await connection.execute(text(SEED[2]),
+                                     {'employees': EMPLOYEES,
+                                      'model_id': model_id,
+                                      'entries': ENTRIES})
+            # Sample covers every row, so plans don't depend on luck
+            await connection.execute(
+                text('SET LOCAL default_statistics_target = 1000'))
+            await connection.execute(text('ANALYZE entries'))
+            cursor = await connection.scalar(
+                text('SELECT max(id) - :half FROM entries'),
+                {'half': ENTRIES // 2})
+            for name, query, _ in CASES:
+                query = query.format(cursor=cursor)
+                response = await connection.scalar(
+                    text(f'EXPLAIN (FORMAT JSON) {query}'))
+                if isinstance(response, str):
+                    response = json.loads(response)
+                plans[name] = list(plan_nodes(response[0]['Plan']))
+        finally:
+            await transaction.rollback()
+    await engine.dispose()
+    return plans
+
+
+@pytest.fixture(scope='module')
+def plans() -> dict[str, list[dict]]:
+    return asyncio.run(explain_cases())
+
+
+@pytest.mark.parametrize('name, query, index', CASES,
+                         ids=[case[0] for case in CASES])
+def test_lookup_uses_index(plans: dict, name: str, query: str, index: str):
+    scans = {node['Node Type'] for node in plans[name]}
+    indexes = {node.get('Index Name') for node in plans[name]}
+    assert 'Seq Scan' not in scans, scans
+    assert index in indexes, indexes
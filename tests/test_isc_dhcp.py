@@ -0,0 +1,195 @@
+"""
+Office ISC DHCP config editing against an in-memory SSH stand-in
+"""
+import re
+
+import pytest
+
+from ztp2.utils.isc_dhcp import OfficeDhcpConfig, OfficeDhcpEditor, \
+    OfficeHost, EXIT_MARKER
+
+FILEPATH = '/etc/dhcp/dhcpd.conf'
+
+HEADER = """\
+authoritative;
+option option125 code 125 = string;
+option option150 code 150 = ip-address;
+
+subnet 10.0.0.0 netmask 255.255.255.0 {
+    range 10.0.0.100 10.0.0.200;
+}
+"""
+FOOTER = """
+# static hosts
+host printer { hardware ethernet 00:aa:bb:cc:dd:ee; }
+"""
+
+
+def host(entry_id: int, mac_address: str, ip_address: str) -> OfficeHost:
+    return OfficeHost(entry_id, mac_address, 'tftp.example',
+                      f'initial/{ip_address}.cfg', '00:00:0d:e9:10',
+                      'tftp.example')
+
+
+SAMPLE = (HEADER + host(1, '00:11:22:33:44:01', '10.1.0.1').render()
+          + host(2, '00:11:22:33:44:02', '10.1.0.2').render() + FOOTER)
+
+
+def test_parse_and_render_round_trip():
+    config = OfficeDhcpConfig(SAMPLE)
+    assert sorted(config.by_entry) == [1, 2]
+    assert config.by_mac['00:11:22:33:44:02'].entry_id == 2
+    assert config.render() == SAMPLE
+
+
+def test_add_replaces_same_entry_and_same_mac():
+    config = OfficeDhcpConfig(SAMPLE)
+    config.add(host(1, '00:11:22:33:44:09', '10.1.0.9'))
+    config.add(host(3, '00:11:22:33:44:02', '10.1.0.3'))
+    reparsed = OfficeDhcpConfig(config.render())
+    assert sorted(reparsed.by_entry) == [1, 3]
+    assert reparsed.by_entry[1].bootfile == 'initial/10.1.0.9.cfg'
+    assert reparsed.by_mac['00:11:22:33:44:02'].entry_id == 3
+    assert config.render().startswith(HEADER)
+    assert FOOTER in config.render()
+
+
+def test_remove():
+    config = OfficeDhcpConfig(SAMPLE)
+    assert config.remove(1)
+    assert not config.remove(1)
+    reparsed = OfficeDhcpConfig(config.render())
+    assert sorted(reparsed.by_entry) == [2]
+    assert '00:11:22:33:44:01' not in reparsed.by_mac
+
+
+def test_change_mac_address():
+    config = OfficeDhcpConfig(SAMPLE)
+    assert config.change_mac_address(1, '00:11:22:33:44:02')
+    assert not config.change_mac_address(5, '00:11:22:33:44:05')
+    reparsed = OfficeDhcpConfig(config.render())
+    # Group that had the MAC address before is gone
+    assert sorted(reparsed.by_entry) == [1]
+    assert reparsed.by_entry[1].mac_address == '00:11:22:33:44:02'
+
+
+def test_change_ip_address():
+    config = OfficeDhcpConfig(SAMPLE)
+    assert config.change_ip_address(2, '10.1.0.22')
+    assert not config.change_ip_address(5, '10.1.0.5')
+    reparsed = OfficeDhcpConfig(config.render())
+    assert reparsed.by_entry[2].bootfile == 'initial/10.1.0.22.cfg'
+    assert reparsed.by_entry[1].bootfile == 'initial/10.1.0.1.cfg'
+
+
+class FakeFile:
+    def __init__(self, files: dict, path: str, mode: str):
+        self.files = files
+        self.path = path
+        self.mode = mode
+        self.written = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if 'w' in self.mode:
+            self.files[self.path] = self.written
+
+    def read(self) -> bytes:
+        return self.files[self.path].encode()
+
+    def write(self, data: str):
+        self.written += data
+
+
+class FakeSFTP:
+    def __init__(self, files: dict):
+        self.files = files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def open(self, path: str, mode: str = 'r') -> FakeFile:
+        return FakeFile(self.files, path, mode)
+
+
+class FakeSSH:
+    """
+    Runs the shell commands the editor sends on a dict of files.
+    dhcpd accepts a file unless it contains `invalid_marker`
+    """
+    def __init__(self, text: str, invalid_marker: str = 'broken;',
+                 reload_ok: bool = True):
+        self.files = {FILEPATH: text}
+        self.invalid_marker = invalid_marker
+        self.reload_ok = reload_ok
+        self.commands = []
+        self.reloads = 0
+        self.remote_conn_pre = self
+
+    def open_sftp(self) -> FakeSFTP:
+        return FakeSFTP(self.files)
+
+    def _execute(self, command: str) -> bool:
+        if match := re.match(r'sudo install -m 644 (\S+) (\S+);', command):
+            self.files[match[2]] = self.files.pop(match[1])
+            return True
+        if match := re.match(r'sudo dhcpd -t -q -cf (\S+)', command):
+            return self.invalid_marker not in self.files[match[1]]
+        if match := re.match(r'sudo rm -f (\S+)', command):
+            self.files.pop(match[1], None)
+            return True
+        if match := re.match(r'sudo cp -p (\S+) (\S+) && '
+                             r'sudo mv -f (\S+) (\S+)', command):
+            self.files[match[2]] = self.files[match[1]]
+            self.files[match[4]] = self.files.pop(match[3])
+            return True
+        if command.endswith('restart'):
+            self.reloads += 1
+            return self.reload_ok
+        raise AssertionError(f'Unexpected command {command}')
+
+    def send_command(self, command: str) -> str:
+        command, _, _ = command.rpartition('; echo ')
+        self.commands.append(command)
+        ok = self._execute(command)
+        return f'{EXIT_MARKER}{0 if ok else 1}\n'
+
+
+def test_editor_saves_checked_config_and_reloads():
+    ssh = FakeSSH(SAMPLE)
+    editor = OfficeDhcpEditor(ssh, FILEPATH)
+    config = editor.load()
+    config.add(host(3, '00:11:22:33:44:03', '10.1.0.3'))
+    editor.save(config)
+    assert sorted(OfficeDhcpConfig(ssh.files[FILEPATH]).by_entry) \
+        == [1, 2, 3]
+    assert ssh.files[f'{FILEPATH}.bak'] == SAMPLE
+    assert set(ssh.files) == {FILEPATH, f'{FILEPATH}.bak'}
+    assert ssh.commands[1] == f'sudo dhcpd -t -q -cf {FILEPATH}.new'
+    assert ssh.reloads == 1
+
+
+def test_editor_keeps_installed_config_when_check_fails():
+    ssh = FakeSSH(SAMPLE)
+    editor = OfficeDhcpEditor(ssh, FILEPATH)
+    config = editor.load()
+    config.parts.append('broken;\n')
+    with pytest.raises(RuntimeError, match='rejected'):
+        editor.save(config)
+    assert ssh.files == {FILEPATH: SAMPLE}
+    assert ssh.reloads == 0
+
+
+def test_editor_raises_when_reload_fails():
+    ssh = FakeSSH(SAMPLE, reload_ok=False)
+    editor = OfficeDhcpEditor(ssh, FILEPATH)
+    config = editor.load()
+    config.remove(2)
+    with pytest.raises(RuntimeError, match='reload'):
+        editor.save(config)
+    assert sorted(OfficeDhcpConfig(ssh.files[FILEPATH]).by_entry) == [1]
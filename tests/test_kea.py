@@ -0,0 +1,120 @@
+"""
+Kea host reservations against Kea schema in a real Postgres.
+
+    ZTP_TEST_KEA_DATABASE=postgresql+asyncpg://... python -m pytest tests
+"""
+import asyncio
+import ipaddress
+import os
+import pathlib
+import uuid
+
+import pytest
+from sqlalchemy import select, text, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from ztp2.db.models.kea_dhcp import Host, DHCPOption
+from ztp2.utils import kea
+
+DATABASE = os.environ.get('ZTP_TEST_KEA_DATABASE')
+SCHEMA = pathlib.Path(__file__).with_name('kea_schema.sql').read_text()
+
+pytestmark = pytest.mark.skipif(not DATABASE,
+                                reason='ZTP_TEST_KEA_DATABASE is not set')
+
+GATEWAY = ipaddress.IPv4Interface('10.0.0.1/24')
+OPTIONS = (GATEWAY, 'tftp.example', 'initial/10.0.0.10.cfg',
+           '10.0.0.2', 'firmwares/DES-3200-C1_4.48.had')
+
+
+def run_with_kea(scenario):
+    """
+    Runs scenario(sessionmaker) in a fresh schema dropped afterwards
+    """
+    async def wrapper():
+        schema = f'kea_test_{uuid.uuid4().hex}'
+        engine = create_async_engine(DATABASE)
+        async with engine.begin() as connection:
+            await connection.execute(text(f'CREATE SCHEMA {schema}'))
+        scoped = create_async_engine(
+            DATABASE,
+            connect_args={'server_settings': {'search_path': schema}})
+        try:
+            async with scoped.begin() as connection:
+                for statement in SCHEMA.split(';'):
+                    if statement.strip():
+                        await connection.exec_driver_sql(statement)
+                await connection.execute(text(
+                    "INSERT INTO dhcp4_subnet (subnet_id, subnet_prefix) "
+                    "VALUES (3, '10.0.0.0/16')"))
+            kea.subnet_registry.checked_at = None
+            kea.subnet_registry.version = None
+            await scenario(async_sessionmaker(scoped,
+                                              expire_on_commit=False))
+        finally:
+            await scoped.dispose()
+            async with engine.begin() as connection:
+                await connection.execute(
+                    text(f'DROP SCHEMA {schema} CASCADE'))
+            await engine.dispose()
+    asyncio.run(wrapper())
+
+
+async def hosts_and_options(db):
+    hosts = (await db.execute(
+        select(Host.host_id, Host.dhcp_identifier, Host.ipv4_address)
+        .order_by(Host.host_id))).all()
+    options = await db.scalar(select(func.count()).select_from(DHCPOption))
+    return hosts, options
+
+
+def test_create_host_and_options():
+    async def scenario(sessionmaker):
+        async with sessionmaker() as db:
+            await kea.create_host_and_options(
+                db, '00:11:22:33:44:55', ipaddress.IPv4Address('10.0.0.10'),
+                *OPTIONS)
+            hosts, options = await hosts_and_options(db)
+        assert [(identifier, address) for _, identifier, address in hosts] \
+            == [(bytes.fromhex('001122334455'),
+                 int(ipaddress.IPv4Address('10.0.0.10')))]
+        assert options == 6
+    run_with_kea(scenario)
+
+
+def test_same_device_is_updated_in_place():
+    async def scenario(sessionmaker):
+        async with sessionmaker() as db:
+            await kea.create_host_and_options(
+                db, '001122334455', ipaddress.IPv4Address('10.0.0.10'),
+                *OPTIONS)
+            (first, *_), _ = await hosts_and_options(db)
+            await kea.create_host_and_options(
+                db, '001122334455', ipaddress.IPv4Address('10.0.0.11'),
+                *OPTIONS)
+            hosts, options = await hosts_and_options(db)
+        assert [(host_id, address) for host_id, _, address in hosts] \
+            == [(first[0], int(ipaddress.IPv4Address('10.0.0.11')))]
+        assert options == 6
+    run_with_kea(scenario)
+
+
+def test_address_is_taken_from_other_device():
+    async def scenario(sessionmaker):
+        async with sessionmaker() as db:
+            await kea.create_hosts_and_options(db, [
+                ('001122334455', ipaddress.IPv4Address('10.0.0.10'),
+                 *OPTIONS),
+                ('001122334466', ipaddress.IPv4Address('10.0.0.12'),
+                 *OPTIONS),
+            ])
+            await kea.create_host_and_options(
+                db, '0011223344ff', ipaddress.IPv4Address('10.0.0.10'),
+                *OPTIONS)
+            hosts, options = await hosts_and_options(db)
+        assert sorted((identifier.hex(), address)
+                      for _, identifier, address in hosts) \
+            == [('001122334466', int(ipaddress.IPv4Address('10.0.0.12'))),
+                ('0011223344ff', int(ipaddress.IPv4Address('10.0.0.10')))]
+        assert options == 12
+    run_with_kea(scenario)
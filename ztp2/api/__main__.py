@@ -2,6 +2,7 @@ from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from celery import Celery
+import aiohttp
 from configargparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import uvicorn
 
@@ -14,6 +15,8 @@ from .stub import ztp_db_session_stub, userside_api_stub, snmp_ro_stub, \
     contexted_ftp_stub
 
 from ..remote_apis.userside import UsersideAPI
+from ..utils.netbox import prefix_index
+from ..utils.userside import userside_cache
 
 ENV_VAR_PREFIX = 'ZTP_'
 
@@ -93,8 +96,10 @@ def main():
 
     userside_url = args.userside_url
     userside_key = args.userside_key
-    userside_api = UsersideAPI(userside_url, userside_key)
+    userside_api = UsersideAPI(userside_url, userside_key,
+                               cache=userside_cache)
     app.dependency_overrides[userside_api_stub] = get_userside_api(userside_api)
+    app.add_event_handler('shutdown', userside_api.close)
 
     snmp_community = args.snmp_community_ro
     app.dependency_overrides[snmp_ro_stub] = get_snmp_ro(snmp_community)
@@ -105,6 +110,12 @@ def main():
     app.dependency_overrides[netbox_session_stub] = get_http_session(
         netbox_url, headers=headers)
 
+    async def load_prefix_index():
+        async with aiohttp.ClientSession(netbox_url,
+                                         headers=headers) as session:
+            await prefix_index.sync(session)
+    app.add_event_handler('startup', load_prefix_index)
+
     celery = Celery(broker=args.celery_broker, backend=args.celery_result)
     celery.conf.task_track_started = True
     celery.conf.result_extended = True
@@ -3,7 +3,7 @@ from typing import Any
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import MACADDR
-from sqlalchemy import select, cast, desc, insert, update, delete
+from sqlalchemy import select, cast, desc, insert, update, delete, or_
 from sqlalchemy.orm import selectinload
 
 from ...db.models.ztp import Entry
@@ -28,6 +28,18 @@ class ConcreteCRUD(CRUDBase[Entry, EntryCreateRequest, EntryPatchRequest]):
         await db.commit()
         return result.scalars().first()
 
+    async def create_many(self, db: AsyncSession, *,
+                          objs_in: list[dict]) -> list[Entry]:
+        statement = insert(self._schema)
+        statement = statement.values([jsonable_encoder(obj_in)
+                                      for obj_in in objs_in])
+        statement = statement.returning(self._schema)
+        statement = statement.options(selectinload(self._schema.model))
+        statement = statement.options(selectinload(self._schema.employee))
+        result = await db.execute(statement)
+        await db.commit()
+        return result.scalars().all()
+
     async def read(self, db: AsyncSession, id: Any):
         statement = select(self._schema).where(self._schema.id == id)
         statement = statement.options(selectinload(self._schema.model))
@@ -43,7 +55,12 @@ class ConcreteCRUD(CRUDBase[Entry, EntryCreateRequest, EntryPatchRequest]):
                               mac_address: str = None,
                               serial_number: str = None,
                               task_id: int = None,
+                              after_id: int = None,
                               skip: int = 0, limit: int = 100) -> list[Entry]:
+        """
+        Newest first. after_id is a keyset cursor: entries older than it
+        are returned and skip is ignored, so deep pages cost the same
+        """
         statement = select(self._schema)
         if employee_id:
             statement = statement.where(self._schema.employee_id == employee_id)
@@ -60,13 +77,50 @@ class ConcreteCRUD(CRUDBase[Entry, EntryCreateRequest, EntryPatchRequest]):
         if task_id:
             statement = statement.where(self._schema.task_id == task_id)
         statement = statement.order_by(desc(self._schema.id))
-        statement = statement.offset(skip).limit(limit)
+        if after_id is not None:
+            statement = statement.where(self._schema.id < after_id)
+        else:
+            statement = statement.offset(skip)
+        statement = statement.limit(limit)
         statement = statement.options(selectinload(self._schema.model))
         statement = statement.options(selectinload(self._schema.employee))
         response = await db.execute(statement)
         target_obj = response.scalars().all()
         return target_obj
 
+    async def find_conflicts(self, db: AsyncSession, *,
+                             serial_number: str = None,
+                             mac_address: str = None,
+                             ip_address: ipaddress.IPv4Address = None
+                             ) -> dict[str, list[int]]:
+        """
+        IDs of entries sharing serial number, MAC or IP address,
+        newest first, grouped by field. One query, no relationships
+        """
+        clauses = {}
+        if serial_number:
+            clauses['serial_number'] = \
+                self._schema.serial_number == serial_number
+        if mac_address:
+            clauses['mac_address'] = \
+                self._schema.mac_address == cast(mac_address, MACADDR)
+        if ip_address:
+            clauses['ip_address'] = self._schema.ip_address == ip_address
+        if not clauses:
+            return {}
+        statement = select(self._schema.id,
+                           *(clause.label(field)
+                             for field, clause in clauses.items()))
+        statement = statement.where(or_(*clauses.values()))
+        statement = statement.order_by(desc(self._schema.id))
+        response = await db.execute(statement)
+        conflicts = {}
+        for row in response.mappings():
+            for field in clauses:
+                if row[field]:
+                    conflicts.setdefault(field, []).append(row['id'])
+        return conflicts
+
     async def update(self, db: AsyncSession, *,
                      db_obj: Entry,
                      obj_in: EntryPatchRequest | dict[str, Any]
@@ -96,5 +150,11 @@ class ConcreteCRUD(CRUDBase[Entry, EntryCreateRequest, EntryPatchRequest]):
         await db.commit()
         return result.scalars().first()
 
+    async def delete_many(self, db: AsyncSession, *, ids: list[int]):
+        statement = delete(self._schema)
+        statement = statement.where(self._schema.id.in_(ids))
+        await db.execute(statement)
+        await db.commit()
+
 
 entry = ConcreteCRUD(Entry)
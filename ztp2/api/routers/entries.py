@@ -1,12 +1,15 @@
 import aiosnmp.exceptions
-from fastapi import APIRouter, Depends
+import asyncio
+from fastapi import APIRouter, Depends, Response
 import ipaddress
 import logging
 
 
 from .. import crud
 from ... import utils
-from ..schemas.entries import Entry, EntryCreateRequest, EntryPatchRequest
+from ..schemas.entries import Entry, EntryCreateRequest, EntryPatchRequest, \
+    EntryBulkCreateRequest
+from ..timing import StageTimer
 from ..stub import ztp_db_session_stub, userside_api_stub, snmp_ro_stub, \
     netbox_session_stub, celery_stub, kea_db_session_stub, ftp_settings_stub, \
     contexted_ftp_stub
@@ -17,6 +20,7 @@ entries_router = APIRouter()
 
 @entries_router.post('/', response_model=Entry | None)
 async def entries_create(req: EntryCreateRequest,
+                         response: Response,
                          db=Depends(ztp_db_session_stub),
                          kea=Depends(kea_db_session_stub),
                          userside_api=Depends(userside_api_stub),
@@ -27,6 +31,7 @@ async def entries_create(req: EntryCreateRequest,
                          ftp=Depends(contexted_ftp_stub)):
     logging.error(req)
     mount_type = req.mount_type
+    timer = StageTimer()
 
     # Common parameters
     new_object = {'serial_number': req.serial_number.upper(),
@@ -39,16 +44,15 @@ async def entries_create(req: EntryCreateRequest,
     new_object['mac_address'] = mac_address
 
     # Duplicate check
-    possible_serial_duplicates = await crud.entry.read_by_clauses(
-        db, serial_number=new_object['serial_number']
-    )
-    possible_mac_duplicates = await crud.entry.read_by_clauses(
-        db, mac_address=new_object['mac_address']
-    )
-    if mount_type == 'changeSwitch':
-        possible_ip_duplicates = await crud.entry.read_by_clauses(
-            db, ip_address=req.ip_address
-        )
+    with timer.stage('duplicates'):
+        conflicts = await crud.entry.find_conflicts(
+            db, serial_number=new_object['serial_number'],
+            mac_address=new_object['mac_address'],
+            ip_address=req.ip_address if mount_type == 'changeSwitch'
+            else None)
+    if conflicts:
+        logging.warning(f'Entry {new_object["serial_number"]} conflicts '
+                        f'with existing ones: {conflicts}')
 
     # Task ID
     if mount_type == 'newHouse':
@@ -56,82 +60,145 @@ async def entries_create(req: EntryCreateRequest,
     else:
         new_object['task_id'] = None
 
-    # Node ID
-    if mount_type == 'newHouse':
-        new_object['node_id'] = req.node_id
-    else:
-        new_object['node_id'] = await utils.get_node_id(req.ip_address.exploded,
-                                                        userside_api)
-    # IP address
-    if mount_type == 'changeSwitch':
-        new_object['ip_address'] = req.ip_address.exploded
-    else:
+    # Remote lookups below depend on each other only partially,
+    # so every one of them starts as soon as its inputs are ready.
+    # Database session is not used here: it can't run concurrent queries
+    async def task_specification():
+        with timer.stage('task'):
+            return await utils.userside.get_task_specification(
+                new_object['task_id'], userside_api)
+
+    async def switch_snapshot():
+        # Only VLAN names of parent switch are needed for new switch
+        tables = ('vlans',) if mount_type == 'newSwitch' \
+            else utils.snmp.SNAPSHOT_TABLES
+        with timer.stage('snmp'):
+            try:
+                return await utils.snmp.get_switch_snapshot(
+                    req.ip_address.exploded, snmp_ro, tables)
+            except aiosnmp.exceptions.SnmpTimeoutError:
+                logging.error('Timeout while reading old switch')
+            except (TypeError, ValueError, AttributeError):
+                logging.error('Some strange things happened here')
+
+    async def node_id():
+        if mount_type == 'newHouse':
+            return req.node_id
+        with timer.stage('node'):
+            return await utils.get_node_id(req.ip_address.exploded,
+                                           userside_api)
+
+    async def ip_address():
+        if mount_type == 'changeSwitch':
+            return req.ip_address.exploded
         if mount_type == 'newSwitch':
-            management_prefix = await utils.get_prefix(req.ip_address.exploded,
-                                                       netbox)
+            with timer.stage('prefix'):
+                management_prefix = await utils.get_prefix(
+                    req.ip_address.exploded, netbox)
         else:
-            task_prefixes = await utils.get_task_prefixes(
-                new_object['task_id'], userside_api
-            )
-            management_prefix = task_prefixes[0]
-        new_ip = await utils.get_and_reserve_ip(management_prefix, netbox)
-        new_object['ip_address'] = new_ip
+            specification = await specification_task
+            management_prefix = utils.userside.parse_task_prefixes(
+                specification)[0]
+        with timer.stage('reserve'):
+            return await utils.get_and_reserve_ip(management_prefix, netbox)
+
+    async def management():
+        ip = await ip_task
+        with timer.stage('management'):
+            return await asyncio.gather(
+                utils.netbox.get_vlan(ip, netbox),
+                utils.netbox.get_default_gateway(ip, netbox))
+
+    async def parent():
+        if mount_type == 'newSwitch':
+            return req.ip_address.exploded, req.parent_port, True
+        if mount_type == 'newHouse':
+            return None, None, False
+        with timer.stage('parent'):
+            switch, port = await utils.userside.get_parent_switch_port(
+                req.ip_address.exploded, userside_api)
+        return switch, port, (switch is not None) and (port is not None)
+
+    async def other_vlans():
+        """
+        VLANs overriding management ones and VLANs added only if missing
+        """
+        if mount_type != 'newHouse':
+            snapshot = await snapshot_task
+            if snapshot is None:
+                return {}, []
+            try:
+                return snapshot.vlan_list(), []
+            except (TypeError, ValueError, AttributeError):
+                logging.error('Some strange things happened here')
+                return {}, []
+        specification = await specification_task
+        task_prefixes = utils.userside.parse_task_prefixes(specification)
+        task_vlans = utils.userside.parse_task_vlans(specification)
+        with timer.stage('vlans'):
+            prefix_vlans, task_vlans = await asyncio.gather(
+                asyncio.gather(*(utils.netbox.get_vlan(prefix, netbox)
+                                 for prefix in task_prefixes)),
+                asyncio.gather(*(utils.netbox.get_vlan(vlan, netbox)
+                                 for vlan in task_vlans)))
+        return dict(prefix_vlans), task_vlans
+
+    async def device_model():
+        with timer.stage('model'):
+            return await utils.get_device_model(new_object['serial_number'],
+                                                userside_api)
+
+    specification_task = None
+    snapshot_task = None
+    if mount_type == 'newHouse':
+        specification_task = asyncio.create_task(task_specification())
+    else:
+        snapshot_task = asyncio.create_task(switch_snapshot())
+    ip_task = asyncio.create_task(ip_address())
+    node_task = asyncio.create_task(node_id())
+    parent_task = asyncio.create_task(parent())
+    vlans_task = asyncio.create_task(other_vlans())
+    model_task = asyncio.create_task(device_model())
+    management_task = asyncio.create_task(management())
+    tasks = [task
+             for task in (specification_task, snapshot_task, ip_task,
+                          node_task, parent_task, vlans_task, model_task,
+                          management_task)
+             if task is not None]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Address of replaced switch is not ours to give back
+        if mount_type != 'changeSwitch' and ip_task.done() \
+                and not ip_task.cancelled() and ip_task.exception() is None:
+            await release_reserved([ip_task.result()], netbox)
+        raise
+    new_object['node_id'] = node_task.result()
+    new_object['ip_address'] = ip_task.result()
+    snapshot = snapshot_task.result() if snapshot_task else None
+    switch, port, autochange_vlans = parent_task.result()
+    vlan_overrides, vlan_additions = vlans_task.result()
+    model = model_task.result()
+    (mgmt_id, mgmt_name), default_gateway = management_task.result()
 
     # Parent switch and port
-    if mount_type == 'newSwitch':
-        new_object['parent_switch'] = req.ip_address.exploded  # noqa
-        new_object['parent_port'] = req.parent_port
-        new_object['autochange_vlans'] = True
-    elif mount_type == 'newHouse':
-        new_object['parent_switch'] = None
-        new_object['parent_port'] = None
-        new_object['autochange_vlans'] = False
-    elif mount_type == 'changeSwitch':
-        switch, port = await utils.userside.get_parent_switch_port(
-            new_object['ip_address'], userside_api
-        )
-        new_object['parent_switch'] = switch
-        new_object['parent_port'] = port
-        if (switch is not None) and (port is not None):
-            new_object['autochange_vlans'] = True
-        else:
-            new_object['autochange_vlans'] = False
+    new_object['parent_switch'] = switch
+    new_object['parent_port'] = port
+    new_object['autochange_vlans'] = autochange_vlans
 
-    mgmt_id, mgmt_name = await utils.netbox.get_vlan(new_object['ip_address'],
-                                                     netbox)
     # VLAN settings
     vlan_settings = {'1': 'default',
                      mgmt_id: mgmt_name}
-    if mount_type == 'newHouse':
-        task_prefixes = await utils.get_task_prefixes(
-            new_object['task_id'], userside_api
-        )
-        if task_prefixes:
-            for prefix in task_prefixes:
-                vlan_id, vlan_name = await utils.netbox.get_vlan(prefix, netbox)
-                vlan_settings[vlan_id] = vlan_name
-        task_vlans = await utils.userside.get_task_vlans(req.task_id, userside_api)
-        if task_vlans:
-            for vlan in task_vlans:
-                vlan_id, vlan_name = await utils.netbox.get_vlan(vlan, netbox)
-                if vlan_id not in vlan_settings:
-                    vlan_settings[vlan_id] = vlan_name
-    else:
-        try:
-            vlans = await utils.snmp.get_vlan_list(req.ip_address.exploded,
-                                                   snmp_ro)
-            for vlan_id, vlan_name in vlans.items():
-                vlan_settings[vlan_id] = vlan_name
-        except aiosnmp.exceptions.SnmpTimeoutError:
-            logging.error('Timeout while reading old switch vlans')
-        except (TypeError, ValueError, AttributeError):
-            logging.error('Some strange things happened here')
+    vlan_settings.update(vlan_overrides)
+    for vlan_id, vlan_name in vlan_additions:
+        if vlan_id not in vlan_settings:
+            vlan_settings[vlan_id] = vlan_name
     new_object['vlan_settings'] = vlan_settings.copy()
     new_object['modified_vlan_settings'] = vlan_settings.copy()
 
     # Model ID
-    model = await utils.get_device_model(new_object['serial_number'],
-                                         userside_api)
     model_obj = await crud.model.read_by_model(db, model)
     if model_obj:
         model_obj = model_obj[0]
@@ -139,7 +206,7 @@ async def entries_create(req: EntryCreateRequest,
 
     # Port settings
     portcount = model_obj.portcount
-    if mount_type == 'changeSwitch':
+    if mount_type == 'changeSwitch' and snapshot is not None:
         port_settings = {
             str(port): {'description': '',
                         'tagged': [],
@@ -147,10 +214,7 @@ async def entries_create(req: EntryCreateRequest,
             for port in range(1, portcount + 1)
         }
         try:
-            descriptions = await utils.snmp.get_ports_descriptions(
-                req.ip_address.exploded, snmp_ro)
-        except aiosnmp.exceptions.SnmpTimeoutError:
-            logging.error('Timeout while reading old switch descriptions')
+            descriptions = snapshot.ports_descriptions()
         except (TypeError, ValueError, AttributeError):
             logging.error('Some strange things happened here')
         else:
@@ -162,16 +226,7 @@ async def entries_create(req: EntryCreateRequest,
                                             'tagged': [],
                                             'untagged': []}
         try:
-            port_vlans = await utils.snmp.get_port_vlans(req.ip_address.exploded,
-                                                         snmp_ro)
-        except aiosnmp.exceptions.SnmpTimeoutError:
-            logging.error('Timeout while reading old switch vlans')
-            port_settings = {
-                str(port): {'description': '',
-                            'tagged': [int(mgmt_id)],
-                            'untagged': []}
-                for port in range(1, portcount + 1)
-            }
+            port_vlans = snapshot.port_vlans()
         except (TypeError, ValueError, AttributeError):
             logging.error('Some strange things happened here')
         else:
@@ -191,34 +246,39 @@ async def entries_create(req: EntryCreateRequest,
     new_object['original_port_settings'] = port_settings.copy()
     new_object['modified_port_settings'] = port_settings.copy()
 
-    answer = await crud.entry.create(db, obj_in=new_object)
-
-    default_gateway = await utils.netbox.get_default_gateway(
-        answer.ip_address.exploded, netbox)
+    with timer.stage('insert'):
+        answer = await crud.entry.create(db, obj_in=new_object)
 
     initial_config_filepath = f'{ftp_settings.configs_initial_path}' \
                               f'{answer.ip_address.exploded}.cfg'
     firmware_filepath = ftp_settings.firmwares_path + model_obj.firmware
-
-    await utils.kea.create_host_and_options(
-        kea, answer.mac_address, answer.ip_address, default_gateway,
-        ftp_settings.host, initial_config_filepath, ftp_settings.host,
-        firmware_filepath)
-
     initial_template_filepath = f'{ftp_settings.templates_initial_path}' \
                                 f'{model_obj.default_initial_config}'
     full_config_filepath = f'{ftp_settings.configs_full_path}' \
                            f'{answer.ip_address.exploded}.cfg'
     full_template_filepath = f'{ftp_settings.templates_full_path}' \
                              f'{model_obj.default_full_config}'
-    async with ftp as ftp_instance:
-        await utils.ztp.generate_initial_config(
-            answer, model_obj, ftp_settings.tftp_folder,
-            initial_template_filepath, initial_config_filepath, netbox,
-            ftp_instance)
-        await utils.ztp.generate_full_config(
-            answer, model_obj, ftp_settings.tftp_folder,
-            full_template_filepath, full_config_filepath, netbox, ftp_instance)
+
+    async def write_kea():
+        with timer.stage('kea'):
+            await utils.kea.create_host_and_options(
+                kea, answer.mac_address, answer.ip_address, default_gateway,
+                ftp_settings.host, initial_config_filepath, ftp_settings.host,
+                firmware_filepath)
+
+    async def write_configs():
+        with timer.stage('configs'):
+            async with ftp as ftp_instance:
+                await utils.ztp.generate_configs(
+                    [(utils.ztp.gather_initial_configuration_parameters,
+                      answer, model_obj, initial_template_filepath,
+                      initial_config_filepath),
+                     (utils.ztp.gather_full_configuration_parameters,
+                      answer, model_obj, full_template_filepath,
+                      full_config_filepath)],
+                    ftp_settings.tftp_folder, netbox, ftp_instance)
+
+    await asyncio.gather(write_kea(), write_configs())
 
     celery_task_kwargs = {
         'entry_id': answer.id,
@@ -229,6 +289,165 @@ async def entries_create(req: EntryCreateRequest,
      }
     celery.send_task('ztp2_office_dhcp', kwargs=celery_task_kwargs)
 
+    response.headers['Server-Timing'] = timer.header()
+    if conflicts:
+        response.headers['X-Entry-Conflicts'] = '; '.join(
+            f'{field}={",".join(map(str, ids))}'
+            for field, ids in conflicts.items())
+    return answer
+
+
+async def release_reserved(ips: list[str], netbox):
+    """
+    Failure to release must not hide the original error
+    """
+    try:
+        await utils.netbox.release_ips(ips, netbox)
+    except Exception as exc:
+        logging.error(f'Reserved addresses {ips} were not released: {exc!r}')
+
+
+@entries_router.post('/bulk/', response_model=list[Entry])
+async def entries_bulk_create(req: EntryBulkCreateRequest,
+                              db=Depends(ztp_db_session_stub),
+                              kea=Depends(kea_db_session_stub),
+                              userside_api=Depends(userside_api_stub),
+                              netbox=Depends(netbox_session_stub),
+                              celery=Depends(celery_stub),
+                              ftp_settings=Depends(ftp_settings_stub),
+                              ftp=Depends(contexted_ftp_stub)):
+    """
+    newHouse for many switches of one task:
+    task, VLANs and models are resolved once for all switches
+    """
+    switches = [(switch.serial_number.upper(),
+                 ''.join(letter for letter in switch.mac_address.lower()
+                         if letter in '0123456789abcdef'))
+                for switch in req.switches]
+    if not switches:
+        return []
+
+    # Task specification
+    specification = await utils.userside.get_task_specification(
+        req.task_id, userside_api)
+    task_prefixes = utils.userside.parse_task_prefixes(specification)
+    task_vlans = utils.userside.parse_task_vlans(specification)
+
+    # IP addresses, models and VLANs
+    serials = list(dict.fromkeys(serial for serial, _ in switches))
+    results = await asyncio.gather(
+        utils.netbox.reserve_ips(task_prefixes[0], len(switches), netbox),
+        asyncio.gather(*(utils.get_device_model(serial, userside_api)
+                         for serial in serials)),
+        asyncio.gather(*(utils.netbox.get_vlan(prefix, netbox)
+                         for prefix in task_prefixes)),
+        asyncio.gather(*(utils.netbox.get_vlan(vlan, netbox)
+                         for vlan in task_vlans)),
+        return_exceptions=True
+    )
+    errors = [result for result in results
+              if isinstance(result, BaseException)]
+    if errors:
+        if not isinstance(results[0], BaseException):
+            await release_reserved(results[0], netbox)
+        raise errors[0]
+    new_ips, models, prefix_vlans, task_vlans = results
+
+    # Reserved addresses and created entries are given back on failure
+    answer = []
+    try:
+        models = dict(zip(serials, models))
+        model_objs = {}
+        for model in set(models.values()):
+            model_obj = await crud.model.read_by_model(db, model)
+            model_objs[model] = model_obj[0]
+
+        # Management VLAN is the same for the whole prefix VLAN
+        mgmt_id, mgmt_name = await utils.netbox.get_vlan(new_ips[0], netbox)
+        vlan_settings = {'1': 'default',
+                         mgmt_id: mgmt_name}
+        for vlan_id, vlan_name in prefix_vlans:
+            vlan_settings[vlan_id] = vlan_name
+        for vlan_id, vlan_name in task_vlans:
+            if vlan_id not in vlan_settings:
+                vlan_settings[vlan_id] = vlan_name
+
+        new_objects = []
+        for (serial_number, mac_address), new_ip in zip(switches, new_ips):
+            model_obj = model_objs[models[serial_number]]
+            port_settings = {
+                str(port): {'description': '',
+                            'tagged': [int(mgmt_id)],
+                            'untagged': []}
+                for port in range(1, model_obj.portcount + 1)
+            }
+            new_objects.append({
+                'serial_number': serial_number, 'status': 'WAITING',
+                'employee_id': req.employee_id, 'port_movements': {},
+                'mac_address': mac_address, 'task_id': req.task_id,
+                'node_id': req.node_id, 'ip_address': new_ip,
+                'parent_switch': None, 'parent_port': None,
+                'autochange_vlans': False, 'model_id': model_obj.id,
+                'vlan_settings': vlan_settings.copy(),
+                'modified_vlan_settings': vlan_settings.copy(),
+                'original_port_settings': port_settings.copy(),
+                'modified_port_settings': port_settings.copy(),
+            })
+        answer = await crud.entry.create_many(db, objs_in=new_objects)
+
+        default_gateways = await asyncio.gather(
+            *(utils.netbox.get_default_gateway(entry.ip_address.exploded,
+                                               netbox)
+              for entry in answer))
+        hosts = []
+        office_entries = []
+        config_jobs = []
+        for entry, default_gateway in zip(answer, default_gateways):
+            initial_config_filepath = f'{ftp_settings.configs_initial_path}' \
+                                      f'{entry.ip_address.exploded}.cfg'
+            full_config_filepath = f'{ftp_settings.configs_full_path}' \
+                                   f'{entry.ip_address.exploded}.cfg'
+            firmware_filepath = ftp_settings.firmwares_path \
+                + entry.model.firmware
+            hosts.append((entry.mac_address, entry.ip_address, default_gateway,
+                          ftp_settings.host, initial_config_filepath,
+                          ftp_settings.host, firmware_filepath))
+            office_entries.append({
+                'entry_id': entry.id,
+                'mac_address': entry.mac_address,
+                'ftp_host': ftp_settings.host,
+                'config_filename': initial_config_filepath,
+                'firmware_filename': firmware_filepath
+            })
+            config_jobs.append((
+                utils.ztp.gather_initial_configuration_parameters,
+                entry, entry.model,
+                ftp_settings.templates_initial_path
+                + entry.model.default_initial_config,
+                initial_config_filepath))
+            config_jobs.append((
+                utils.ztp.gather_full_configuration_parameters,
+                entry, entry.model,
+                ftp_settings.templates_full_path
+                + entry.model.default_full_config,
+                full_config_filepath))
+
+        async with ftp as ftp_instance:
+            await utils.ztp.generate_configs(config_jobs,
+                                             ftp_settings.tftp_folder,
+                                             netbox, ftp_instance)
+        # Last: nothing is left to undo in Kea if anything before fails
+        await utils.kea.create_hosts_and_options(kea, hosts)
+    except BaseException:
+        await release_reserved(new_ips, netbox)
+        if answer:
+            await db.rollback()
+            await crud.entry.delete_many(db, ids=[entry.id
+                                                  for entry in answer])
+        raise
+    celery.send_task('ztp2_office_dhcp_bulk',
+                     kwargs={'entries': office_entries})
+
     return answer
 
 
@@ -241,6 +460,7 @@ async def entries_list(skip: int = 0,
                        mac_address: str = None,
                        serial_number: str = None,
                        task_id: int = None,
+                       after_id: int = None,
                        db=Depends(ztp_db_session_stub)):
     entries = await crud.entry.read_by_clauses(db, employee_id=employee_id,
                                                status=status,
@@ -248,6 +468,7 @@ async def entries_list(skip: int = 0,
                                                mac_address=mac_address,
                                                serial_number=serial_number,
                                                task_id=task_id,
+                                               after_id=after_id,
                                                skip=skip, limit=limit)
     return entries
 
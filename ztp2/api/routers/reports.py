@@ -1,27 +1,73 @@
+import csv
 from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+import io
+from typing import Literal
+
 from ..stub import ztp_db_session_stub, userside_api_stub
 from .. import crud
 from ... import utils
 
+REPORT_PAGE_SIZE = 500
+REPORT_COLUMNS = ['ztp_id', 'ip_address', 'serial_number', 'mac_address',
+                  'box_name', 'model', 'employee']
+
 reports_router = APIRouter()
 
 
 @reports_router.get('/commissioning/{task_id}/')
 async def commissioning_report(task_id: int,
+                               format: Literal['json', 'csv'] = 'json',
                                db=Depends(ztp_db_session_stub),
                                userside_api=Depends(userside_api_stub)):
-    entries = await crud.entry.read_by_clauses(db, task_id=task_id)
+    entries = []
+    while True:
+        page = await crud.entry.read_by_clauses(
+            db, task_id=task_id,
+            after_id=entries[-1].id if entries else None,
+            limit=REPORT_PAGE_SIZE)
+        entries += page
+        if len(page) < REPORT_PAGE_SIZE:
+            break
+    node_names = await utils.userside.get_node_names(
+        [entry.node_id for entry in entries], userside_api)
     # ZTP ID | IP | SN | Имя Бокса | id Бокса | Модель коммутатора
     entries = [
         {'ztp_id': entry.id,
          'ip_address': entry.ip_address.exploded,
          'serial_number': entry.serial_number,
          'mac_address': entry.mac_address,
-         'box_name': (await utils.userside.get_node_name(
-             entry.node_id, userside_api)).replace(
+         'box_name': node_names[entry.node_id].replace(
              'Россия, Санкт-Петербург, ', ''),
          'model': entry.model.model,
          'employee': ', '.join(entry.employee.name.split(' ')[:2])}
         for entry in entries
     ]
+    if format == 'csv':
+        filename = f'commissioning_{task_id}.csv'
+        return StreamingResponse(
+            csv_rows(entries, REPORT_COLUMNS), media_type='text/csv',
+            headers={'Content-Disposition':
+                     f'attachment; filename="{filename}"'})
     return entries
+
+
+def csv_rows(rows: list[dict], columns: list[str]):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+@reports_router.get('/cache/')
+async def cache_report():
+    return {'netbox': utils.netbox.netbox_cache.stats(),
+            'prefix_index': utils.netbox.prefix_index.stats(),
+            'userside': utils.userside.userside_cache.stats(),
+            'node_names': utils.userside.node_names_cache.stats(),
+            'snmp_snapshots': utils.snmp.snapshot_cache.stats()}
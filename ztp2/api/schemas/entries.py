@@ -23,6 +23,18 @@ class EntryCreateRequest(BaseModel):
         orm_mode = True
 
 
+class EntryBulkItem(BaseModel):
+    serial_number: str = Field(..., alias='serial')
+    mac_address: str = Field(..., alias='mac')
+
+
+class EntryBulkCreateRequest(BaseModel):
+    employee_id: int = Field(..., alias='employeeId')
+    node_id: int = Field(..., alias='nodeId')
+    task_id: int = Field(..., alias='taskId')
+    switches: list[EntryBulkItem]
+
+
 class EntryPatchRequest(BaseModel):
     started_at: datetime.datetime = None
     finished_at: datetime.datetime = None
@@ -71,6 +83,7 @@ class Entry(BaseModel):
     modified_port_settings: dict = None
     vlan_settings: dict = None
     modified_vlan_settings: dict = None
+    ztp_state: str = None
 
     class Config:
         orm_mode = True
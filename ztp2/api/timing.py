@@ -0,0 +1,25 @@
+import contextlib
+import time
+
+
+class StageTimer:
+    """
+    Durations of named handler stages, rendered as Server-Timing header
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = (time.perf_counter() - started) * 1000
+
+    def header(self) -> str:
+        total = (time.perf_counter() - self.started) * 1000
+        stages = [f'{name};dur={duration:.1f}'
+                  for name, duration in self.durations.items()]
+        return ', '.join(stages + [f'total;dur={total:.1f}'])
@@ -48,7 +48,11 @@ def main_keyboard(is_ztp_started: bool):
         builder.row(
             InlineKeyboardButton(
                 text='Остановить ZTP',
-                callback_data=ManageData(cat='ztp', action='stop_ztp').pack()))
+                callback_data=ManageData(cat='ztp', action='stop_ztp').pack()),
+            InlineKeyboardButton(
+                text='Аплинк настроен',
+                callback_data=ManageData(cat='ztp',
+                                         action='uplink_done').pack()))
     else:
         builder.row(
             InlineKeyboardButton(
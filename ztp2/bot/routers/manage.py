@@ -127,6 +127,8 @@ async def ztp_control(query: types.CallbackQuery,
         await utils.stop_ztp(api_session, data['celery_id'])
         data['celery_id'] = None
         await state.set_data(data)
+    elif action == 'uplink_done':
+        await utils.ztp_event(api_session, data['id'], 'uplink_configured')
     elif action == 'finalize':
         await utils.ztp_finalize(api_session,
                                  data['id'],
@@ -114,6 +114,17 @@ async def ztp_finalize(api_session: aiohttp.ClientSession,
     return content['task_id']
 
 
+async def ztp_event(api_session: aiohttp.ClientSession,
+                    ztp_id: int,
+                    event: str):
+    body = {'name': 'ztp2_event',
+            'args': [ztp_id, event],
+            'kwargs': {}}
+    async with api_session.post('/celery/', json=body) as response:
+        content = await response.json()
+    return content['task_id']
+
+
 async def stop_ztp(api_session: aiohttp.ClientSession,
                    celery_id: str):
     await api_session.delete(f'/celery/{celery_id}/')
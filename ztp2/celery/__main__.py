@@ -1,13 +1,19 @@
 from configargparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import celery
+from celery.signals import worker_init, worker_shutdown, \
+    worker_process_init, worker_process_shutdown
 
-from .dependencies import sessionmaker_factory, netbox_session_factory
-from .tasks.ztp import PreparedTask, RemoteFileModifyTask
+from .dependencies import WorkerResources
+from .machine import CHECK_DELAY
+from .office_dhcp import OFFICE_DHCP_FLUSH_DELAY, OFFICE_DHCP_BATCH_SIZE
+from .tasks.ztp import PreparedTask, OfficeDhcpTask, TFTP_LOG_FILENAME
 from ..remote_apis.ftp import FtpFactory
 from ..remote_apis.snmp import DeviceSNMP
 from ..remote_apis.terminal import DeviceTerminal
 from ..remote_apis.server import ServerTerminalFactory
 from ..remote_apis.userside import UsersideAPI
+from ..utils.tftp import TftpLogWatcher
+from ..utils.userside import userside_cache
 
 
 ENV_VAR_PREFIX = 'ZTP_'
@@ -19,14 +25,20 @@ parser = ArgumentParser(
 )
 
 
-def main():
+def prepare_worker():
     group = parser.add_argument_group('Celery')
     group.add_argument('--celery-broker', help='Broker URL', required=True)
     group.add_argument('--celery-result', help='Result backend', required=True)
     group.add_argument('--celery-hostname', help='Worker name', required=True)
+    group.add_argument('--max-in-flight',
+                       help='Simultaneous tasks of ztp-runner',
+                       type=int, default=200)
 
     group = parser.add_argument_group('Database')
     group.add_argument('--database', help='Main ZTP database', required=True)
+    group.add_argument('--database-pool-size',
+                       help='Database connections per worker process',
+                       type=int, default=5)
 
     group = parser.add_argument_group('Bot')
     group.add_argument('--bot-token', help='ZTP bot token', required=True)
@@ -34,6 +46,9 @@ def main():
     group = parser.add_argument_group('Netbox')
     group.add_argument('--netbox-url', help='Netbox URL', required=True)
     group.add_argument('--netbox-token', help='Netbox RW token', required=True)
+    group.add_argument('--netbox-connections',
+                       help='Netbox connections per worker process',
+                       type=int, default=20)
 
     group = parser.add_argument_group('Userside')
     group.add_argument('--userside-url',
@@ -74,6 +89,13 @@ def main():
     group.add_argument('--office-dhcp-filename',
                        help='Office DHCP server config filename',
                        required=True)
+    group.add_argument('--office-dhcp-flush-delay',
+                       help='Seconds to collect office DHCP changes '
+                            'before rewriting config',
+                       type=int, default=OFFICE_DHCP_FLUSH_DELAY)
+    group.add_argument('--office-dhcp-batch-size',
+                       help='Office DHCP changes applied with one reload',
+                       type=int, default=OFFICE_DHCP_BATCH_SIZE)
 
     args = parser.parse_args()
     app = celery.Celery(include=['ztp2.celery.tasks.ztp'],
@@ -82,7 +104,18 @@ def main():
     app.conf.task_track_started = True
     app.conf.result_extended = True
 
-    PreparedTask.sessionmaker_factory = sessionmaker_factory(args.database)
+    resources = WorkerResources(
+        database_url=args.database,
+        netbox_url=args.netbox_url,
+        netbox_token=args.netbox_token,
+        bot_token=args.bot_token,
+        userside_api=UsersideAPI(args.userside_url, args.userside_key,
+                                 cache=userside_cache),
+        pool_size=args.database_pool_size,
+        http_limit=args.netbox_connections)
+    PreparedTask.resources = resources
+
+    PreparedTask.sessionmaker_factory = resources.sessionmaker_factory
 
     PreparedTask.bot_token = args.bot_token
 
@@ -93,25 +126,43 @@ def main():
         password=args.terminal_password,
         enable=args.terminal_enable)
 
-    PreparedTask.netbox_factory = netbox_session_factory(args.netbox_url,
-                                                         args.netbox_token)
+    PreparedTask.netbox_factory = resources.netbox_factory
 
-    PreparedTask.userside_api = UsersideAPI(args.userside_url,
-                                            args.userside_key)
+    PreparedTask.userside_api = resources.userside_api
 
     PreparedTask.ftp_factory = FtpFactory(args.ftp_host, args.ftp_username,
                                           args.ftp_password)
 
     PreparedTask.ftp_base_folder = args.ftp_tftp_folder
     PreparedTask.ftp_full_config_folder = args.ftp_configs_full_path
+    PreparedTask.tftp_server = args.ftp_host
 
-    RemoteFileModifyTask.server_ssh_factory = ServerTerminalFactory(
+    PreparedTask.tftp_watcher = TftpLogWatcher(PreparedTask.ftp_factory,
+                                               TFTP_LOG_FILENAME,
+                                               poll_interval=CHECK_DELAY)
+
+    OfficeDhcpTask.server_ssh_factory = ServerTerminalFactory(
         ip_address=args.office_dhcp_host,
         username=args.office_dhcp_username,
         password=args.office_dhcp_password
     )
-    RemoteFileModifyTask.remote_filename = args.office_dhcp_filename
+    OfficeDhcpTask.remote_filename = args.office_dhcp_filename
+    OfficeDhcpTask.flush_delay = args.office_dhcp_flush_delay
+    OfficeDhcpTask.batch_size = args.office_dhcp_batch_size
+    return app, args, resources
+
 
+def shutdown(resources: WorkerResources):
+    resources.shutdown()
+    OfficeDhcpTask.server_ssh_factory.close()
+
+
+def main():
+    app, args, resources = prepare_worker()
+    worker_process_init.connect(lambda **kwargs: resources.startup(),
+                                weak=False)
+    worker_process_shutdown.connect(lambda **kwargs: shutdown(resources),
+                                    weak=False)
     app.start(argv=['worker',
                     '--loglevel=debug',
                     '-E',
@@ -121,6 +172,26 @@ def main():
                     ])
 
 
+def runner():
+    """
+    Single process worker: all coroutines share one event loop
+    """
+    app, args, resources = prepare_worker()
+    worker_init.connect(lambda **kwargs: resources.startup(threaded=True),
+                        weak=False)
+    worker_shutdown.connect(lambda **kwargs: shutdown(resources),
+                            weak=False)
+    # --pool accepts only built-in pool names,
+    # default one is replaced with configured pool
+    app.conf.worker_pool = 'ztp2.celery.pool:AsyncioTaskPool'
+    app.start(argv=['worker',
+                    '--loglevel=debug',
+                    '-E',
+                    f'-n {args.celery_hostname}',
+                    f'--concurrency={args.max_in_flight}'
+                    ])
+
+
 def flower():
     group = parser.add_argument_group('Celery')
     group.add_argument('--celery-broker', help='Broker URL', required=True)
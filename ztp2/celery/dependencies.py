@@ -1,22 +1,130 @@
 import aiogram
 import aiohttp
+import asyncio
+import logging
+import threading
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 
+from .progress import ProgressDispatcher
+from ..remote_apis.userside import UsersideAPI
 
-def sessionmaker_factory(database_url):
-    def inner(*args):
-        engine = create_async_engine(database_url)
-        ztp_session_factory = async_sessionmaker(engine,
-                                                 expire_on_commit=False,
-                                                 class_=AsyncSession)
-        return ztp_session_factory
-    return inner
 
+class SharedSession:
+    """
+    Keeps `async with factory() as session` usage,
+    but doesn't close shared session on exit
+    """
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
 
-def netbox_session_factory(url: str, token: str):
-    def inner(*args):
-        headers = {'Authorization': f'Token {token}'}
-        return aiohttp.ClientSession(url, headers=headers)
-    return inner
+    async def __aenter__(self):
+        return self.session
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class WorkerResources:
+    """
+    Event loop and client pools owned by one worker process.
+    Must be started after fork, so every child gets its own connections.
+    """
+    def __init__(self, database_url: str,
+                 netbox_url: str,
+                 netbox_token: str,
+                 bot_token: str,
+                 userside_api: UsersideAPI,
+                 pool_size: int = 5,
+                 http_limit: int = 20):
+        self.database_url = database_url
+        self.netbox_url = netbox_url
+        self.netbox_token = netbox_token
+        self.bot_token = bot_token
+        self.userside_api = userside_api
+        self.pool_size = pool_size
+        self.http_limit = http_limit
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.threaded = False
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self.engine: AsyncEngine | None = None
+        self.sessionmaker: async_sessionmaker | None = None
+        self.netbox: aiohttp.ClientSession | None = None
+        self.bot: aiogram.Bot | None = None
+        self.progress: ProgressDispatcher | None = None
+
+    @property
+    def started(self) -> bool:
+        return self.loop is not None
+
+    def startup(self, threaded: bool = False):
+        """
+        In threaded mode loop runs forever in its own thread
+        and tasks submit coroutines to it from pool threads
+        """
+        with self._lock:
+            if self.started:
+                return
+            self._startup(threaded)
+
+    def _startup(self, threaded: bool):
+        self.loop = asyncio.new_event_loop()
+        self.threaded = threaded
+        if threaded:
+            self._thread = threading.Thread(target=self.loop.run_forever,
+                                            name='ztp-loop', daemon=True)
+            self._thread.start()
+        else:
+            asyncio.set_event_loop(self.loop)
+        self.engine = create_async_engine(self.database_url,
+                                          pool_size=self.pool_size,
+                                          max_overflow=self.pool_size,
+                                          pool_pre_ping=True)
+        self.sessionmaker = async_sessionmaker(self.engine,
+                                               expire_on_commit=False,
+                                               class_=AsyncSession)
+        self.run(self._open_sessions())
+
+    async def _open_sessions(self):
+        headers = {'Authorization': f'Token {self.netbox_token}'}
+        connector = aiohttp.TCPConnector(limit=self.http_limit)
+        self.netbox = aiohttp.ClientSession(self.netbox_url, headers=headers,
+                                            connector=connector)
+        self.bot = aiogram.Bot(self.bot_token)
+        self.progress = ProgressDispatcher(self.bot)
+
+    def run(self, coroutine):
+        if self.threaded:
+            return asyncio.run_coroutine_threadsafe(coroutine,
+                                                    self.loop).result()
+        return self.loop.run_until_complete(coroutine)
+
+    def shutdown(self):
+        with self._lock:
+            if not self.started:
+                return
+            self.run(self._close_sessions())
+            if self.threaded:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join()
+            self.loop.close()
+            self.loop = None
+
+    async def _close_sessions(self):
+        await self.userside_api.close()
+        await self.progress.flush()
+        await self.progress.close()
+        logging.info('Progress dispatcher counters: %s',
+                     dict(self.progress.counters))
+        await self.bot.session.close()
+        await self.netbox.close()
+        await self.engine.dispose()
+
+    def sessionmaker_factory(self, *args):
+        return self.sessionmaker
+
+    def netbox_factory(self, *args):
+        return SharedSession(self.netbox)
@@ -0,0 +1,326 @@
+import aiohttp
+import aiosnmp.exceptions
+import time
+from sqlalchemy import select, update, type_coerce, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from typing import Callable
+
+from .progress import Progresser
+from ..db.models.ztp import Entry
+from ..remote_apis.snmp import DeviceSNMP
+from ..remote_apis.terminal import DeviceTerminal
+from ..utils.netbox import get_prefix_info
+from ..utils.ping import check
+from ..utils.tftp import TftpLogWatcher
+from ..utils.ztp import CiscoInterface, DlinkInterface
+
+SNMP_DEVICE_PATTERNS = ['DES-', 'DGS-12', 'DGS-30', 'Extreme']
+CISCO_DEVICE_PATTERNS = ['Cisco']
+ALL_DEVICE_PATTERNS = SNMP_DEVICE_PATTERNS + CISCO_DEVICE_PATTERNS
+
+CHECK_DELAY = 5
+DEVICE_DHCP_DELAY = 5
+HUMAN_CONFIGURE_KNOWN_PORT_TIME = 60
+HUMAN_FIND_AND_CONFIGURE_PORT_TIME = 90
+DLINK_FIRMWARE_UPDATE_TIME = 195
+
+UPLINK_CONFIGURED_EVENT = 'uplink_configured'
+
+
+class ZTPState:
+    START = 'START'
+    UPLINK_PROBE = 'UPLINK_PROBE'
+    WAIT_HUMAN = 'WAIT_HUMAN'
+    WAIT_PING = 'WAIT_PING'
+    WAIT_FIRMWARE = 'WAIT_FIRMWARE'
+    WAIT_CONFIG = 'WAIT_CONFIG'
+    UPLINK_RESTORE = 'UPLINK_RESTORE'
+    WAIT_REBOOT = 'WAIT_REBOOT'
+    DONE = 'DONE'
+
+
+async def save_state(sessionmaker: async_sessionmaker, ztp_id: int,
+                     state: str, context: dict, replace: bool = False):
+    """
+    Context is merged into the stored one, so events written by other tasks
+    in the meantime (see record_event) are not overwritten
+    """
+    context = {key: value for key, value in context.items()
+               if key != 'events'}
+    if replace:
+        new_context = type_coerce(context, JSONB)
+    else:
+        new_context = Entry.ztp_context.op('||')(type_coerce(context, JSONB))
+    statement = update(Entry).where(Entry.id == ztp_id)
+    statement = statement.values(ztp_state=state, ztp_context=new_context)
+    async with sessionmaker() as session:
+        await session.execute(statement)
+        await session.commit()
+
+
+async def record_event(sessionmaker: async_sessionmaker, ztp_id: int,
+                       event: str):
+    """
+    Merged into stored events by database itself: no read-modify-write,
+    so concurrent steps and events of the entry don't lose each other
+    """
+    events = func.coalesce(Entry.ztp_context['events'],
+                           type_coerce({}, JSONB))
+    events = events.op('||')(type_coerce({event: time.time()}, JSONB))
+    new_context = Entry.ztp_context.op('||')(
+        func.jsonb_build_object('events', events))
+    statement = update(Entry).where(Entry.id == ztp_id)
+    statement = statement.where(Entry.ztp_context.isnot(None))
+    statement = statement.values(ztp_context=new_context)
+    async with sessionmaker() as session:
+        await session.execute(statement)
+        await session.commit()
+
+
+class ZTPStateMachine:
+    """
+    ZTP pipeline split into short steps.
+    Every step returns next state and delay before it should be run,
+    so the caller can reschedule itself instead of sleeping.
+    """
+    def __init__(self,
+                 sessionmaker: async_sessionmaker,
+                 snmp: DeviceSNMP,
+                 terminal: DeviceTerminal,
+                 netbox_factory: Callable[[], aiohttp.ClientSession],
+                 bot_token: str,
+                 tftp_watcher: TftpLogWatcher):
+        self.sessionmaker = sessionmaker
+        self.snmp = snmp
+        self.terminal = terminal
+        self.netbox_factory = netbox_factory
+        self.bot_token = bot_token
+        self.tftp_watcher = tftp_watcher
+
+    async def start(self, ztp_id: int, *chat_ids: int):
+        progresser = Progresser(self.bot_token, *chat_ids)
+        progresser.startup()
+        await progresser.greet(f'Свич {ztp_id}')
+        context = {'progress': progresser.dump(), 'started_at': time.time()}
+        await progresser.shutdown()
+        await save_state(self.sessionmaker, ztp_id, ZTPState.START, context,
+                         replace=True)
+
+    async def run(self, ztp_id: int) -> float | None:
+        """
+        Runs steps until one of them has to wait.
+        Returns countdown for next run or None if ZTP is over
+        """
+        async with self.sessionmaker() as session:
+            statement = select(Entry).where(Entry.id == ztp_id)
+            response = await session.execute(statement)
+            entry = response.scalars().first()
+        if entry is None or entry.ztp_state in (None, ZTPState.DONE):
+            return None
+        state = entry.ztp_state
+        context = dict(entry.ztp_context)
+        progresser = Progresser.load(self.bot_token, context['progress'])
+        progresser.startup()
+        try:
+            countdown = 0
+            while state != ZTPState.DONE and not countdown:
+                handler = getattr(self, 'step_' + state.lower())
+                state, countdown = await handler(entry, context, progresser)
+        except BaseException:
+            # Failed step stops the pipeline
+            self.tftp_watcher.forget(entry.ip_address.exploded)
+            raise
+        finally:
+            context['progress'] = progresser.dump()
+            await save_state(self.sessionmaker, ztp_id, state, context)
+            await progresser.shutdown()
+        if state == ZTPState.DONE:
+            self.tftp_watcher.forget(entry.ip_address.exploded)
+            return None
+        return countdown
+
+    @staticmethod
+    async def wait_human(context: dict, progresser: Progresser,
+                         step_text: str, alert_text: str, timeout: float,
+                         next_state: str):
+        await progresser.send_step(step_text)
+        await progresser.alert(alert_text)
+        context['human'] = {'since': time.time(),
+                            'deadline': time.time() + timeout,
+                            'next': next_state}
+        return ZTPState.WAIT_HUMAN, min(CHECK_DELAY, timeout)
+
+    def uplink_interface(self, entry: Entry, context: dict):
+        model = context['parent_model']
+        if any(pattern in model for pattern in SNMP_DEVICE_PATTERNS):
+            uplink_interface = DlinkInterface(
+                entry.parent_switch.exploded,
+                entry.parent_port,
+                context['management_vlan_id'],
+                self.snmp
+            )
+        else:  # pattern in model for pattern in CISCO_DEVICE_PATTERNS
+            uplink_interface = CiscoInterface(
+                entry.parent_switch.exploded,
+                entry.parent_port,
+                context['management_vlan_id'],
+                self.terminal(entry.parent_switch.exploded,
+                              'AsyncIOSXEDriver',
+                              transport='asynctelnet')
+            )
+        uplink_interface.untagged = context.get('untagged')
+        return uplink_interface
+
+    async def step_start(self, entry: Entry, context: dict,
+                         progresser: Progresser):
+        progresser.update_done(f'Бот посмотрел данные свича '
+                               f'{entry.ip_address}')
+        async with self.netbox_factory() as session:
+            answer = await get_prefix_info(entry.ip_address.exploded, session)
+        context['management_vlan_id'] = answer['vlan']['vid']
+        progresser.update_done(f'Бот определил тег менеджмент влана: '
+                               f'{context["management_vlan_id"]}')
+        if entry.autochange_vlans:
+            return ZTPState.UPLINK_PROBE, 0
+        return await self.wait_human(
+            context, progresser, 'Человек ищет и настраивает аплинк',
+            '@nekone найди и настрой, ага?',
+            HUMAN_FIND_AND_CONFIGURE_PORT_TIME, ZTPState.WAIT_PING)
+
+    async def step_uplink_probe(self, entry: Entry, context: dict,
+                                progresser: Progresser):
+        context['manual_vlan_change'] = False
+        await progresser.send_step(f'Бот смотрит модель вышестоящего '
+                                   f'{entry.parent_switch}')
+        alert_text = f'@nekone подорвись и настрой ' \
+                     f'{entry.parent_switch} : {entry.parent_port}'
+        try:
+            async with self.snmp(entry.parent_switch.exploded) as session:
+                response = await session.get('1.3.6.1.2.1.1.1.0')
+        except aiosnmp.exceptions.SnmpTimeoutError:
+            context['manual_vlan_change'] = True
+            progresser.update_done(f'Бот не смог узнать модель вышестоящего '
+                                   f'{entry.parent_switch}')
+            return await self.wait_human(
+                context, progresser, 'Человек настраивает аплинк', alert_text,
+                HUMAN_CONFIGURE_KNOWN_PORT_TIME, ZTPState.WAIT_PING)
+        model = response[0].value.decode('utf-8')
+        context['parent_model'] = model
+        progresser.update_done(f'Бот узнал модель вышестоящего '
+                               f'{entry.parent_switch}: {model}')
+        if all(pattern not in model for pattern in ALL_DEVICE_PATTERNS):
+            context['manual_vlan_change'] = True
+            return await self.wait_human(
+                context, progresser, 'Человек настраивает аплинк', alert_text,
+                HUMAN_CONFIGURE_KNOWN_PORT_TIME, ZTPState.WAIT_PING)
+        await progresser.send_step(f'Бот смотрит антаги на '
+                                   f'{entry.parent_switch} : '
+                                   f'{entry.parent_port}')
+        uplink_interface = self.uplink_interface(entry, context)
+        async with uplink_interface:
+            untagged = await uplink_interface.get_untagged()
+        context['untagged'] = untagged
+        if isinstance(untagged, list):
+            untagged_text = ', '.join(map(str, untagged))
+        else:
+            untagged_text = untagged
+        if not untagged_text:
+            untagged_text = 'их нет'
+        progresser.update_done(f'Бот посмотрел антаги на '
+                               f'{entry.parent_switch} : '
+                               f'{entry.parent_port} '
+                               f'[{untagged_text}]')
+        await progresser.send_step('Бот перенастраивает вышестоящий')
+        async with uplink_interface:
+            await uplink_interface.switch_to_management()
+        progresser.update_done('Бот перенастроил вышестоящий')
+        await progresser.send_step('Свич получает IP и опции по DHCP')
+        return ZTPState.WAIT_PING, 0
+
+    async def step_wait_human(self, entry: Entry, context: dict,
+                              progresser: Progresser):
+        human = context['human']
+        done_at = context.get('events', {}).get(UPLINK_CONFIGURED_EVENT, 0)
+        now = time.time()
+        if done_at < human['since'] and now < human['deadline']:
+            return ZTPState.WAIT_HUMAN, min(CHECK_DELAY,
+                                            human['deadline'] - now)
+        if done_at >= human['since']:
+            progresser.update_done('Человек настроил аплинк')
+        else:
+            progresser.update_done('Человек нашел и настроил аплинк '
+                                   '(скорее всего)')
+        if human['next'] == ZTPState.WAIT_PING:
+            await progresser.send_step('Свич получает IP и опции по DHCP')
+        elif not context.get('ztp_froze'):
+            await progresser.send_step('Свич ребутается после скачивания '
+                                       'конфига')
+        return human['next'], 0
+
+    async def step_wait_ping(self, entry: Entry, context: dict,
+                             progresser: Progresser):
+        if not await check(entry.ip_address.exploded):
+            return ZTPState.WAIT_PING, CHECK_DELAY
+        progresser.update_done('Свич начал пинговаться')
+        await progresser.send_step('Свич запрашивает прошивку')
+        return ZTPState.WAIT_FIRMWARE, DEVICE_DHCP_DELAY
+
+    async def step_wait_firmware(self, entry: Entry, context: dict,
+                                 progresser: Progresser):
+        await self.tftp_watcher.poll()
+        if not self.tftp_watcher.requested(entry.ip_address.exploded,
+                                           'firmwares'):
+            return ZTPState.WAIT_FIRMWARE, CHECK_DELAY
+        progresser.update_done('Свич запросил прошивку')
+        await progresser.send_step('Свич качает прошивку и шьётся')
+        context['ztp_froze'] = False
+        return ZTPState.WAIT_CONFIG, DLINK_FIRMWARE_UPDATE_TIME
+
+    async def step_wait_config(self, entry: Entry, context: dict,
+                               progresser: Progresser):
+        await self.tftp_watcher.poll()
+        if not self.tftp_watcher.requested(entry.ip_address.exploded,
+                                           'configs'):
+            if not context['ztp_froze']:
+                await progresser.send_step('Свич завис, надо зайти и выйти')
+                context['ztp_froze'] = True
+            return ZTPState.WAIT_CONFIG, CHECK_DELAY
+        if context['ztp_froze']:
+            progresser.update_done('Свич скачал прошивку, прошился, '
+                                   'скачал конфиг и ребутнулся')
+        else:
+            progresser.update_done('Свич скачал прошивку, прошился, '
+                                   'и скачал конфиг ')
+        return ZTPState.UPLINK_RESTORE, 0
+
+    async def step_uplink_restore(self, entry: Entry, context: dict,
+                                  progresser: Progresser):
+        if not entry.autochange_vlans:
+            return await self.wait_human(
+                context, progresser, 'Человек ищет и настраивает аплинк',
+                '@nekone найди и настрой, ага?',
+                HUMAN_FIND_AND_CONFIGURE_PORT_TIME, ZTPState.WAIT_REBOOT)
+        if context['manual_vlan_change']:
+            return await self.wait_human(
+                context, progresser, 'Человек настраивает аплинк',
+                f'@nekone подорвись и настрой '
+                f'{entry.parent_switch} : {entry.parent_port}',
+                HUMAN_CONFIGURE_KNOWN_PORT_TIME, ZTPState.WAIT_REBOOT)
+        await progresser.send_step('Бот перенастраивает вышестоящий')
+        uplink_interface = self.uplink_interface(entry, context)
+        async with uplink_interface:
+            await uplink_interface.switch_back()
+        progresser.update_done('Бот перенастроил вышестоящий')
+        if not context['ztp_froze']:
+            await progresser.send_step('Свич ребутается после скачивания '
+                                       'конфига')
+        return ZTPState.WAIT_REBOOT, 0
+
+    async def step_wait_reboot(self, entry: Entry, context: dict,
+                               progresser: Progresser):
+        if not await check(entry.ip_address.exploded):
+            return ZTPState.WAIT_REBOOT, CHECK_DELAY
+        progresser.update_done('Свич начал пинговаться')
+        await progresser.finish('Готово')
+        return ZTPState.DONE, 0
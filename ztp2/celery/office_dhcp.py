@@ -0,0 +1,141 @@
+"""
+Office DHCP changes are queued in database and applied in batches
+by the worker holding advisory lock, one reload serves whole batch.
+Failed batch stays queued and is retried with backoff keeping order,
+changes failed too many times are dropped and employees are notified
+"""
+import asyncio
+import datetime
+import logging
+from sqlalchemy import select, update, insert, func
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from typing import Callable
+
+from ..db.models.ztp import OfficeDhcpChange, Entry, User
+from ..utils.server import apply_changes
+
+# Any constant, same for every worker
+OFFICE_DHCP_LOCK_KEY = 0x0FF1CED
+OFFICE_DHCP_FLUSH_DELAY = 10
+OFFICE_DHCP_BATCH_SIZE = 50
+OFFICE_DHCP_BUSY_DELAY = 5
+OFFICE_DHCP_MAX_ATTEMPTS = 5
+OFFICE_DHCP_RETRY_BACKOFF = 30
+NOTIFY_TIMEOUT = 10
+
+PENDING = (OfficeDhcpChange.applied_at.is_(None)
+           & OfficeDhcpChange.error.is_(None))
+
+
+async def enqueue_changes(sessionmaker: async_sessionmaker,
+                          changes: list[tuple[str, dict]]) -> int:
+    """
+    Returns number of pending changes including new ones
+    """
+    async with sessionmaker() as session:
+        await session.execute(insert(OfficeDhcpChange),
+                              [{'action': action, 'payload': payload}
+                               for action, payload in changes])
+        pending = await session.scalar(
+            select(func.count()).select_from(OfficeDhcpChange).where(PENDING))
+        await session.commit()
+    return pending
+
+
+def _apply(ssh_factory: Callable, changes: list[tuple[str, dict]],
+           filename: str):
+    with ssh_factory() as ssh:
+        apply_changes(changes, filename, ssh)
+
+
+def retry_delay(attempts: int,
+                backoff: float = OFFICE_DHCP_RETRY_BACKOFF) -> float:
+    return backoff * 2 ** (attempts - 1)
+
+
+async def _notify_dropped(session, rows: list[OfficeDhcpChange],
+                          error: Exception, notify: Callable):
+    """
+    Tells employees of entries whose changes are dropped
+    """
+    entry_ids = {row.payload['entry_id'] for row in rows}
+    statement = select(Entry.id, User.telegram_id)
+    statement = statement.join(User, User.userside_id == Entry.employee_id)
+    statement = statement.where(Entry.id.in_(entry_ids))
+    response = await session.execute(statement)
+    futures = [notify(telegram_id,
+                      f'Не удалось изменить офисный DHCP для свича '
+                      f'{entry_id}: {error!r}')
+               for entry_id, telegram_id in response.all() if telegram_id]
+    if futures:
+        await asyncio.wait(futures, timeout=NOTIFY_TIMEOUT)
+
+
+async def flush_changes(sessionmaker: async_sessionmaker,
+                        ssh_factory: Callable,
+                        filename: str,
+                        batch_size: int = OFFICE_DHCP_BATCH_SIZE,
+                        max_attempts: int = OFFICE_DHCP_MAX_ATTEMPTS,
+                        notify: Callable | None = None) -> float | None:
+    """
+    Applies pending changes batch by batch.
+    Returns delay before next flush: if another worker is flushing
+    right now or a batch failed and waits for retry
+    """
+    while True:
+        async with sessionmaker() as session:
+            # Released with transaction, even if worker dies
+            locked = await session.scalar(
+                select(func.pg_try_advisory_xact_lock(OFFICE_DHCP_LOCK_KEY)))
+            if not locked:
+                return OFFICE_DHCP_BUSY_DELAY
+            statement = select(OfficeDhcpChange).where(PENDING)
+            statement = statement.order_by(OfficeDhcpChange.id)
+            statement = statement.limit(batch_size)
+            response = await session.execute(statement)
+            rows = response.scalars().all()
+            if not rows:
+                return None
+            if rows[0].retry_at is not None:
+                # Newer changes wait too, they may depend on failed ones
+                now = await session.scalar(select(func.localtimestamp()))
+                if rows[0].retry_at > now:
+                    return (rows[0].retry_at - now).total_seconds()
+            changes = [(row.action, row.payload) for row in rows]
+            try:
+                # SSH session is blocking, event loop stays free meanwhile
+                await asyncio.to_thread(_apply, ssh_factory, changes,
+                                        filename)
+            except Exception as exc:
+                logging.error(f'Office DHCP batch of {len(rows)} '
+                              f'changes failed: {exc!r}')
+                dropped = []
+                for row in rows:
+                    row.attempts += 1
+                    if row.attempts >= max_attempts:
+                        row.error = repr(exc)
+                        dropped.append(row)
+                    else:
+                        row.retry_at = func.now() + datetime.timedelta(
+                            seconds=retry_delay(row.attempts))
+                await session.commit()
+                if dropped:
+                    logging.error(f'Office DHCP changes dropped after '
+                                  f'{max_attempts} attempts: '
+                                  f'{[row.id for row in dropped]}')
+                    if notify is not None:
+                        try:
+                            await _notify_dropped(session, dropped, exc,
+                                                  notify)
+                        except Exception as notify_exc:
+                            logging.error(f'Office DHCP drop notification '
+                                          f'failed: {notify_exc!r}')
+                if len(dropped) == len(rows):
+                    continue
+                return retry_delay(min(row.attempts for row in rows
+                                       if row.error is None))
+            statement = update(OfficeDhcpChange)
+            statement = statement.where(
+                OfficeDhcpChange.id.in_([row.id for row in rows]))
+            await session.execute(statement.values(applied_at=func.now()))
+            await session.commit()
@@ -0,0 +1,73 @@
+import concurrent.futures
+import threading
+from celery.concurrency.base import apply_target
+from celery.concurrency.thread import TaskPool as ThreadTaskPool, \
+    ApplyResult
+
+# Job run by the current pool thread
+_current = threading.local()
+
+
+class AsyncioJob:
+    """
+    Coroutine future of one task, cancelled when the task is terminated
+    """
+    def __init__(self):
+        self.future: concurrent.futures.Future | None = None
+        self.terminated = False
+
+    def attach(self, future: concurrent.futures.Future):
+        self.future = future
+        if self.terminated:
+            future.cancel()
+
+    def terminate(self):
+        self.terminated = True
+        if self.future is not None:
+            self.future.cancel()
+
+
+class AsyncioApplyResult(ApplyResult):
+    def __init__(self, future: concurrent.futures.Future, job: AsyncioJob):
+        super().__init__(future)
+        self.job = job
+
+    def terminate(self, signal=None):
+        self.job.terminate()
+
+
+def _run_job(job: AsyncioJob, *args):
+    _current.job = job
+    try:
+        return apply_target(*args)
+    finally:
+        _current.job = None
+
+
+def attach_coroutine(future: concurrent.futures.Future):
+    """
+    Called by task in pool thread for coroutine scheduled on the loop
+    """
+    job = getattr(_current, 'job', None)
+    if job is not None:
+        job.attach(future)
+
+
+class AsyncioTaskPool(ThreadTaskPool):
+    """
+    Pool for ztp-runner: threads only wait for coroutines scheduled on
+    the shared event loop of the process, so number of threads is the limit
+    of simultaneously running tasks.
+    revoke(terminate=True) cancels the coroutine of the task
+    """
+    def on_apply(self, target, args=None, kwargs=None, callback=None,
+                 accept_callback=None, **_):
+        job = AsyncioJob()
+        future = self.executor.submit(_run_job, job, target, args, kwargs,
+                                      callback, accept_callback)
+        return AsyncioApplyResult(future, job)
+
+    def terminate_job(self, pid, signal=None):
+        # All jobs share the process, they are terminated
+        # through their apply results instead
+        pass
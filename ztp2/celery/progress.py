@@ -1,20 +1,282 @@
 from aiogram import Bot
-from aiogram.exceptions import TelegramRetryAfter
+from aiogram.exceptions import TelegramRetryAfter, TelegramAPIError, \
+    TelegramNetworkError
+import asyncio
 from asyncio import sleep
+from collections import Counter, deque
+import itertools
+import logging
+import time
+
+from ..utils.cache import TTLCache
+
+TELEGRAM_GLOBAL_INTERVAL = 1 / 30
+TELEGRAM_PRIVATE_CHAT_INTERVAL = 1
+TELEGRAM_GROUP_CHAT_INTERVAL = 3
+FLUSH_TIMEOUT = 10
+# Last texts of messages, to skip edits changing nothing
+DELIVERED_MAXSIZE = 1024
+DELIVERED_TTL = 3600
+
+
+class ProgressDispatcher:
+    """
+    Delivers progress messages in background.
+    Edits of the same message are coalesced (latest text wins),
+    Telegram global and per-chat limits are respected.
+    edit() and send() return futures resolved once the text
+    (or a newer one of the same message) is delivered or dropped
+    """
+    def __init__(self, bot: Bot,
+                 global_interval: float = TELEGRAM_GLOBAL_INTERVAL,
+                 private_interval: float = TELEGRAM_PRIVATE_CHAT_INTERVAL,
+                 group_interval: float = TELEGRAM_GROUP_CHAT_INTERVAL):
+        self.bot = bot
+        self.global_interval = global_interval
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        # (chat_id, message_id) -> text
+        self.edits: dict[tuple[int, int], str] = {}
+        # (chat_id, message_id) -> futures waiting for delivery
+        self.edit_waiters: dict[tuple[int, int], list[asyncio.Future]] = {}
+        # (chat_id, message_id) -> queue position of the first pending edit
+        self.edit_order: dict[tuple[int, int], int] = {}
+        # (position, chat_id, text, reply_to_message_id, future)
+        self.messages: deque[tuple[int, int, str, int | None,
+                                   asyncio.Future]] = deque()
+        self._positions = itertools.count()
+        self.delivered = TTLCache(maxsize=DELIVERED_MAXSIZE,
+                                  ttl=DELIVERED_TTL)
+        self.next_allowed: dict[int, float] = {}
+        self.counters = Counter()
+        self._in_progress = 0
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(
+                self._deliver())
+        self._wakeup.set()
+
+    def edit(self, chat_id: int, message_id: int,
+             text: str) -> asyncio.Future:
+        key = (chat_id, message_id)
+        if key in self.edits:
+            self.counters['coalesced'] += 1
+        else:
+            self.edit_order[key] = next(self._positions)
+        self.edits[key] = text
+        future = asyncio.get_running_loop().create_future()
+        self.edit_waiters.setdefault(key, []).append(future)
+        self._ensure_started()
+        return future
+
+    def send(self, chat_id: int, text: str,
+             reply_to_message_id: int | None = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.messages.append((next(self._positions), chat_id, text,
+                              reply_to_message_id, future))
+        self._ensure_started()
+        return future
+
+    @staticmethod
+    def _resolve(futures: list[asyncio.Future]):
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+    def chat_interval(self, chat_id: int) -> float:
+        if chat_id < 0:
+            return self.group_interval
+        return self.private_interval
+
+    def _pick(self, now: float):
+        """
+        Oldest job of chats allowed to receive now,
+        so no task waits behind messages queued after its own
+        """
+        message = edit = None
+        for index, candidate in enumerate(self.messages):
+            if self.next_allowed.get(candidate[1], 0) <= now:
+                message = index, candidate
+                break
+        for key in self.edits:
+            if self.next_allowed.get(key[0], 0) <= now \
+                    and (edit is None
+                         or self.edit_order[key] < self.edit_order[edit]):
+                edit = key
+        if edit is not None and (message is None
+                                 or self.edit_order[edit] < message[1][0]):
+            text = self.edits.pop(edit)
+            del self.edit_order[edit]
+            return self._edit_message, (*edit, text)
+        if message is not None:
+            index, (_, *args) = message
+            del self.messages[index]
+            return self._send_message, tuple(args)
+        return None
+
+    def _time_to_next(self, now: float) -> float | None:
+        chats = {message[1] for message in self.messages}
+        chats |= {chat_id for chat_id, _ in self.edits}
+        if not chats:
+            return None
+        return max(0., min(self.next_allowed.get(chat_id, 0)
+                           for chat_id in chats) - now)
+
+    async def _deliver(self):
+        while True:
+            now = time.monotonic()
+            job = self._pick(now)
+            if job is None:
+                # Chats free to receive now need no entry
+                self.next_allowed = {chat_id: moment for chat_id, moment
+                                     in self.next_allowed.items()
+                                     if moment > now}
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           self._time_to_next(now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            method, args = job
+            self.next_allowed[args[0]] = now + self.chat_interval(args[0])
+            self._in_progress += 1
+            try:
+                await method(*args)
+            except Exception as exc:
+                # Delivery loop must survive, waiters must not hang
+                logging.error(f'Progress delivery to {args[0]} failed: '
+                              f'{exc!r}')
+                self.counters['dropped'] += 1
+                if method == self._send_message:
+                    self._resolve([args[-1]])
+                else:
+                    self._resolve_edit(args[:2])
+            finally:
+                self._in_progress -= 1
+            await sleep(self.global_interval)
+
+    async def _send_message(self, chat_id: int, text: str,
+                            reply_to: int | None, future: asyncio.Future):
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text,
+                                        reply_to_message_id=reply_to)
+        except (TelegramRetryAfter, TelegramNetworkError) as exc:
+            self._postpone(chat_id, exc)
+            self.messages.appendleft((-1, chat_id, text, reply_to, future))
+            return
+        except TelegramAPIError:
+            self.counters['dropped'] += 1
+        else:
+            self.counters['sent'] += 1
+        self._resolve([future])
+
+    async def _edit_message(self, chat_id: int, message_id: int, text: str):
+        key = (chat_id, message_id)
+        if self.delivered.get(key) == (True, text):
+            self.counters['coalesced'] += 1
+            self._resolve_edit(key)
+            return
+        try:
+            await self.bot.edit_message_text(text, chat_id, message_id)
+        except (TelegramRetryAfter, TelegramNetworkError) as exc:
+            self._postpone(chat_id, exc)
+            if key in self.edits:
+                # Newer text was queued meanwhile
+                self.counters['coalesced'] += 1
+            else:
+                self.edits[key] = text
+                self.edit_order[key] = -1
+            return
+        except TelegramAPIError:
+            self.counters['dropped'] += 1
+        else:
+            self.delivered.set(key, text)
+            self.counters['sent'] += 1
+        self._resolve_edit(key)
+
+    def _resolve_edit(self, key: tuple[int, int]):
+        # Newer text queued meanwhile keeps its waiters
+        if key not in self.edits:
+            self._resolve(self.edit_waiters.pop(key, []))
+
+    def _postpone(self, chat_id: int, exc: TelegramAPIError):
+        self.counters['retried'] += 1
+        retry_after = getattr(exc, 'retry_after', self.chat_interval(chat_id))
+        self.next_allowed[chat_id] = time.monotonic() + retry_after
+
+    @property
+    def idle(self) -> bool:
+        return not (self.edits or self.messages or self._in_progress)
+
+    async def flush(self, timeout: float = FLUSH_TIMEOUT):
+        """
+        Waits (limited time) until everything queued is delivered.
+        Undelivered messages stay in queue for the next run of the loop.
+        Meant for worker shutdown, tasks wait only for their own messages
+        """
+        deadline = time.monotonic() + timeout
+        while not self.idle and time.monotonic() < deadline:
+            await sleep(0.1)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
 
 
 class Progresser:
+    # Worker-wide dispatcher, its bot session is reused by every progresser
+    dispatcher: ProgressDispatcher | None = None
+
     def __init__(self, token: str, *args):
         self.token = token
         self.msg_ids = {chat_id: None for chat_id in args}
         self.bot: Bot | None = None
         self.done: str = ''
+        # Own messages queued in dispatcher
+        self.pending: set[asyncio.Future] = set()
+
+    @classmethod
+    def load(cls, token: str, state: dict):
+        progresser = cls(token)
+        progresser.msg_ids = {chat_id: message_id
+                              for chat_id, message_id in state['msg_ids']}
+        progresser.done = state['done']
+        return progresser
+
+    def dump(self) -> dict:
+        return {'msg_ids': [[chat_id, message_id]
+                            for chat_id, message_id in self.msg_ids.items()],
+                'done': self.done}
+
+    @property
+    def is_dispatched(self) -> bool:
+        return self.dispatcher is not None \
+            and self.dispatcher.bot.token == self.token
 
     def startup(self):
-        self.bot = Bot(self.token)
+        if self.is_dispatched:
+            self.bot = self.dispatcher.bot
+        else:
+            self.bot = Bot(self.token)
 
-    async def shutdown(self):
-        await self.bot.session.close()
+    async def shutdown(self, timeout: float = FLUSH_TIMEOUT):
+        """
+        Waits (limited time) for own messages only,
+        other tasks' traffic is left to the dispatcher
+        """
+        if self.is_dispatched:
+            if self.pending:
+                await asyncio.wait(self.pending, timeout=timeout)
+            self.pending = {future for future in self.pending
+                            if not future.done()}
+        else:
+            await self.bot.session.close()
 
     async def greet(self, greeting_text: str):
         self.done = greeting_text + '\n'
@@ -25,9 +287,12 @@ class Progresser:
     def update_done(self, done_step: str):
         self.done += '☒ ' + done_step + '\n'
 
-    async def send_step(self, current_step: str):
-        text = self.done + '☐ ' + current_step
+    async def _edit(self, text: str):
         for chat_id, message_id in self.msg_ids.items():
+            if self.is_dispatched:
+                self.pending.add(
+                    self.dispatcher.edit(chat_id, message_id, text))
+                continue
             while True:
                 try:
                     await self.bot.edit_message_text(text, chat_id, message_id)
@@ -35,19 +300,20 @@ class Progresser:
                 except TelegramRetryAfter as exc:
                     await sleep(exc.retry_after)
 
+    async def send_step(self, current_step: str):
+        await self._edit(self.done + '☐ ' + current_step)
+
     async def finish(self, goodbye_text: str):
         self.done += '☒ ' + goodbye_text
-        text = self.done
-        for chat_id, message_id in self.msg_ids.items():
-            while True:
-                try:
-                    await self.bot.edit_message_text(text, chat_id, message_id)
-                    break
-                except TelegramRetryAfter as exc:
-                    await sleep(exc.retry_after)
+        await self._edit(self.done)
 
     async def alert(self, alert_text):
         for chat_id, message_id in self.msg_ids.items():
             if chat_id < 0:
-                await self.bot.send_message(chat_id=chat_id, text=alert_text,
-                                            reply_to_message_id=message_id)
+                if self.is_dispatched:
+                    self.pending.add(
+                        self.dispatcher.send(chat_id, alert_text, message_id))
+                else:
+                    await self.bot.send_message(
+                        chat_id=chat_id, text=alert_text,
+                        reply_to_message_id=message_id)
@@ -1,39 +1,37 @@
 import aiohttp
-import aiosnmp.exceptions
 import asyncio
+import concurrent.futures
+import logging
 from celery import Task, current_app
-from multiprocessing import Lock
+from celery.exceptions import TaskRevokedError
+from celery.worker import state as worker_state
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from typing import Callable
 
+from ..dependencies import WorkerResources
+from ..machine import ZTPStateMachine, record_event
+from ..office_dhcp import enqueue_changes, flush_changes, \
+    OFFICE_DHCP_FLUSH_DELAY, OFFICE_DHCP_BATCH_SIZE
+from ..pool import attach_coroutine
 from ..progress import Progresser
 from ...db.models.ztp import Entry, Model
-from ...remote_apis.snmp import DeviceSNMP
 from ...remote_apis.terminal import DeviceTerminal
 from ...remote_apis.ftp import ContextedFTP
 from ...remote_apis.userside import UsersideAPI
-from ...utils.ftp import pattern_in_file_content, get_file_content
-from ...utils.netbox import get_prefix_info, mark_ip_active
-from ...utils.ztp import CiscoInterface, DlinkInterface
-from ...utils.server import create_entry, change_ip_address, change_mac_address
+from ...utils.ftp import get_file_content
+from ...utils.netbox import mark_ip_active
 from ...utils.sort_of_ping import check_port
 from ...utils.ping import check
-from ...utils.terminal import extract_dlink_serial
+from ...utils.terminal import extract_dlink_serial, dlink_download_config, \
+    dlink_send_config_lines
 from ...utils.userside import transfer_inventory_to_employee, \
     get_inventory_item, transfer_inventory_to_node, update_commutation, \
     update_up_down_link
 
-SNMP_DEVICE_PATTERNS = ['DES-', 'DGS-12', 'DGS-30', 'Extreme']
-CISCO_DEVICE_PATTERNS = ['Cisco']
-ALL_DEVICE_PATTERNS = SNMP_DEVICE_PATTERNS + CISCO_DEVICE_PATTERNS
-
-CHECK_DELAY = 5
-DEVICE_DHCP_DELAY = 5
-HUMAN_CONFIGURE_KNOWN_PORT_TIME = 60
-HUMAN_FIND_AND_CONFIGURE_PORT_TIME = 90
 TFTP_LOG_FILENAME = '/tftp/tftp.log'
-DLINK_FIRMWARE_UPDATE_TIME = 195
+REVOKE_CHECK_INTERVAL = 1
+
 
 def stub(*args, **kwargs):  # noqa
     raise NotImplementedError
@@ -49,236 +47,138 @@ class PreparedTask(Task):  # noqa
     ftp_factory = stub
     ftp_base_folder = stub
     ftp_full_config_folder = stub
+    tftp_watcher = stub
+    tftp_server = stub
+    resources: WorkerResources = stub
     loop: asyncio.BaseEventLoop | None = stub
 
     def before_start(self, task_id, args, kwargs):
-        PreparedTask.loop = asyncio.new_event_loop()
-
-    def after_return(self, status, retval, task_id, args, kwargs, einfo):
-        PreparedTask.loop.close()
-
-
-class RemoteFileModifyTask(Task):  # noqa
-    lock = Lock()
+        # Normally resources are started by worker_process_init signal
+        self.resources.startup()
+        PreparedTask.loop = self.resources.loop
+        Progresser.dispatcher = self.resources.progress
+
+    def run_coroutine(self, coroutine):
+        if not self.resources.threaded:
+            return self.loop.run_until_complete(coroutine)
+        # Pool thread only waits for coroutine running on shared loop
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        attach_coroutine(future)
+        while True:
+            try:
+                return future.result(timeout=REVOKE_CHECK_INTERVAL)
+            except concurrent.futures.CancelledError:
+                # Terminated through the pool
+                raise TaskRevokedError(self.request.id)
+            except concurrent.futures.TimeoutError:
+                if self.request.id in worker_state.revoked:
+                    future.cancel()
+                    raise TaskRevokedError(self.request.id)
+
+
+class OfficeDhcpTask(PreparedTask):  # noqa
     server_ssh_factory = stub
     remote_filename = stub
+    flush_delay = OFFICE_DHCP_FLUSH_DELAY
+    batch_size = OFFICE_DHCP_BATCH_SIZE
+
+    def enqueue(self, changes: list[tuple[str, dict]]):
+        pending = self.run_coroutine(
+            enqueue_changes(self.sessionmaker_factory(), changes))
+        # Changes coming in meanwhile are applied by the same flush
+        countdown = 0 if pending >= self.batch_size else self.flush_delay
+        flush_dhcp_office.apply_async(countdown=countdown)
 
-    def before_start(self, task_id, args, kwargs):
-        self.lock.acquire()
 
-    def after_return(self, status, retval, task_id, args, kwargs, einfo):
-        self.lock.release()
+def ztp_state_machine(task: PreparedTask) -> ZTPStateMachine:
+    return ZTPStateMachine(task.sessionmaker_factory(),
+                           task.snmp_factory,
+                           task.terminal_factory,
+                           task.netbox_factory,
+                           task.bot_token,
+                           task.tftp_watcher)
 
 
 @current_app.task(base=PreparedTask, name='ztp2_main', bind=True)
-def ztp(self, ztp_id: int, sender_chat_id: int):  # noqa
-    ztp.loop.run_until_complete(_ztp(ztp_id,
-                                     sender_chat_id,
-                                     ztp.sessionmaker_factory(),
-                                     ztp.snmp_factory,
-                                     ztp.terminal_factory,
-                                     ztp.netbox_factory,
-                                     ztp.bot_token,
-                                     ztp.ftp_factory))
-
-
-async def _ztp(ztp_id: int,
-               sender_chat_id: int,
-               sessionmaker: async_sessionmaker,
-               snmp: DeviceSNMP,
-               terminal: DeviceTerminal,
-               netbox_factory: Callable[[], aiohttp.ClientSession],
-               bot_token: str,
-               tftp_factory: Callable[[], ContextedFTP]):
-    progresser = Progresser(bot_token, sender_chat_id)
-    progresser.startup()
-    await progresser.greet(f'Свич {ztp_id}')
-    await progresser.send_step('Бот смотрит в базу')
-    async with sessionmaker() as session:
-        statement = select(Entry).where(Entry.id == ztp_id)
-        response = await session.execute(statement)
-        entry = response.scalars().first()
-    progresser.update_done(f'Бот посмотрел данные свича {entry.ip_address}')
-    async with netbox_factory() as session:
-        answer = await get_prefix_info(entry.ip_address.exploded,
-                                       session)
-    management_vlan_id = answer['vlan']['vid']
-    progresser.update_done(f'Бот определил тег менеджмент влана: '
-                           f'{management_vlan_id}')
-    if entry.autochange_vlans:
-        manual_vlan_change = False
-        await progresser.send_step(f'Бот смотрит модель вышестоящего '
-                                   f'{entry.parent_switch}')
-        try:
-            async with snmp(entry.parent_switch.exploded) as session:
-                response = await session.get('1.3.6.1.2.1.1.1.0')
-        except aiosnmp.exceptions.SnmpTimeoutError:
-            manual_vlan_change = True
-            progresser.update_done(f'Бот не смог узнать модель вышестоящего '
-                                   f'{entry.parent_switch}')
-            await progresser.send_step('Человек настраивает аплинк')
-            await progresser.alert(f'@nekone подорвись и настрой '
-                                   f'{entry.parent_switch} : '
-                                   f'{entry.parent_port}')
-            await asyncio.sleep(HUMAN_CONFIGURE_KNOWN_PORT_TIME)
-            progresser.update_done('Человек нашел и настроил аплинк '
-                                   '(скорее всего)')
-        else:
-            model = response[0].value.decode('utf-8')
-            progresser.update_done(f'Бот узнал модель вышестоящего '
-                                   f'{entry.parent_switch}: {model}')
-            if all(pattern not in model for pattern in ALL_DEVICE_PATTERNS):
-                manual_vlan_change = True
-                await progresser.send_step('Человек настраивает аплинк')
-                await progresser.alert(f'@nekone подорвись и настрой '
-                                       f'{entry.parent_switch} : '
-                                       f'{entry.parent_port}')
-                await asyncio.sleep(HUMAN_CONFIGURE_KNOWN_PORT_TIME)
-                progresser.update_done('Человек нашел и настроил аплинк '
-                                       '(скорее всего)')
-            else:
-                await progresser.send_step(f'Бот смотрит антаги на '
-                                           f'{entry.parent_switch} : '
-                                           f'{entry.parent_port}')
-                if any(pattern in model for pattern in SNMP_DEVICE_PATTERNS):
-                    uplink_interface = DlinkInterface(
-                        entry.parent_switch.exploded,
-                        entry.parent_port,
-                        management_vlan_id,
-                        snmp
-                    )
-                else:  # pattern in model for pattern in CISCO_DEVICE_PATTERNS
-                    uplink_interface = CiscoInterface(
-                        entry.parent_switch.exploded,
-                        entry.parent_port,
-                        management_vlan_id,
-                        terminal(entry.parent_switch.exploded,
-                                 'AsyncIOSXEDriver',
-                                 transport='asynctelnet')
-                    )
-                async with uplink_interface:
-                    untagged = await uplink_interface.get_untagged()
-                if isinstance(untagged, list):
-                    untagged_text = ', '.join(map(str, untagged))
-                else:
-                    untagged_text = untagged
-                if not untagged_text:
-                    untagged_text = 'их нет'
-                progresser.update_done(f'Бот посмотрел антаги на '
-                                       f'{entry.parent_switch} : '
-                                       f'{entry.parent_port} '
-                                       f'[{untagged_text}]')
-                await progresser.send_step('Бот перенастраивает вышестоящий')
-                async with uplink_interface:
-                    await uplink_interface.switch_to_management()
-                progresser.update_done('Бот перенастроил вышестоящий')
-    else:
-        await progresser.send_step('Человек ищет и настраивает аплинк')
-        await progresser.alert(f'@nekone найди и настрой, ага?')
-        await asyncio.sleep(HUMAN_FIND_AND_CONFIGURE_PORT_TIME)
-        progresser.update_done('Человек нашел и настроил аплинк (скорее всего)')
-
-    await progresser.send_step('Свич получает IP и опции по DHCP')
-    while not await check(entry.ip_address.exploded):
-        await asyncio.sleep(CHECK_DELAY)
-    progresser.update_done('Свич начал пинговаться')
-
-    await progresser.send_step('Свич запрашивает прошивку')
-    await asyncio.sleep(DEVICE_DHCP_DELAY)
-    firmware_requested_pattern = f'RRQ from {entry.ip_address.exploded} ' \
-                                 f'filename firmwares'
-    async with tftp_factory() as ftp_client:
-        while not await pattern_in_file_content(TFTP_LOG_FILENAME,
-                                                firmware_requested_pattern,
-                                                ftp_client):
-            await asyncio.sleep(CHECK_DELAY)
-    progresser.update_done('Свич запросил прошивку')
-
-    await progresser.send_step('Свич качает прошивку и шьётся')
-    await asyncio.sleep(DLINK_FIRMWARE_UPDATE_TIME)
-    ztp_froze = False
-    config_requested_pattern = f'RRQ from {entry.ip_address.exploded} ' \
-                               f'filename configs'
-    async with tftp_factory() as ftp_client:
-        if not await pattern_in_file_content(TFTP_LOG_FILENAME,
-                                             config_requested_pattern,
-                                             ftp_client):
-            await progresser.send_step('Свич завис, надо зайти и выйти')
-            ztp_froze = True
-            while not await pattern_in_file_content(TFTP_LOG_FILENAME,
-                                                    config_requested_pattern,
-                                                    ftp_client):
-                await asyncio.sleep(CHECK_DELAY)
-            progresser.update_done('Свич скачал прошивку, прошился, '
-                                   'скачал конфиг и ребутнулся')
-        else:
-            progresser.update_done('Свич скачал прошивку, прошился, '
-                                   'и скачал конфиг ')
-
-    if entry.autochange_vlans:
-        if manual_vlan_change:  # noqa
-            await progresser.send_step('Человек настраивает аплинк')
-            await progresser.alert(f'@nekone подорвись и настрой '
-                                   f'{entry.parent_switch} : '
-                                   f'{entry.parent_port}')
-            await asyncio.sleep(HUMAN_CONFIGURE_KNOWN_PORT_TIME)
-            progresser.update_done('Человек нашел и настроил аплинк '
-                                   '(скорее всего)')
-        else:
-            await progresser.send_step('Бот перенастраивает вышестоящий')
-            async with uplink_interface:  # noqa
-                await uplink_interface.switch_back()  # noqa
-            progresser.update_done('Бот перенастроил вышестоящий')
-    else:
-        await progresser.send_step('Человек ищет и настраивает аплинк')
-        await progresser.alert(f'@nekone найди и настрой, ага?')
-        await asyncio.sleep(HUMAN_FIND_AND_CONFIGURE_PORT_TIME)
-        progresser.update_done('Человек нашел и настроил аплинк (скорее всего)')
+def ztp(self, ztp_id: int, sender_chat_id: int, *additional_chat_ids: int):
+    machine = ztp_state_machine(self)
+    self.run_coroutine(machine.start(ztp_id, sender_chat_id,
+                                     *additional_chat_ids))
+    # Every step reuses ID of this task, so revoking it stops whole pipeline
+    ztp_step.apply_async((ztp_id,), task_id=self.request.id)
 
-    if not ztp_froze:
-        await progresser.send_step('Свич ребутается после скачивания конфига')
-    while not await check(entry.ip_address.exploded):
-        await asyncio.sleep(CHECK_DELAY)
-    progresser.update_done('Свич начал пинговаться')
 
-    await progresser.finish('Готово')
-    await progresser.shutdown()
+@current_app.task(base=PreparedTask, name='ztp2_step', bind=True,
+                  acks_late=True)
+def ztp_step(self, ztp_id: int):
+    machine = ztp_state_machine(self)
+    countdown = self.run_coroutine(machine.run(ztp_id))
+    if countdown is not None:
+        ztp_step.apply_async((ztp_id,), countdown=countdown,
+                             task_id=self.request.id)
 
 
-@current_app.task(base=RemoteFileModifyTask, name='ztp2_office_dhcp', bind=True)
+@current_app.task(base=PreparedTask, name='ztp2_event', bind=True)
+def ztp_event(self, ztp_id: int, event: str):
+    self.run_coroutine(record_event(self.sessionmaker_factory(),
+                                    ztp_id, event))
+
+
+@current_app.task(base=OfficeDhcpTask, name='ztp2_office_dhcp', bind=True)
 def create_dhcp_office_entry(self, entry_id: int, mac_address: str,
                              ftp_host: str, config_filename: str,
                              firmware_filename: str):
-    with self.server_ssh_factory() as session:
-        create_entry(entry_id, mac_address, ftp_host, config_filename,
-                     firmware_filename, self.remote_filename, session)
+    self.enqueue([('create', {'entry_id': entry_id,
+                              'mac_address': mac_address,
+                              'ftp_host': ftp_host,
+                              'config_filename': config_filename,
+                              'firmware_filename': firmware_filename})])
 
 
-@current_app.task(base=RemoteFileModifyTask,
-                  name='ztp2_office_dhcp_edit',
-                  bind=True)
+@current_app.task(base=OfficeDhcpTask, name='ztp2_office_dhcp_bulk', bind=True)
+def create_dhcp_office_entries(self, entries: list[dict]):
+    """
+    Entries are ztp2_office_dhcp kwargs
+    """
+    self.enqueue([('create', entry) for entry in entries])
+
+
+@current_app.task(base=OfficeDhcpTask, name='ztp2_office_dhcp_edit', bind=True)
 def edit_dhcp_office_entry(self, entry_id: int, field: str, value: str):
     if field not in ['ip_address', 'mac_address']:
         return
-    with self.server_ssh_factory() as session:
-        if field == 'ip_address':
-            change_ip_address(entry_id, value, self.remote_filename, session)
-        elif field == 'mac_address':
-            change_mac_address(entry_id, value, self.remote_filename, session)
+    self.enqueue([(field, {'entry_id': entry_id, 'value': value})])
+
+
+@current_app.task(base=OfficeDhcpTask, name='ztp2_office_dhcp_flush',
+                  bind=True)
+def flush_dhcp_office(self):
+    countdown = self.run_coroutine(flush_changes(
+        self.sessionmaker_factory(), self.server_ssh_factory,
+        self.remote_filename, self.batch_size,
+        notify=self.resources.progress.send))
+    logging.info('Office DHCP SSH pool: %s',
+                 self.server_ssh_factory.stats())
+    if countdown is not None:
+        # Other worker may have finished its last batch before our changes,
+        # or failed batch waits for retry
+        flush_dhcp_office.apply_async(countdown=countdown)
 
 
 @current_app.task(base=PreparedTask, name='ztp2_finalize', bind=True)
 def finalize(self, ztp_id: int, sender_chat_id: int):
     full_configs_path = self.ftp_base_folder + self.ftp_full_config_folder
-    self.loop.run_until_complete(_finalize(ztp_id,
-                                           sender_chat_id,
-                                           self.bot_token,
-                                           self.sessionmaker_factory(),
-                                           self.terminal_factory,
-                                           self.ftp_factory,
-                                           full_configs_path,
-                                           self.netbox_factory,
-                                           self.userside_api))
+    self.run_coroutine(_finalize(ztp_id,
+                                 sender_chat_id,
+                                 self.bot_token,
+                                 self.sessionmaker_factory(),
+                                 self.terminal_factory,
+                                 self.ftp_factory,
+                                 full_configs_path,
+                                 self.tftp_server,
+                                 self.ftp_full_config_folder,
+                                 self.netbox_factory,
+                                 self.userside_api))
 
 
 async def _finalize(ztp_id: int,
@@ -288,6 +188,8 @@ async def _finalize(ztp_id: int,
                     terminal_factory: DeviceTerminal,
                     ftp_factory: Callable[[], ContextedFTP],
                     configs_tftp_path: str,
+                    tftp_server: str,
+                    tftp_configs_path: str,
                     netbox_factory: Callable[[], aiohttp.ClientSession],
                     userside_api: UsersideAPI):
     # Получить информацию о свиче
@@ -331,22 +233,28 @@ async def _finalize(ztp_id: int,
     line_count = len(cfg)
     progresser.update_done(f'Получен конфиг из {line_count} строк')
 
-    # Отправить конфиг построчно
-    await progresser.send_step('Отправляем конфиг на свич')
+    # Отправить конфиг: свич сам скачивает его по TFTP
+    await progresser.send_step('Свич скачивает конфиг')
     session = terminal_factory(entry.ip_address.exploded, 'dlink_os')
     async with session:
-        alert_chunks = 5
-        threshold = line_count // alert_chunks
-        percents = 100 // alert_chunks
-        multiplier = 1
-        for index, line in enumerate(cfg):
-            if index > threshold * multiplier:
-                percents_done = percents * multiplier
+        errors = await dlink_download_config(
+            session, tftp_server,
+            tftp_configs_path + entry.ip_address.exploded + '.cfg')
+        if errors is None:
+            # Старая прошивка, отправляем построчно
+            async def report(percents_done: int):
                 await progresser.send_step('Отправляем конфиг на свич '
                                            f'(отправлено {percents_done}%)')
-                multiplier += 1
-            await session.send_command(line)
-    progresser.update_done('Отправили конфиг на свич')
+            await progresser.send_step('Отправляем конфиг на свич')
+            errors = await dlink_send_config_lines(session, cfg, report)
+    if errors:
+        progresser.update_done(f'Отправили конфиг на свич, ошибок: '
+                               f'{len(errors)}')
+        errors_text = '\n'.join(errors[:20])
+        await progresser.alert(f'Ошибки при заливке конфига '
+                               f'{entry.ip_address}:\n{errors_text}')
+    else:
+        progresser.update_done('Отправили конфиг на свич')
 
     # Проверить что свич пингуется после заливки конфига
     await progresser.send_step('Проверяем, что свич пингуется')
@@ -430,7 +338,7 @@ async def _finalize(ztp_id: int,
         if old_switch_present:
             # Восстановить коммутацию
             await progresser.send_step('Восстанавливаем аплинки/даунлинки')
-            await update_up_down_link(
+            failed = await update_up_down_link(
                 old_uplink=old_switch_data['uplink_iface'],
                 old_downlinks=old_switch_data['dnlink_iface'],
                 movements=entry.port_movements,
@@ -439,11 +347,18 @@ async def _finalize(ztp_id: int,
             progresser.update_done('Восстановили аплинки/даунлинки')
 
             await progresser.send_step('Восстанавливаем коммутацию')
-            await update_commutation(old_commutation=old_switch_commutation,
-                                     movements=entry.port_movements,
-                                     device_id=new_device_id,
-                                     userside_api=userside_api)
+            failed += await update_commutation(
+                old_commutation=old_switch_commutation,
+                movements=entry.port_movements,
+                device_id=new_device_id,
+                userside_api=userside_api)
             progresser.update_done('Восстановили коммутацию')
+            if failed:
+                failed_text = '\n'.join(f'{description}: {error}'
+                                        for description, error in failed)
+                await progresser.alert(
+                    f'Не удалось восстановить ({len(failed)}):\n'
+                    f'{failed_text}')
 
     await progresser.finish('Готово')
     await progresser.shutdown()
@@ -0,0 +1,27 @@
+"""ZTP state columns
+
+Revision ID: 3c5a91d0e7b2
+Revises: 6082b26db63d
+Create Date: 2026-10-18 10:12:41.531204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5a91d0e7b2'
+down_revision = '6082b26db63d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('entries', sa.Column('ztp_state', sa.String(), nullable=True))
+    op.add_column('entries', sa.Column('ztp_context', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('entries', 'ztp_context')
+    op.drop_column('entries', 'ztp_state')
@@ -0,0 +1,34 @@
+"""Entries lookup indexes
+
+Revision ID: 5f7c2e9b4d16
+Revises: 8d2f4b6e1a93
+Create Date: 2026-10-18 16:02:41.530217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f7c2e9b4d16'
+down_revision = '8d2f4b6e1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_entries_employee_status_id', 'entries', ['employee_id', 'status', sa.text('id DESC')], unique=False)
+    op.create_index('ix_entries_status_id', 'entries', ['status', sa.text('id DESC')], unique=False)
+    op.create_index('ix_entries_task_id', 'entries', ['task_id'], unique=False)
+    op.create_index('ix_entries_serial_number', 'entries', ['serial_number'], unique=False)
+    op.create_index('ix_entries_mac_address', 'entries', ['mac_address'], unique=False)
+    op.create_index('ix_entries_ip_address', 'entries', ['ip_address'], unique=False, postgresql_ops={'ip_address': 'inet_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_entries_ip_address', table_name='entries')
+    op.drop_index('ix_entries_mac_address', table_name='entries')
+    op.drop_index('ix_entries_serial_number', table_name='entries')
+    op.drop_index('ix_entries_task_id', table_name='entries')
+    op.drop_index('ix_entries_status_id', table_name='entries')
+    op.drop_index('ix_entries_employee_status_id', table_name='entries')
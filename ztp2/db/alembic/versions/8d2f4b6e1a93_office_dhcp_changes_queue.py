@@ -0,0 +1,36 @@
+"""Office DHCP changes queue
+
+Revision ID: 8d2f4b6e1a93
+Revises: 3c5a91d0e7b2
+Create Date: 2026-10-18 14:37:05.118342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4b6e1a93'
+down_revision = '3c5a91d0e7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'office_dhcp_changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+        sa.Column('action', sa.String(), nullable=False),
+        sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('applied_at', sa.DateTime(), nullable=True),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_office_dhcp_changes_pending', 'office_dhcp_changes', ['id'], unique=False, postgresql_where=sa.text('applied_at IS NULL AND error IS NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_office_dhcp_changes_pending', table_name='office_dhcp_changes')
+    op.drop_table('office_dhcp_changes')
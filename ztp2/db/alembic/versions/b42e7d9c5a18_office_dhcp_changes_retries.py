@@ -0,0 +1,26 @@
+"""Office DHCP changes retries
+
+Revision ID: b42e7d9c5a18
+Revises: 5f7c2e9b4d16
+Create Date: 2026-10-18 19:12:27.804519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b42e7d9c5a18'
+down_revision = '5f7c2e9b4d16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('office_dhcp_changes', sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('office_dhcp_changes', sa.Column('retry_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('office_dhcp_changes', 'retry_at')
+    op.drop_column('office_dhcp_changes', 'attempts')
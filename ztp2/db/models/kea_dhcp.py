@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Boolean
+from sqlalchemy import Column, Integer, Boolean, DateTime
 from sqlalchemy.dialects.postgresql import BYTEA, TEXT, SMALLINT, BIGINT, \
     VARCHAR
 
@@ -39,3 +39,10 @@ class DHCPOption(KeaBase):
     host_id = Column('host_id', Integer)
     scope_id = Column('scope_id', SMALLINT, nullable=False)
     user_context = Column('user_context', TEXT)
+
+
+class DHCP4Subnet(KeaBase):
+    __tablename__ = 'dhcp4_subnet'
+    subnet_id = Column('subnet_id', BIGINT, primary_key=True, nullable=False)
+    subnet_prefix = Column('subnet_prefix', VARCHAR(64), nullable=False)
+    modification_ts = Column('modification_ts', DateTime, nullable=False)
@@ -5,7 +5,8 @@ from sqlalchemy import (
     Boolean,
     ForeignKey,
     Enum,
-    DateTime
+    DateTime,
+    Index
 )
 from sqlalchemy.dialects.postgresql import INET, JSONB, MACADDR, BIGINT
 from sqlalchemy.orm import relationship
@@ -47,7 +48,19 @@ class Entry(ZTPBase):
     modified_port_settings = Column('modified_port_settings', JSONB, nullable=True)
     vlan_settings = Column('vlan_settings', JSONB, nullable=True)
     modified_vlan_settings = Column('modified_vlan_settings', JSONB, nullable=True)
+    ztp_state = Column('ztp_state', String, nullable=True)
+    ztp_context = Column('ztp_context', JSONB, nullable=True)
     __mapper_args__ = {"eager_defaults": True}
+    __table_args__ = (
+        Index('ix_entries_employee_status_id', 'employee_id', 'status',
+              id.desc()),
+        Index('ix_entries_status_id', 'status', id.desc()),
+        Index('ix_entries_task_id', 'task_id'),
+        Index('ix_entries_serial_number', 'serial_number'),
+        Index('ix_entries_mac_address', 'mac_address'),
+        Index('ix_entries_ip_address', 'ip_address',
+              postgresql_ops={'ip_address': 'inet_ops'}),
+    )
 
 
 class Model(ZTPBase):
@@ -67,3 +80,20 @@ class User(ZTPBase):
     userside_id = Column(Integer)
     name = Column(String)
     telegram_id = Column(BIGINT)
+
+
+class OfficeDhcpChange(ZTPBase):
+    __tablename__ = 'office_dhcp_changes'
+    id = Column('id', Integer, primary_key=True, nullable=False)
+    created_at = Column('created_at', DateTime, server_default=func.now())
+    action = Column('action', String, nullable=False)
+    payload = Column('payload', JSONB, nullable=False)
+    applied_at = Column('applied_at', DateTime, nullable=True)
+    error = Column('error', String, nullable=True)
+    attempts = Column('attempts', Integer, nullable=False, server_default='0')
+    retry_at = Column('retry_at', DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_office_dhcp_changes_pending', 'id',
+              postgresql_where=applied_at.is_(None) & error.is_(None)),
+    )
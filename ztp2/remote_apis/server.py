@@ -1,14 +1,123 @@
+import logging
+import threading
+import time
 from netmiko.linux import LinuxSSH
 
+SSH_KEEPALIVE = 30
+SSH_MAX_IDLE = 300
+SSH_POOL_SIZE = 2
+
+
+class PooledSession:
+    """
+    Leases pooled connection for `with factory() as session` block.
+    Connection is dropped if block failed, it may be in unknown state
+    """
+    def __init__(self, factory: 'ServerTerminalFactory'):
+        self.factory = factory
+        self.session: LinuxSSH | None = None
+
+    def __enter__(self) -> LinuxSSH:
+        self.session = self.factory.acquire()
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.factory.release(self.session, broken=exc_type is not None)
+        self.session = None
+
 
 class ServerTerminalFactory:
-    def __init__(self, username: str, password: str, ip_address: str):
+    """
+    Keeps SSH sessions between tasks of one worker process
+    """
+    def __init__(self, username: str, password: str, ip_address: str,
+                 keepalive: int = SSH_KEEPALIVE,
+                 max_idle: float = SSH_MAX_IDLE,
+                 pool_size: int = SSH_POOL_SIZE):
         self.username = username
         self.password = password
         self.ip_address = ip_address
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.pool_size = pool_size
+        # (session, released at)
+        self.idle: list[tuple[LinuxSSH, float]] = []
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.broken = 0
+        self.setup_time = 0.
 
     def __call__(self):
-        return LinuxSSH(device_type='linux',
-                        host=self.ip_address,
-                        username=self.username,
-                        password=self.password)
+        return PooledSession(self)
+
+    def _connect(self) -> LinuxSSH:
+        started = time.monotonic()
+        session = LinuxSSH(device_type='linux',
+                           host=self.ip_address,
+                           username=self.username,
+                           password=self.password,
+                           keepalive=self.keepalive)
+        with self.lock:
+            self.created += 1
+            self.setup_time += time.monotonic() - started
+        return session
+
+    @staticmethod
+    def _disconnect(session: LinuxSSH):
+        try:
+            session.disconnect()
+        except Exception as exc:
+            logging.debug(f'SSH disconnect failed: {exc!r}')
+
+    def acquire(self) -> LinuxSSH:
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                session, released_at = self.idle.pop()
+            if time.monotonic() - released_at > self.max_idle:
+                with self.lock:
+                    self.evicted += 1
+                self._disconnect(session)
+                continue
+            if not session.is_alive():
+                with self.lock:
+                    self.broken += 1
+                self._disconnect(session)
+                continue
+            with self.lock:
+                self.reused += 1
+            return session
+        return self._connect()
+
+    def release(self, session: LinuxSSH, broken: bool = False):
+        if broken:
+            with self.lock:
+                self.broken += 1
+            self._disconnect(session)
+            return
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append((session, time.monotonic()))
+                return
+        self._disconnect(session)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for session, _ in idle:
+            self._disconnect(session)
+        logging.info('Office DHCP SSH pool: %s', self.stats())
+
+    def stats(self) -> dict[str, int | float]:
+        leases = self.created + self.reused
+        return {'created': self.created,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'broken': self.broken,
+                'idle': len(self.idle),
+                'reuse_ratio': self.reused / leases if leases else 0.,
+                'setup_time_avg': self.setup_time / self.created
+                if self.created else 0.}
@@ -1,4 +1,18 @@
 import aiohttp
+import asyncio
+import copy
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from ..utils.cache import TTLCache
+
+USERSIDE_CONNECTIONS = 20
+USERSIDE_KEEPALIVE = 60
+# Write actions also make stale data of these categories
+USERSIDE_INVALIDATES = {
+    'commutation': ('commutation', 'device'),
+    'inventory': ('inventory', 'device', 'node'),
+}
 
 
 class UsersideCategory:
@@ -15,18 +29,116 @@ class UsersideCategory:
 
 
 class UsersideAPI:
+    """
+    Session is created once and kept alive between requests.
+    Identical read requests (get_*, show) in flight are sent once,
+    their responses are cached if cache is given.
+    Write requests drop cached responses of affected categories
+    """
     def __init__(self,
                  url: str,
-                 key: str, ):
+                 key: str,
+                 cache: 'TTLCache | None' = None):
         self._url = url
         self._key = key
         self._in_use = 0
         self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        self.cache = cache
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed \
+                or self._loop is not loop:
+            stale, stale_loop = self._session, self._loop
+            connector = aiohttp.TCPConnector(
+                limit=USERSIDE_CONNECTIONS,
+                keepalive_timeout=USERSIDE_KEEPALIVE)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+            self._in_flight = {}
+            if stale is not None and not stale.closed:
+                await self._close_stale(stale, stale_loop)
+        return self._session
+
+    @staticmethod
+    async def _close_stale(session: aiohttp.ClientSession,
+                           loop: asyncio.AbstractEventLoop):
+        """
+        Session left by another event loop. If that loop runs in other
+        thread, its transports are closed there
+        """
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            await session.close()
+
+    @staticmethod
+    def _is_read(action: str) -> bool:
+        return action.startswith('get') or action == 'show'
 
     async def _request(self, cat: str, action: str, **kwargs):
+        if not self._is_read(action):
+            try:
+                return await self._send(cat, action, **kwargs)
+            finally:
+                self._invalidate(cat)
+        key = (cat, action, tuple(sorted((name, str(value))
+                                         for name, value in kwargs.items())))
+        if self.cache is not None:
+            found, content = self.cache.get(key)
+            if found:
+                return copy.deepcopy(content)
+        await self._get_session()
+        while True:
+            future = self._in_flight.get(key)
+            if future is None:
+                return copy.deepcopy(await self._lead(key, cat, action,
+                                                      **kwargs))
+            try:
+                return copy.deepcopy(await asyncio.shield(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # Leader was cancelled, not us: next one leads
+
+    async def _lead(self, key: tuple, cat: str, action: str, **kwargs):
+        """
+        Sends request for every caller waiting for the same key.
+        Shared future is resolved on every exit, cancellation included
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            content = await self._send(cat, action, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+            # Nobody else may wait for it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+        future.set_result(content)
+        if self.cache is not None:
+            self.cache.set(key, content)
+        return content
+
+    def _invalidate(self, cat: str):
+        if self.cache is None:
+            return
+        categories = USERSIDE_INVALIDATES.get(cat, (cat,))
+        self.cache.invalidate_where(lambda key: key[0] in categories)
+
+    async def _send(self, cat: str, action: str, **kwargs):
         params = {'key': self._key, 'cat': cat, 'action': action}
         params.update(kwargs)
-        async with self._session.get(url=self._url, params=params) as response:
+        session = await self._get_session()
+        async with session.get(url=self._url, params=params) as response:
             content = await response.json()
             if not response.ok:
                 raise RuntimeError(
@@ -50,13 +162,15 @@ class UsersideAPI:
         return UsersideCategory(item, self)
 
     async def __aenter__(self):
-        if (self._in_use == 0) and (not self._session):
-            self._session = aiohttp.ClientSession()
+        await self._get_session()
         self._in_use += 1
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # Session stays open for next users, see close()
         self._in_use -= 1
-        if (self._in_use == 0) and self._session:
+
+    async def close(self):
+        if self._session is not None:
             await self._session.close()
             self._session = None
@@ -1,11 +1,13 @@
-from .ftp import get_file_content, pattern_in_file_content, upload_file
+from .ftp import get_file_content, pattern_in_file_content, upload_file, \
+    get_file_bytes, get_file_size
 from .kea import create_host_and_options, kea_change_ip_address, \
     kea_change_mac_address
 from .netbox import get_prefix_info, get_prefix, get_and_reserve_ip, get_vlan, \
-    get_default_gateway
+    get_default_gateway, reserve_ips
 from .server import create_entry, change_ip_address, change_mac_address, \
-    delete_entry
-from .snmp import get_vlan_list, get_ports_descriptions, get_port_vlans
+    delete_entry, create_entries, apply_changes
+from .snmp import get_vlan_list, get_ports_descriptions, get_port_vlans, \
+    get_switch_snapshot
 from .sort_of_ping import check_port
 from .ping import check
 from .terminal import extract_dlink_serial
@@ -0,0 +1,67 @@
+"""
+Binary DHCP option payloads shared by Kea and ISC DHCP backends.
+Payloads depending only on firmware and servers are same for every
+switch of a model, so they are memoized
+"""
+import functools
+import ipaddress
+import struct
+
+DLINK_ENTERPRISE_ID = 0xAB
+DLINK_FIRMWARE_SUBOPTION = 1
+# enterprise id, data length, suboption code, suboption length
+OPTION_125_HEADER = struct.Struct('!IBBB')
+
+
+def encode_address(address: str | ipaddress.IPv4Address) -> bytes:
+    return ipaddress.IPv4Address(address).packed
+
+
+def encode_text(text: str) -> bytes:
+    return text.encode()
+
+
+@functools.lru_cache(maxsize=256)
+def encode_option_125(firmware_filename: str) -> bytes:
+    """
+    Vendor-identifying vendor-specific information (RFC 3925)
+    with D-Link firmware filename suboption
+    """
+    filename = firmware_filename.encode('latin-1')
+    header = OPTION_125_HEADER.pack(DLINK_ENTERPRISE_ID, len(filename) + 2,
+                                    DLINK_FIRMWARE_SUBOPTION, len(filename))
+    return header + filename
+
+
+def decode_option_125(value: bytes) -> tuple[int, dict[int, bytes]]:
+    enterprise_id, data_length = struct.unpack_from('!IB', value)
+    data = value[5:5 + data_length]
+    suboptions = {}
+    position = 0
+    while position < len(data):
+        code, length = data[position], data[position + 1]
+        suboptions[code] = data[position + 2:position + 2 + length]
+        position += 2 + length
+    return enterprise_id, suboptions
+
+
+@functools.lru_cache(maxsize=256)
+def firmware_options(fw_tftp_server: str,
+                     fw_filename: str) -> tuple[tuple[int, bytes], ...]:
+    """
+    Options 125 (firmware filename) and 150 (firmware TFTP server)
+    """
+    return ((125, encode_option_125(fw_filename)),
+            (150, encode_address(fw_tftp_server)))
+
+
+@functools.lru_cache(maxsize=256)
+def config_server_option(cfg_tftp_server: str) -> tuple[int, bytes]:
+    """
+    Option 66 (configurations TFTP server name)
+    """
+    return 66, encode_text(cfg_tftp_server)
+
+
+def isc_hex(value: bytes) -> str:
+    return value.hex(':').upper()
@@ -4,11 +4,24 @@ import io
 
 async def get_file_content(filename: str,
                            client: aioftp.Client):
-    file_content = ''
-    async with client.download_stream(filename) as stream:
+    content = await get_file_bytes(filename, client)
+    return content.decode('utf-8')
+
+
+async def get_file_bytes(filename: str,
+                         client: aioftp.Client,
+                         offset: int = 0):
+    blocks = []
+    async with client.download_stream(filename, offset=offset) as stream:
         async for block in stream.iter_by_block():
-            file_content += block.decode('utf-8')
-    return file_content
+            blocks.append(block)
+    return b''.join(blocks)
+
+
+async def get_file_size(filename: str,
+                        client: aioftp.Client):
+    info = await client.stat(filename)
+    return int(info['size'])
 
 
 async def pattern_in_file_content(filename: str,
@@ -0,0 +1,192 @@
+"""
+Office ISC DHCP config as a model: file is fetched once over SFTP,
+ZTP host groups are edited in memory, then the file is replaced
+atomically, checked by dhcpd and the server is reloaded once
+"""
+import posixpath
+import re
+import uuid
+from netmiko.linux import LinuxSSH
+
+# Formatted with path of the file to check
+DHCPD_CHECK_COMMAND = 'sudo dhcpd -t -q -cf {filepath}'
+DHCPD_RELOAD_COMMAND = 'sudo /etc/init.d/isc-dhcp-server restart'
+EXIT_MARKER = '__ztp_exit='
+
+GROUP_REGEX = re.compile(
+    r'group \{\s*'
+    r'option tftp-server-name "(?P<tftp_server>[^"]*)";\s*'
+    r'option bootfile-name "(?P<bootfile>[^"]*)";\s*'
+    r'option option125 (?P<option125>[0-9A-Fa-f:]+);\s*'
+    r'option option150 (?P<option150>[^;\s]+);\s*'
+    r'host entry_(?P<entry_id>\d+) \{ '
+    r'hardware ethernet (?P<mac_address>[0-9A-Fa-f:]+); \}\s*'
+    r'\}\n?'
+)
+INITIAL_CONFIG_REGEX = re.compile(r'(initial/)[^/]+?(\.cfg)')
+
+
+class OfficeHost:
+    def __init__(self, entry_id: int, mac_address: str, tftp_server: str,
+                 bootfile: str, option125: str, option150: str):
+        self.entry_id = entry_id
+        self.mac_address = mac_address
+        self.tftp_server = tftp_server
+        self.bootfile = bootfile
+        self.option125 = option125
+        self.option150 = option150
+
+    @classmethod
+    def from_match(cls, match: re.Match):
+        return cls(int(match['entry_id']), match['mac_address'].lower(),
+                   match['tftp_server'], match['bootfile'],
+                   match['option125'], match['option150'])
+
+    def render(self) -> str:
+        lines = [
+            'group {',
+            f'option tftp-server-name "{self.tftp_server}";',
+            f'option bootfile-name "{self.bootfile}";',
+            f'option option125 {self.option125};',
+            f'option option150 {self.option150};',
+            f'host entry_{self.entry_id} '
+            f'{{ hardware ethernet {self.mac_address}; }}',
+            '}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+class OfficeDhcpConfig:
+    """
+    Parsed config file. Everything except ZTP host groups is kept as is
+    """
+    def __init__(self, text: str = ''):
+        self.parts: list[str | OfficeHost] = []
+        self.by_entry: dict[int, OfficeHost] = {}
+        self.by_mac: dict[str, OfficeHost] = {}
+        position = 0
+        for match in GROUP_REGEX.finditer(text):
+            if match.start() > position:
+                self.parts.append(text[position:match.start()])
+            host = OfficeHost.from_match(match)
+            self.parts.append(host)
+            self.by_entry[host.entry_id] = host
+            self.by_mac[host.mac_address] = host
+            position = match.end()
+        if position < len(text):
+            self.parts.append(text[position:])
+
+    def render(self) -> str:
+        text = ''
+        for part in self.parts:
+            if isinstance(part, OfficeHost):
+                if text and not text.endswith('\n'):
+                    text += '\n'
+                text += part.render()
+            else:
+                text += part
+        return text
+
+    def _discard(self, host: OfficeHost | None):
+        if host is None:
+            return
+        self.parts = [part for part in self.parts if part is not host]
+        if self.by_entry.get(host.entry_id) is host:
+            del self.by_entry[host.entry_id]
+        if self.by_mac.get(host.mac_address) is host:
+            del self.by_mac[host.mac_address]
+
+    def add(self, host: OfficeHost):
+        """
+        Replaces groups of the same entry or the same MAC address
+        """
+        self._discard(self.by_entry.get(host.entry_id))
+        self._discard(self.by_mac.get(host.mac_address))
+        self.parts.append(host)
+        self.by_entry[host.entry_id] = host
+        self.by_mac[host.mac_address] = host
+
+    def remove(self, entry_id: int) -> bool:
+        host = self.by_entry.get(entry_id)
+        self._discard(host)
+        return host is not None
+
+    def change_mac_address(self, entry_id: int, mac_address: str) -> bool:
+        host = self.by_entry.get(entry_id)
+        if host is None:
+            return False
+        if host.mac_address == mac_address:
+            return True
+        self._discard(self.by_mac.get(mac_address))
+        if self.by_mac.get(host.mac_address) is host:
+            del self.by_mac[host.mac_address]
+        host.mac_address = mac_address
+        self.by_mac[mac_address] = host
+        return True
+
+    def change_ip_address(self, entry_id: int, ip_address: str) -> bool:
+        host = self.by_entry.get(entry_id)
+        if host is None:
+            return False
+        host.bootfile = INITIAL_CONFIG_REGEX.sub(
+            rf'\g<1>{ip_address}\g<2>', host.bootfile, count=1)
+        return True
+
+
+class OfficeDhcpEditor:
+    """
+    Loads and saves office DHCP config through one SSH session
+    """
+    def __init__(self, session: LinuxSSH, filepath: str,
+                 check_command: str = DHCPD_CHECK_COMMAND,
+                 reload_command: str = DHCPD_RELOAD_COMMAND):
+        self.session = session
+        self.filepath = filepath
+        self.check_command = check_command
+        self.reload_command = reload_command
+
+    def _sftp(self):
+        return self.session.remote_conn_pre.open_sftp()
+
+    def _run(self, command: str) -> tuple[str, bool]:
+        output = self.session.send_command(
+            f'{command}; echo "{EXIT_MARKER}$?"')
+        output, _, code = output.rpartition(EXIT_MARKER)
+        return output.strip(), code.strip() == '0'
+
+    def load(self) -> OfficeDhcpConfig:
+        with self._sftp() as sftp:
+            with sftp.open(self.filepath) as file:
+                text = file.read().decode()
+        return OfficeDhcpConfig(text)
+
+    def save(self, config: OfficeDhcpConfig, reload: bool = True):
+        """
+        New file is checked by dhcpd next to the old one, then replaces it
+        by rename, so dhcpd never reads half-written or rejected config
+        """
+        basename = posixpath.basename(self.filepath)
+        temporary = f'/tmp/{basename}.{uuid.uuid4().hex}'
+        new = f'{self.filepath}.new'
+        backup = f'{self.filepath}.bak'
+        with self._sftp() as sftp:
+            with sftp.open(temporary, 'w') as file:
+                file.write(config.render())
+        output, ok = self._run(
+            f'sudo install -m 644 {temporary} {new}; rc=$?; '
+            f'rm -f {temporary}; test $rc -eq 0')
+        if not ok:
+            raise RuntimeError(f'Office DHCP config upload failed: {output}')
+        output, ok = self._run(self.check_command.format(filepath=new))
+        if not ok:
+            self._run(f'sudo rm -f {new}')
+            raise RuntimeError(f'Office DHCP config rejected: {output}')
+        output, ok = self._run(f'sudo cp -p {self.filepath} {backup} && '
+                               f'sudo mv -f {new} {self.filepath}')
+        if not ok:
+            raise RuntimeError(f'Office DHCP config install failed: {output}')
+        if reload:
+            output, ok = self._run(self.reload_command)
+            if not ok:
+                raise RuntimeError(f'Office DHCP server reload failed: '
+                                   f'{output}')
@@ -4,44 +4,92 @@ KEA DHCP server is third-party software
 We don't pay for KEA custom hooks and use free version
 So we have to prepare values to match KEA format by ourselves
 """
+import bisect
 import ipaddress
+import time
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy import select, and_, delete, update
+from sqlalchemy import select, and_, delete, update, tuple_, func
 
-from ..db.models.kea_dhcp import Host, DHCPOption
+from ..db.models.kea_dhcp import Host, DHCPOption, DHCP4Subnet
+from .dhcp_options import encode_address, encode_text, \
+    config_server_option, firmware_options
 
 
-def subnet_id(ip_address: ipaddress.IPv4Address) -> int:
-    if ip_address in ipaddress.IPv4Network('172.22.0.0/16'):
-        return 1
-    elif ip_address in ipaddress.IPv4Network('10.10.0.0/16'):
-        return 2
-    elif ip_address in ipaddress.IPv4Network('10.0.0.0/16'):
-        return 3
-    elif ip_address in ipaddress.IPv4Network('10.55.0.0/16'):
-        return 4
-    raise
+# Used until dhcp4_subnet table is read (or if it is empty)
+DEFAULT_SUBNETS = {
+    '172.22.0.0/16': 1,
+    '10.10.0.0/16': 2,
+    '10.0.0.0/16': 3,
+    '10.55.0.0/16': 4,
+}
+SUBNETS_CHECK_INTERVAL = 60
 
 
-def hexstring_to_bytea(hexstring: str) -> bytes:
-    answer = [int(hexstring[i:i + 2], 16) for i in range(0, len(hexstring), 2)]
-    return bytes(answer)
+class SubnetRegistry:
+    """
+    Kea subnets as sorted integer ranges with bisect lookup.
+    Subnets in Kea don't overlap, so the nearest range start is enough
+    """
+    def __init__(self, subnets: dict[str, int],
+                 check_interval: float = SUBNETS_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.checked_at: float | None = None
+        self.version: tuple | None = None
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        self.ids: list[int] = []
+        self.load(subnets)
+
+    def load(self, subnets: dict[str, int]):
+        ranges = []
+        for prefix, subnet in subnets.items():
+            network = ipaddress.IPv4Network(prefix, strict=False)
+            ranges.append((int(network.network_address),
+                           int(network.broadcast_address), subnet))
+        ranges.sort()
+        self.starts = [start for start, _, _ in ranges]
+        self.ends = [end for _, end, _ in ranges]
+        self.ids = [subnet for _, _, subnet in ranges]
+
+    def lookup(self, ip_address: ipaddress.IPv4Address) -> int:
+        address = int(ip_address)
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index < 0 or address > self.ends[index]:
+            raise ValueError(f'No Kea subnet for {ip_address}')
+        return self.ids[index]
+
+    async def refresh(self, db: AsyncSession):
+        """
+        Reloads subnets if dhcp4_subnet changed, at most once per interval
+        """
+        now = time.monotonic()
+        if self.checked_at is not None \
+                and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        stmt = select(func.count(), func.max(DHCP4Subnet.modification_ts))
+        response = await db.execute(stmt)
+        version = tuple(response.one())
+        if version == self.version:
+            return
+        response = await db.execute(select(DHCP4Subnet.subnet_prefix,
+                                           DHCP4Subnet.subnet_id))
+        subnets = {prefix: subnet for prefix, subnet in response.all()
+                   if ':' not in prefix}
+        self.load(subnets or DEFAULT_SUBNETS)
+        self.version = version
 
 
-def generate_option_125(firmware_filename: str):
-    dlink_id = '000000AB'
-    suboption_length = hex(1 + 1 + len(firmware_filename))[2:].upper().zfill(2)
-    suboption_code = '01'
-    filename_length = hex(len(firmware_filename))[2:].upper().zfill(2)
-    hex_filename = ''.join([hex(ord(letter))[2:].upper().zfill(2)
-                            for letter in firmware_filename])
-    answer = dlink_id
-    answer += suboption_length
-    answer += suboption_code
-    answer += filename_length
-    answer += hex_filename
-    return answer
+subnet_registry = SubnetRegistry(DEFAULT_SUBNETS)
+
+
+def subnet_id(ip_address: ipaddress.IPv4Address) -> int:
+    return subnet_registry.lookup(ip_address)
+
+
+def hexstring_to_bytea(hexstring: str) -> bytes:
+    return bytes.fromhex(hexstring)
 
 
 def host_params(mac_address: str, ip_address: ipaddress.IPv4Address):
@@ -65,58 +113,21 @@ def option_params_gen(host_id: int,
         'scope_id': 3,
         'persistent': False,
     }
-
-    # option1: subnet mask
-    option1 = bytes(str(int(default_gateway.netmask)), 'utf-8')
-    specification1 = {
-        'code': 1,
-        'value': option1
-    }
-    yield base | specification1
-
+    # option1: subnet mask (Kea keeps it as decimal text)
+    yield base | {'code': 1,
+                  'value': str(int(default_gateway.netmask)).encode()}
     # option3: default gateway
-    option3 = hex(int(default_gateway.ip))[2:].zfill(8)
-    option3 = hexstring_to_bytea(option3)
-    specification3 = {
-        'code': 3,
-        'value': option3
-    }
-    yield base | specification3
-
+    yield base | {'code': 3,
+                  'value': encode_address(default_gateway.ip)}
     # option66: configurations tftp server address
-    option66 = bytes(cfg_tftp_server, 'utf-8')
-    specification66 = {
-        'code': 66,
-        'value': option66
-    }
-    yield base | specification66
-
+    code, value = config_server_option(cfg_tftp_server)
+    yield base | {'code': code, 'value': value}
     # option67: configuration filename
-    option67 = bytes(cfg_filename, 'utf-8')
-    specification67 = {
-        'code': 67,
-        'value': option67
-    }
-    yield base | specification67
-
-    # option125: firmware filename
-    option125 = generate_option_125(fw_filename)
-    option125 = hexstring_to_bytea(option125)
-    specification125 = {
-        'code': 125,
-        'value': option125
-    }
-    yield base | specification125
-
-    # option150: firmwares tftp server address
-    option150 = int(ipaddress.IPv4Address(fw_tftp_server))
-    option150 = hex(option150)[2:].zfill(8)
-    option150 = hexstring_to_bytea(option150)
-    specification150 = {
-        'code': 150,
-        'value': option150
-    }
-    yield base | specification150
+    yield base | {'code': 67,
+                  'value': encode_text(cfg_filename)}
+    # option125: firmware filename, option150: firmwares tftp server address
+    for code, value in firmware_options(fw_tftp_server, fw_filename):
+        yield base | {'code': code, 'value': value}
 
 
 async def create_host_and_options(db: AsyncSession,
@@ -127,40 +138,67 @@ async def create_host_and_options(db: AsyncSession,
                                   cfg_filename: str,
                                   fw_tftp_server: str,
                                   fw_filename: str):
-    mac_address = ''.join(filter(lambda x: x in '0123456789abcdef',
-                                 mac_address.lower()))
-    params = host_params(mac_address, ip_address)
-    stmt = select(Host)
-    stmt = stmt.where(and_(
-        Host.dhcp_identifier == params['dhcp_identifier'],
-        Host.dhcp_identifier_type == params['dhcp_identifier_type'],
-        Host.dhcp4_subnet_id == params['dhcp4_subnet_id']))
-    response = await db.execute(stmt)
-    host = response.scalars().first()
-    if host:
-        stmt = delete(Host).where(Host.host_id == host.host_id)
-        await db.execute(stmt)
-    stmt = select(Host)
-    stmt = stmt.where(and_(
-        Host.dhcp4_subnet_id == params['dhcp4_subnet_id'],
-        Host.ipv4_address == params['ipv4_address']))
-    response = await db.execute(stmt)
-    host = response.scalars().first()
-    if host:
-        stmt = delete(Host).where(Host.host_id == host.host_id)
-        await db.execute(stmt)
+    await create_hosts_and_options(db, [(mac_address, ip_address,
+                                         default_gateway, cfg_tftp_server,
+                                         cfg_filename, fw_tftp_server,
+                                         fw_filename)])
+
+
+async def create_hosts_and_options(db: AsyncSession, hosts: list[tuple]):
+    """
+    Upserts many reservations in one transaction of four statements.
+    Every item is a tuple of create_host_and_options arguments after db.
+    Reservations of same addresses for other devices are removed
+    """
+    await subnet_registry.refresh(db)
+    prepared = {}
+    for mac_address, ip_address, *options in hosts:
+        mac_address = ''.join(filter(lambda x: x in '0123456789abcdef',
+                                     mac_address.lower()))
+        params = host_params(mac_address, ip_address)
+        identity = (params['dhcp_identifier'],
+                    params['dhcp_identifier_type'],
+                    params['dhcp4_subnet_id'])
+        prepared[identity] = (params, options)
+    if not prepared:
+        return
+    targets = [identity + (params['ipv4_address'],)
+               for identity, (params, _) in prepared.items()]
+
+    stmt = delete(Host)
+    stmt = stmt.where(tuple_(Host.dhcp4_subnet_id, Host.ipv4_address).in_(
+        [(subnet, address) for _, _, subnet, address in targets]))
+    stmt = stmt.where(tuple_(Host.dhcp_identifier, Host.dhcp_identifier_type,
+                             Host.dhcp4_subnet_id,
+                             Host.ipv4_address).not_in(targets))
+    await db.execute(stmt)
+
     stmt = insert(Host)
-    stmt = stmt.values(**params)
-    stmt = stmt.returning(Host.host_id)
+    stmt = stmt.values([params for params, _ in prepared.values()])
+    # Kea unique index on host identity is partial,
+    # Postgres infers it only with the same predicate
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Host.dhcp_identifier, Host.dhcp_identifier_type,
+                        Host.dhcp4_subnet_id],
+        index_where=and_(Host.dhcp4_subnet_id.isnot(None),
+                         Host.dhcp4_subnet_id != 0),
+        set_={'ipv4_address': stmt.excluded.ipv4_address})
+    stmt = stmt.returning(Host.host_id, Host.dhcp_identifier,
+                          Host.dhcp_identifier_type, Host.dhcp4_subnet_id)
     response = await db.execute(stmt)
-    host_id = response.scalars().first()
-
-    for option_params in option_params_gen(host_id, default_gateway,
-                                           cfg_tftp_server, cfg_filename,
-                                           fw_tftp_server, fw_filename):
-        stmt = insert(DHCPOption)
-        stmt = stmt.values(**option_params)
-        await db.execute(stmt)
+    host_ids = {tuple(row[1:]): row[0] for row in response.all()}
+
+    stmt = delete(DHCPOption)
+    stmt = stmt.where(DHCPOption.host_id.in_(list(host_ids.values())))
+    await db.execute(stmt)
+
+    options = [option_params
+               for identity, (_, host_options) in prepared.items()
+               for option_params in option_params_gen(host_ids[identity],
+                                                      *host_options)]
+    stmt = insert(DHCPOption)
+    stmt = stmt.values(options)
+    await db.execute(stmt)
     await db.commit()
 
 
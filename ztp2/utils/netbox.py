@@ -1,11 +1,229 @@
+import asyncio
+import copy
 import ipaddress
+import logging
+import time
 import aiohttp
 
+from .cache import TTLCache
+
+# Prefixes, VLANs and gateways are changed rarely
+netbox_cache = TTLCache(maxsize=4096, ttl=300)
+
+RESERVE_ATTEMPTS = 3
+
+IPV4_MASKS = {length: (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+              for length in range(33)}
+
+
+class PrefixIndex:
+    """
+    Local copy of all Netbox IPv4 prefixes (with VLANs) and gateways
+    for longest prefix match without HTTP.
+    Prefixes are kept in hash tables per prefix length,
+    lookup is at most 33 dict lookups.
+    Synced lazily: full load, then pulls of changed and deleted objects.
+    Gateways are matched to prefixes again after every change
+    """
+    def __init__(self, refresh_interval: float = 60,
+                 full_reload_interval: float = 3600,
+                 page_size: int = 1000):
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.page_size = page_size
+        self.by_length: dict[int, dict[int, dict]] = {}
+        self.by_id: dict[int, tuple[int, int]] = {}
+        # Netbox id: address of every IP address tagged gw
+        self.gateway_addresses: dict[int, str] = {}
+        self.gateways: dict[str, set[str]] = {}
+        self.lengths: list[int] = []
+        self.loaded_at: float | None = None
+        self.refreshed_at: float | None = None
+        self.last_updated: str | None = None
+        self._lock: asyncio.Lock | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _fetch_all(self, url: str, params: dict,
+                         session: aiohttp.ClientSession) -> list[dict]:
+        results = []
+        offset = 0
+        while True:
+            page_params = params | {'limit': self.page_size, 'offset': offset}
+            async with session.get(url, params=page_params) as response:
+                response.raise_for_status()
+                content = await response.json()
+            results.extend(content['results'])
+            offset += self.page_size
+            if offset >= content['count']:
+                return results
+
+    def _remove_prefix(self, prefix_id: int):
+        old = self.by_id.pop(prefix_id, None)
+        if old:
+            self.by_length.get(old[0], {}).pop(old[1], None)
+            if not self.by_length.get(old[0], True):
+                del self.by_length[old[0]]
+
+    def _add_prefix(self, prefix_info: dict):
+        network = ipaddress.ip_network(prefix_info['prefix'])
+        if network.version != 4:
+            return
+        self._remove_prefix(prefix_info['id'])
+        key = (network.prefixlen, int(network.network_address))
+        self.by_length.setdefault(key[0], {})[key[1]] = prefix_info
+        self.by_id[prefix_info['id']] = key
+
+    def _add_address(self, address_info: dict):
+        """
+        Keeps address only while it is tagged gw
+        """
+        tags = {tag.get('slug') for tag in address_info.get('tags', ())}
+        address = ipaddress.ip_interface(address_info['address'])
+        if 'gw' in tags and address.version == 4:
+            self.gateway_addresses[address_info['id']] = \
+                address_info['address']
+        else:
+            self.gateway_addresses.pop(address_info['id'], None)
+
+    def _resolve_gateways(self):
+        self.lengths = sorted(self.by_length, reverse=True)
+        gateways = {}
+        for address in self.gateway_addresses.values():
+            prefix_info = self.lookup(
+                ipaddress.IPv4Interface(address).ip.exploded)
+            if prefix_info:
+                gateways.setdefault(prefix_info['prefix'], set()).add(address)
+        self.gateways = gateways
+
+    def _track_last_updated(self, objects: list[dict]):
+        for obj in objects:
+            last_updated = obj.get('last_updated')
+            if last_updated and (self.last_updated is None
+                                 or last_updated > self.last_updated):
+                self.last_updated = last_updated
+
+    async def _fetch_deleted(self, object_type: str,
+                             session: aiohttp.ClientSession) -> list[int]:
+        changes = await self._fetch_all(
+            '/api/extras/object-changes/',
+            {'action': 'delete', 'changed_object_type': object_type,
+             'time_after': self.last_updated}, session)
+        return [change['changed_object_id'] for change in changes]
+
+    async def load(self, session: aiohttp.ClientSession):
+        prefixes = await self._fetch_all('/api/ipam/prefixes/', {}, session)
+        gateways = await self._fetch_all('/api/ipam/ip-addresses/',
+                                         {'tag': 'gw'}, session)
+        self.by_length = {}
+        self.by_id = {}
+        self.gateway_addresses = {}
+        for prefix_info in prefixes:
+            self._add_prefix(prefix_info)
+        for address_info in gateways:
+            self._add_address(address_info)
+        self._resolve_gateways()
+        self.last_updated = None
+        self._track_last_updated(prefixes + gateways)
+        self.loaded_at = self.refreshed_at = time.monotonic()
+
+    async def refresh(self, session: aiohttp.ClientSession):
+        """
+        Addresses are pulled without tag filter:
+        untagged gateway must be dropped too
+        """
+        if not self.last_updated:
+            return await self.load(session)
+        params = {'last_updated__gte': self.last_updated}
+        prefixes, addresses, deleted_prefixes, deleted_addresses = \
+            await asyncio.gather(
+                self._fetch_all('/api/ipam/prefixes/', params, session),
+                self._fetch_all('/api/ipam/ip-addresses/', params, session),
+                self._fetch_deleted('ipam.prefix', session),
+                self._fetch_deleted('ipam.ipaddress', session))
+        for prefix_id in deleted_prefixes:
+            self._remove_prefix(prefix_id)
+        for address_id in deleted_addresses:
+            self.gateway_addresses.pop(address_id, None)
+        for prefix_info in prefixes:
+            self._add_prefix(prefix_info)
+        for address_info in addresses:
+            self._add_address(address_info)
+        if prefixes or addresses or deleted_prefixes or deleted_addresses:
+            self._resolve_gateways()
+        self._track_last_updated(prefixes + addresses)
+        self.refreshed_at = time.monotonic()
+
+    async def sync(self, session: aiohttp.ClientSession) -> bool:
+        """
+        Brings index up to date if needed. Returns whether it is usable
+        """
+        async with self._get_lock():
+            now = time.monotonic()
+            try:
+                if not self.loaded \
+                        or now - self.loaded_at > self.full_reload_interval:
+                    await self.load(session)
+                elif now - self.refreshed_at > self.refresh_interval:
+                    await self.refresh(session)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    KeyError, ValueError) as exc:
+                logging.error(f'Netbox prefix index sync failed: {exc!r}')
+        return self.loaded
+
+    def lookup(self, ip: str) -> dict | None:
+        address = int(ipaddress.IPv4Address(ip))
+        for length in self.lengths:
+            prefix_info = self.by_length[length].get(
+                address & IPV4_MASKS[length])
+            if prefix_info is not None:
+                return prefix_info
+        return None
+
+    def gateways_of(self, prefix: str) -> list[str]:
+        return sorted(self.gateways.get(prefix, ()))
+
+    def stats(self) -> dict[str, int | float | None]:
+        now = time.monotonic()
+        return {'prefixes': len(self.by_id),
+                'gateways': len(self.gateway_addresses),
+                'loaded_ago': now - self.loaded_at if self.loaded else None,
+                'refreshed_ago': now - self.refreshed_at
+                if self.loaded else None}
+
+
+prefix_index = PrefixIndex()
+
+
+async def cached_get(key: tuple, url: str, params: dict,
+                     session: aiohttp.ClientSession):
+    found, content = netbox_cache.get(key)
+    if not found:
+        async with session.get(url, params=params) as response:
+            content = await response.json()
+            if response.ok:
+                netbox_cache.set(key, content)
+    return copy.deepcopy(content)
+
 
 async def get_prefix_info(ip: str, session: aiohttp.ClientSession):
-    async with session.get('/api/ipam/prefixes', params={'contains': ip}) \
-            as response:
-        possible_prefixes = await response.json()
+    if await prefix_index.sync(session):
+        prefix_info = prefix_index.lookup(ip)
+        if prefix_info is not None:
+            return copy.deepcopy(prefix_info)
+    possible_prefixes = await cached_get(('prefix_contains', ip),
+                                         '/api/ipam/prefixes',
+                                         {'contains': ip}, session)
     possible_prefixes = possible_prefixes['results']
     possible_prefixes.sort(
         key=lambda x: ipaddress.ip_network(x['prefix']).prefixlen,
@@ -21,46 +239,136 @@ async def get_prefix(ip: str, session: aiohttp.ClientSession):
     return prefix
 
 
-async def get_and_reserve_ip(prefix: str, session: aiohttp.ClientSession):
-    new_ip = None
-    async with session.get('/api/ipam/prefixes',
-                           params={'prefix': prefix}) as response:
-        prefix_info = await response.json()
+async def _available_count(prefix_id: int, limit: int,
+                           session: aiohttp.ClientSession) -> int:
+    async with session.get(f'/api/ipam/prefixes/{prefix_id}/available-ips/',
+                           params={'limit': limit}) as response:
+        if not response.ok:
+            return 0
+        answer = await response.json()
+    return len(answer)
+
+
+async def _allocate(prefix_id: int, count: int,
+                    session: aiohttp.ClientSession) -> list[dict]:
+    """
+    Netbox picks and creates addresses itself under a lock,
+    so concurrent callers never get the same address
+    """
+    body = [{'status': 'reserved'} for _ in range(count)]
+    async with session.post(f'/api/ipam/prefixes/{prefix_id}/available-ips/',
+                            json=body) as response:
+        if response.status == 409:
+            # Someone took addresses between check and allocation
+            return []
+        response.raise_for_status()
+        return await response.json()
+
+
+async def _release(addresses: list[dict], session: aiohttp.ClientSession):
+    if addresses:
+        body = [{'id': address['id']} for address in addresses]
+        async with session.delete('/api/ipam/ip-addresses/',
+                                  json=body) as response:
+            response.raise_for_status()
+
+
+async def release_ips(ips: list[str], session: aiohttp.ClientSession):
+    """
+    Gives back addresses reserved by reserve_ips
+    """
+    if not ips:
+        return
+    content = await _fetch_addresses(ips, session)
+    await _release([address for address in content
+                    if address['status']['value'] == 'reserved'], session)
+    for ip in ips:
+        invalidate_ip(ip)
+
+
+async def _fetch_addresses(ips: list[str],
+                           session: aiohttp.ClientSession) -> list[dict]:
+    params = [('address', ip) for ip in ips]
+    params.append(('limit', len(ips)))
+    async with session.get('/api/ipam/ip-addresses/',
+                           params=params) as response:
+        response.raise_for_status()
+        content = await response.json()
+    return content['results']
+
+
+async def _reserve_candidates(prefix: str, session: aiohttp.ClientSession):
+    prefix_info = await cached_get(('prefix', prefix), '/api/ipam/prefixes',
+                                   {'prefix': prefix}, session)
     prefix_info = prefix_info['results'][0]
-    async with session.get(
-            f'/api/ipam/prefixes/{prefix_info["id"]}/available-ips/'
-    ) as main_response:
-        answer = await main_response.json()
-    if answer:
-        new_ip = answer[0]['address']
-    else:
-        vlan_info = prefix_info['vlan']
-        async with session.get('/api/ipam/prefixes',
-                               params={'vlan_id': vlan_info['id']}) as outer_response:
-            prefixes_in_vlan = await outer_response.json()
-        prefixes_in_vlan = prefixes_in_vlan['results']
-        for prefix in prefixes_in_vlan:
-            async with session.get(
-                    f'/api/ipam/prefixes/{prefix["id"]}/available-ips/'
-            ) as loop_response:
-                answer = await loop_response.json()
-            if answer:
-                new_ip = answer[0]['address']
+    candidates = [prefix_info]
+    vlan_info = prefix_info['vlan']
+    if vlan_info:
+        prefixes_in_vlan = await cached_get(('prefixes_in_vlan',
+                                             vlan_info['id']),
+                                            '/api/ipam/prefixes',
+                                            {'vlan_id': vlan_info['id']},
+                                            session)
+        candidates += [candidate
+                       for candidate in prefixes_in_vlan['results']
+                       if candidate['id'] != prefix_info['id']]
+    return candidates
+
+
+async def reserve_ips(prefix: str, count: int,
+                      session: aiohttp.ClientSession) -> list[str]:
+    """
+    Reserves `count` addresses in prefix, then in other prefixes of its VLAN.
+    Either all addresses are reserved or none
+    """
+    candidates = await _reserve_candidates(prefix, session)
+    reserved = []
+    try:
+        for _ in range(RESERVE_ATTEMPTS):
+            needed = count - len(reserved)
+            available = await asyncio.gather(
+                *(_available_count(candidate['id'], needed, session)
+                  for candidate in candidates))
+            if not any(available):
                 break
-    if not new_ip:
-        raise RuntimeError('No free ip left')
-    await session.post('/api/ipam/ip-addresses/', json={'address': new_ip,
-                                                        'status': 'reserved'})
-    new_ip_address = ipaddress.IPv4Interface(new_ip).ip.exploded
-    return new_ip_address
+            for candidate, free in zip(candidates, available):
+                take = min(free, count - len(reserved))
+                if take:
+                    reserved += await _allocate(candidate['id'], take,
+                                                session)
+                if len(reserved) == count:
+                    break
+            if len(reserved) == count:
+                break
+        if len(reserved) < count:
+            raise RuntimeError('No free ip left')
+    except BaseException:
+        try:
+            await _release(reserved, session)
+        except Exception as exc:
+            logging.error(f'Reserved addresses '
+                          f'{[address["address"] for address in reserved]} '
+                          f'were not released: {exc!r}')
+        raise
+    new_ips = []
+    for address in reserved:
+        invalidate_ip(address['address'])
+        new_ips.append(
+            ipaddress.IPv4Interface(address['address']).ip.exploded)
+    return new_ips
+
+
+async def get_and_reserve_ip(prefix: str, session: aiohttp.ClientSession):
+    new_ips = await reserve_ips(prefix, 1, session)
+    return new_ips[0]
 
 
 async def get_vlan(criteria: int | str,
                    session: aiohttp.ClientSession):
     if isinstance(criteria, int) or criteria.isdigit():
-        async with session.get(f'/api/ipam/vlans/',
-                               params={'vid': criteria}) as response:
-            possible_vlans = await response.json()
+        possible_vlans = await cached_get(('vlan_vid', str(criteria)),
+                                          '/api/ipam/vlans/',
+                                          {'vid': criteria}, session)
         possible_vlans = possible_vlans['results']
         if len(possible_vlans) != 1:
             return int(criteria), f'v{str(criteria)}'
@@ -74,15 +382,18 @@ async def get_vlan(criteria: int | str,
 
 async def get_default_gateway(ip: str, session: aiohttp.ClientSession):
     prefix = await get_prefix(ip, session)
-    async with session.get(f'/api/ipam/ip-addresses/',
-                           params={'parent': prefix, 'tag': 'gw'}) as response:
-        content = await response.json()
-    possible_ips = content['results']
+    possible_ips = prefix_index.gateways_of(prefix)
     if not possible_ips:
-        raise
+        content = await cached_get(('gateway', prefix),
+                                   '/api/ipam/ip-addresses/',
+                                   {'parent': prefix, 'tag': 'gw'}, session)
+        possible_ips = [ip_info['address'] for ip_info in content['results']]
+    if not possible_ips:
+        raise RuntimeError(f'No gateway in prefix {prefix}')
     if len(possible_ips) != 1:
-        raise
-    return ipaddress.IPv4Interface(possible_ips[0]['address'])
+        raise RuntimeError(f'Several gateways in prefix {prefix}: '
+                           f'{", ".join(possible_ips)}')
+    return ipaddress.IPv4Interface(possible_ips[0])
 
 
 async def mark_ip_active(ip: str, session: aiohttp.ClientSession):
@@ -97,3 +408,18 @@ async def mark_ip_active(ip: str, session: aiohttp.ClientSession):
     netbox_id = possible_ips[0]['id']
     body = {'status': 'active'}
     await session.patch(f'/api/ipam/ip-addresses/{netbox_id}/', json=body)
+    invalidate_ip(ip)
+
+
+def invalidate_ip(ip: str):
+    """
+    Drops cached IP address lookups of prefixes containing given IP
+    """
+    address = ipaddress.ip_interface(ip).ip
+
+    def affected(key: tuple) -> bool:
+        if key[0] != 'gateway':
+            return False
+        return address in ipaddress.ip_network(key[1], strict=False)
+
+    netbox_cache.invalidate_where(affected)
@@ -1,5 +1,8 @@
 from netmiko.linux import LinuxSSH
 
+from .dhcp_options import encode_option_125, isc_hex
+from .isc_dhcp import OfficeDhcpEditor, OfficeHost
+
 
 def isc_dhcp_format_mac(mac_address: str):
     mac_address = ''.join(filter(lambda x: x in '0123456789abcdef',
@@ -10,99 +13,92 @@ def isc_dhcp_format_mac(mac_address: str):
 
 
 def generate_option_125(firmware_filename: str):
-    dlink_id = '00:00:00:AB'
-    suboption_length = hex(1 + 1 + len(firmware_filename))[2:].upper().zfill(2)
-    suboption_code = '01'
-    filename_length = hex(len(firmware_filename))[2:].upper().zfill(2)
-    hex_filename = ':'.join(
-        [hex(ord(letter))[2:].upper().zfill(2)
-         for letter in firmware_filename])
-    answer = dlink_id
-    answer += ':'
-    answer += suboption_length
-    answer += ':'
-    answer += suboption_code
-    answer += ':'
-    answer += filename_length
-    answer += ':'
-    answer += hex_filename
-    return answer
+    return isc_hex(encode_option_125(firmware_filename))
+
+
+def office_host(ztp_id: int, mac_address: str, ftp_host: str,
+                config_filename: str, firmware_filename: str):
+    return OfficeHost(ztp_id, isc_dhcp_format_mac(mac_address), ftp_host,
+                      config_filename, generate_option_125(firmware_filename),
+                      ftp_host)
 
 
 def create_entry(ztp_id: int, mac_address: str, ftp_host: str,
                  config_filename: str, firmware_filename: str,
                  dhcp_config_filepath: str, session: LinuxSSH):
-    mac_address = isc_dhcp_format_mac(mac_address)
-    cmd = f"cat {dhcp_config_filepath} | " \
-          f"grep -Fn 'hardware ethernet {mac_address}' | " \
-          f"cut --delimiter=':' --fields=1"
-    possible_mac_duplicate = session.send_command(cmd)
-    if possible_mac_duplicate:
-        line_number = int(possible_mac_duplicate)
-        cmd = f"sudo sed -i '{line_number - 5},{line_number + 1}d' " \
-              f"{dhcp_config_filepath}"
-        session.send_command(cmd)
-    lines = [
-        'group {',
-        f'option tftp-server-name "{ftp_host}";',
-        f'option bootfile-name "{config_filename}";',
-        f'option option125 {generate_option_125(firmware_filename)};',
-        f'option option150 {ftp_host};',
-        f'host entry_{ztp_id} {{ hardware ethernet {mac_address}; }}',
-        '}'
-    ]
-    for line in lines:
-        session.send_command(f'echo \'{line}\' >> {dhcp_config_filepath}')
-    session.send_command('sudo /etc/init.d/isc-dhcp-server restart')
+    create_entries([{'entry_id': ztp_id,
+                     'mac_address': mac_address,
+                     'ftp_host': ftp_host,
+                     'config_filename': config_filename,
+                     'firmware_filename': firmware_filename}],
+                   dhcp_config_filepath, session)
+
+
+def create_entries(entries: list[dict], dhcp_config_filepath: str,
+                   session: LinuxSSH):
+    """
+    Entries are create_entry arguments (ztp_id as entry_id)
+    """
+    apply_changes([('create', entry) for entry in entries],
+                  dhcp_config_filepath, session)
+
+
+def apply_changes(changes: list[tuple[str, dict]], dhcp_config_filepath: str,
+                  session: LinuxSSH) -> bool:
+    """
+    Applies changes in order with one rewrite and one reload.
+    Actions: create (create_entries item), ip_address and mac_address
+    (entry_id and value), delete (entry_id).
+    Returns whether config was changed
+    """
+    editor = OfficeDhcpEditor(session, dhcp_config_filepath)
+    config = editor.load()
+    changed = False
+    for action, payload in changes:
+        if action == 'create':
+            config.add(office_host(payload['entry_id'],
+                                   payload['mac_address'],
+                                   payload['ftp_host'],
+                                   payload['config_filename'],
+                                   payload['firmware_filename']))
+            changed = True
+        elif action == 'ip_address':
+            changed |= config.change_ip_address(payload['entry_id'],
+                                                payload['value'])
+        elif action == 'mac_address':
+            changed |= config.change_mac_address(
+                payload['entry_id'], isc_dhcp_format_mac(payload['value']))
+        elif action == 'delete':
+            changed |= config.remove(payload['entry_id'])
+    if changed:
+        editor.save(config)
+    return changed
 
 
 def change_mac_address(ztp_id: int,
                        new_mac: str,
                        dhcp_config_filepath: str,
                        session: LinuxSSH):
-    new_mac = isc_dhcp_format_mac(new_mac)
-    line_number = session.send_command(
-        f"cat {dhcp_config_filepath} | "
-        f"grep -Fn 'entry_{ztp_id}' | "
-        f"cut --delimiter=':' --fields=1")
-    if not line_number:
-        return
-    cmd = f"sudo sed -i -E " \
-        f"'{line_number}s/(hardware ethernet ).+?(;)/\\1{new_mac}\\2/' " \
-        f"{dhcp_config_filepath}"
-    session.send_command(cmd)
-    session.send_command('sudo /etc/init.d/isc-dhcp-server restart')
+    editor = OfficeDhcpEditor(session, dhcp_config_filepath)
+    config = editor.load()
+    if config.change_mac_address(ztp_id, isc_dhcp_format_mac(new_mac)):
+        editor.save(config)
 
 
 def change_ip_address(ztp_id: int,
                       new_ip: str,
                       dhcp_config_filepath: str,
                       session: LinuxSSH):
-    line_number = session.send_command(
-        f"cat {dhcp_config_filepath} | "
-        f"grep -Fn 'entry_{ztp_id}' | "
-        f"cut --delimiter=':' --fields=1")
-    if not line_number:
-        return
-    bootfile_line = int(line_number) - 3
-    cmd = f"sudo sed -i -E " \
-          f"'{bootfile_line}s/(initial\\/).+?(\\.cfg)/\\1{new_ip}\\2/' " \
-          f"{dhcp_config_filepath}"
-    session.send_command(cmd)
-    session.send_command('sudo /etc/init.d/isc-dhcp-server restart')
+    editor = OfficeDhcpEditor(session, dhcp_config_filepath)
+    config = editor.load()
+    if config.change_ip_address(ztp_id, new_ip):
+        editor.save(config)
 
 
 def delete_entry(ztp_id: int,
                  dhcp_config_filepath: str,
                  session: LinuxSSH):
-    line_number = session.send_command(
-        f"cat {dhcp_config_filepath} | "
-        f"grep -Fn 'entry_{ztp_id}' | "
-        f"cut --delimiter=':' --fields=1")
-    if not line_number:
-        return
-    line_number = int(line_number)
-    cmd = f"sudo sed -i '{line_number-5},{line_number+1}d' " \
-          f"{dhcp_config_filepath}"
-    session.send_command(cmd)
-    session.send_command('sudo /etc/init.d/isc-dhcp-server restart')
+    editor = OfficeDhcpEditor(session, dhcp_config_filepath)
+    config = editor.load()
+    if config.remove(ztp_id):
+        editor.save(config)
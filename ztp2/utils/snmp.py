@@ -1,5 +1,8 @@
+import asyncio
 from collections import defaultdict
+import time
 from ..remote_apis.snmp import DeviceSNMP
+from .cache import TTLCache
 
 
 ETHERNET_IANA_IFTYPE = [
@@ -10,95 +13,215 @@ ETHERNET_IANA_IFTYPE = [
     117  # gigabitEthernet
 ]
 
+SNAPSHOT_TABLE_OIDS = {
+    'vlans': '1.3.6.1.2.1.17.7.1.4.3.1.1',  # dot1qVlanStaticName
+    'if_types': '1.3.6.1.2.1.2.2.1.3',  # ifType
+    'aliases': '1.3.6.1.2.1.31.1.1.1.18',  # ifAlias
+    'egress': '1.3.6.1.2.1.17.7.1.4.3.1.2',  # dot1qVlanStaticEgressPorts
+    'untagged': '1.3.6.1.2.1.17.7.1.4.3.1.4',  # dot1qVlanStaticUntaggedPorts
+}
+SNAPSHOT_TABLES = tuple(SNAPSHOT_TABLE_OIDS)
+SNAPSHOT_TTL = 60
+SNAPSHOT_CACHE_SIZE = 1024
+BULK_MAX_REPETITIONS = 25
 
-def bytes_to_portlist(snmp_response: bytes):
-    # bytes to hex
-    # b'\xdf\xa2y\xcb\xa7\xdc\xc0\x00' -> 'dfa279cba7dcc000'
-    # b'\x03\xc0' -> '03c0
-    hexed_response = map(lambda x: hex(x)[2:].zfill(2), snmp_response)
-    hexed_response = ''.join(hexed_response)
-    # hex to bin
-    # '03c0' -> '0000001111000000'
-    bined_response = map(lambda x: bin(int(x, 16))[2:].zfill(4), hexed_response)
-    bined_response = ''.join(bined_response)
-    # bin to portlist
-    # '0000001111000000' -> [7, 8, 9, 10]
-    return [index
-            for index, value in enumerate(bined_response, 1)
-            if value == '1']
+
+class PortList:
+    """
+    Q-BRIDGE-MIB PortList as a bitset.
+    First octet's most significant bit is port 1.
+    """
+    __slots__ = ('mask', 'size')
+
+    def __init__(self, mask: int = 0, size: int = 0):
+        self.mask = mask
+        # Length in octets
+        self.size = size
+
+    @classmethod
+    def from_bytes(cls, value: bytes) -> 'PortList':
+        return cls(int.from_bytes(value, 'big'), len(value))
+
+    @classmethod
+    def from_ports(cls, ports, size: int) -> 'PortList':
+        portlist = cls(0, size)
+        for port in ports:
+            if 1 <= port <= size * 8:
+                portlist.add(port)
+        return portlist
+
+    def to_bytes(self) -> bytes:
+        return self.mask.to_bytes(self.size, 'big')
+
+    def _bit(self, port: int) -> int:
+        return 1 << (self.size * 8 - port)
+
+    def add(self, port: int):
+        self.mask |= self._bit(port)
+
+    def discard(self, port: int):
+        self.mask &= ~self._bit(port)
+
+    def remove(self, port: int):
+        if port not in self:
+            raise ValueError(f'Port {port} is not in list')
+        self.discard(port)
+
+    def __contains__(self, port: int) -> bool:
+        return 1 <= port <= self.size * 8 and bool(self.mask & self._bit(port))
+
+    def __iter__(self):
+        mask = self.mask
+        bits = self.size * 8
+        ports = []
+        while mask:
+            lowest = mask & -mask
+            ports.append(bits - lowest.bit_length() + 1)
+            mask ^= lowest
+        return reversed(ports)
+
+    def __len__(self) -> int:
+        return self.mask.bit_count()
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, PortList) \
+            and (self.mask, self.size) == (other.mask, other.size)
+
+    def __repr__(self):
+        return f'PortList({list(self)})'
+
+
+def bytes_to_portlist(snmp_response: bytes) -> list[int]:
+    # b'\x03\xc0' -> '0000001111000000' -> [7, 8, 9, 10]
+    return list(PortList.from_bytes(snmp_response))
 
 
 def portlist_to_bytes(portlist: list[int], hexlen: int) -> bytes:
-    # portlist to bin list
-    #                             4
-    # [4, 10] -> ['0', '0', '0', '1', '0', '0', '0', '0',
-    #             '0', '1', '0', '0', '0', '0', '0', '0']
-    #                   10
-    resultlist = ['1' if i in portlist else '0'
-                  for i in range(1, hexlen * 4 + 1)]
-    # bin list to bin
-    # ['0', '0', '0', '1', '0', '0', '0', '0',
-    #  '0', '1', '0', '0', '0', '0', '0', '0'] -> '0001000001000000'
-    resultlist = ''.join(resultlist)
-    # bin to bin chunks (length of 8)
-    # '0001000001000000' -> ['00010000', '01000000']
-    resultlist = list(resultlist[8*x:8*(x+1)] for x in range(hexlen // 2))
-    # bin chunks to bytes chunks (length of 1)
-    # ['00010000', '01000000'] -> [b'\x10', b'@']
-    resultlist = [int(chunk, 2).to_bytes(1, 'big') for chunk in resultlist]
-    # byte chunks to bytes
-    return b''.join(resultlist)
+    # [4, 10] -> '0001000001000000' -> b'\x10@'
+    return PortList.from_ports(portlist, hexlen // 2).to_bytes()
 
 
-async def get_vlan_list(ip_address: str, snmp: DeviceSNMP):
+def port_vlan_matrix(egress: dict[int, PortList],
+                     untagged: dict[int, PortList]):
+    """
+    Turns dot1qVlanStaticTable rows (vlan -> ports) into
+    port -> {'untagged': [vlans], 'tagged': [vlans]}
+    """
+    result = defaultdict(lambda: {'untagged': [], 'tagged': []})
+    for vlan, ports in egress.items():
+        untagged_ports = untagged.get(vlan, PortList())
+        for port in ports:
+            if port not in untagged_ports:
+                result[str(port)]['tagged'].append(vlan)
+    for vlan, ports in untagged.items():
+        for port in ports:
+            result[str(port)]['untagged'].append(vlan)
+    return result
+
+
+class SwitchSnapshot:
+    """
+    VLAN and port tables of one switch, collected at once
+    """
+    def __init__(self, ip_address: str,
+                 vlans: dict[str, str],
+                 if_types: dict[str, int],
+                 aliases: dict[str, str],
+                 egress: dict[int, PortList],
+                 untagged: dict[int, PortList]):
+        self.ip_address = ip_address
+        self.vlans = vlans
+        self.if_types = if_types
+        self.aliases = aliases
+        self.egress = egress
+        self.untagged = untagged
+        self.collected_at = time.monotonic()
+
+    def vlan_list(self) -> dict[str, str]:
+        return dict(self.vlans)
+
+    def ports_descriptions(self) -> dict[str, str]:
+        return {if_index: description
+                for if_index, description in self.aliases.items()
+                if self.if_types.get(if_index) in ETHERNET_IANA_IFTYPE}
+
+    def port_vlans(self):
+        return port_vlan_matrix(self.egress, self.untagged)
+
+
+def _last_index(element) -> str:
+    return element.oid.split('.')[-1]
+
+
+async def collect_switch_snapshot(ip_address: str, snmp: DeviceSNMP,
+                                  tables: tuple[str, ...] = SNAPSHOT_TABLES):
+    """
+    One SNMP session, all needed tables are walked concurrently with GETBULK
+    """
     async with snmp(ip_address=ip_address) as session:
-        response = await session.walk('1.3.6.1.2.1.17.7.1.4.3.1.1')
-    answer = {}
-    for element in response:
-        vlan_id = element.oid.split('.')[-1]
-        vlan_name = element.value.decode('utf-8')
-        vlan_name = vlan_name.replace('\x00', '')
-        answer[vlan_id] = vlan_name
-    return answer
+        responses = await asyncio.gather(*(
+            session.bulk_walk(SNAPSHOT_TABLE_OIDS[table],
+                              max_repetitions=BULK_MAX_REPETITIONS)
+            for table in tables))
+    responses = dict(zip(tables, responses))
+    return SwitchSnapshot(
+        ip_address,
+        vlans={_last_index(element):
+               element.value.decode('utf-8').replace('\x00', '')
+               for element in responses.get('vlans', [])},
+        if_types={_last_index(element): element.value
+                  for element in responses.get('if_types', [])},
+        aliases={_last_index(element): element.value.decode('utf-8')
+                 for element in responses.get('aliases', [])},
+        egress={int(_last_index(element)): PortList.from_bytes(element.value)
+                for element in responses.get('egress', [])},
+        untagged={int(_last_index(element)):
+                  PortList.from_bytes(element.value)
+                  for element in responses.get('untagged', [])},
+    )
+
+
+# (ip address, tables) -> snapshot
+snapshot_cache = TTLCache(maxsize=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_TTL)
+
+
+async def get_switch_snapshot(ip_address: str, snmp: DeviceSNMP,
+                              tables: tuple[str, ...] = SNAPSHOT_TABLES,
+                              max_age: float = SNAPSHOT_TTL):
+    """
+    Cached snapshot of the given tables (a full one serves any tables),
+    so entry creation and switch port editing reuse it
+    """
+    now = time.monotonic()
+    for key in dict.fromkeys(((ip_address, SNAPSHOT_TABLES),
+                              (ip_address, tables))):
+        found, snapshot = snapshot_cache.get(key)
+        if found and now - snapshot.collected_at < max_age:
+            return snapshot
+    snapshot = await collect_switch_snapshot(ip_address, snmp, tables)
+    snapshot_cache.set((ip_address, tables), snapshot)
+    return snapshot
+
+
+def forget_switch_snapshot(ip_address: str):
+    """
+    Called after switch is changed
+    """
+    snapshot_cache.invalidate_where(lambda key: key[0] == ip_address)
+
+
+async def get_vlan_list(ip_address: str, snmp: DeviceSNMP):
+    snapshot = await collect_switch_snapshot(ip_address, snmp, ('vlans',))
+    return snapshot.vlan_list()
 
 
 async def get_ports_descriptions(ip_address: str, snmp: DeviceSNMP):
-    async with snmp(ip_address=ip_address) as session:
-        response = await session.walk('1.3.6.1.2.1.2.2.1.3')
-    interface_types = {}
-    for element in response:
-        interface_index = element.oid.split('.')[-1]
-        interface_type = element.value
-        interface_types[interface_index] = interface_type
-    ethernet_interfaces = [if_index
-                           for if_index, if_type in interface_types.items()
-                           if if_type in ETHERNET_IANA_IFTYPE]
-    async with snmp(ip_address=ip_address) as session:
-        response = await session.walk('1.3.6.1.2.1.31.1.1.1.18')
-    descriptions = {}
-    for element in response:
-        interface_index = element.oid.split('.')[-1]
-        interface_description = element.value.decode('utf-8')
-        if interface_index in ethernet_interfaces:
-            descriptions[interface_index] = interface_description
-    return descriptions
+    snapshot = await collect_switch_snapshot(ip_address, snmp,
+                                             ('if_types', 'aliases'))
+    return snapshot.ports_descriptions()
 
 
 async def get_port_vlans(ip_address: str, snmp: DeviceSNMP):
-    result = defaultdict(lambda: {'untagged': [], 'tagged': []})
-    async with snmp(ip_address=ip_address) as session:
-        all_ports = await session.walk('1.3.6.1.2.1.17.7.1.4.3.1.2')
-    all_ports = {int(elem.oid.split('.')[-1]): bytes_to_portlist(elem.value)
-                 for elem in all_ports}
-    async with snmp(ip_address=ip_address) as session:
-        untag_ports = await session.walk('1.3.6.1.2.1.17.7.1.4.3.1.4')
-    untag_ports = {int(elem.oid.split('.')[-1]): bytes_to_portlist(elem.value)
-                   for elem in untag_ports}
-    for vlan, port_list in all_ports.items():
-        for port in port_list:
-            if port not in untag_ports[vlan]:
-                result[str(port)]['tagged'].append(int(vlan))
-    for vlan, port_list in untag_ports.items():
-        for port in port_list:
-            result[str(port)]['untagged'].append(int(vlan))
-    return result
+    snapshot = await collect_switch_snapshot(ip_address, snmp,
+                                             ('egress', 'untagged'))
+    return snapshot.port_vlans()
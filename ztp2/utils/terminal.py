@@ -1,4 +1,5 @@
 from scrapli import AsyncScrapli
+from typing import Awaitable, Callable
 
 
 async def extract_dlink_serial(session: AsyncScrapli):
@@ -7,3 +8,57 @@ async def extract_dlink_serial(session: AsyncScrapli):
                               response.result.split('\n')))
     serial_number = serial_line.split()[-1]
     return serial_number
+
+
+DLINK_ERROR_MARKERS = ['Fail', 'Invalid', 'Available commands',
+                       'Next possible completions', 'ERROR']
+DLINK_SYNTAX_ERROR_MARKERS = ['Invalid', 'Available commands',
+                              'Next possible completions']
+DLINK_CONFIG_DOWNLOAD_COMMAND = 'download cfg_fromTFTP {server} ' \
+                                'src_file {filename} increment'
+DLINK_CONFIG_DOWNLOAD_TIMEOUT = 900
+
+
+def dlink_error_lines(output: str) -> list[str]:
+    return [line.strip() for line in output.split('\n')
+            if any(marker in line for marker in DLINK_ERROR_MARKERS)]
+
+
+async def dlink_download_config(session: AsyncScrapli,
+                                tftp_server: str,
+                                filename: str) -> list[str] | None:
+    """
+    Makes switch download and apply config from TFTP by itself.
+    Returns lines reported as failed or None if command is not supported
+    """
+    command = DLINK_CONFIG_DOWNLOAD_COMMAND.format(server=tftp_server,
+                                                   filename=filename)
+    response = await session.send_command(
+        command, timeout_ops=DLINK_CONFIG_DOWNLOAD_TIMEOUT)
+    head = response.result.strip().split('\n')[:3]
+    if any(marker in line
+           for line in head
+           for marker in DLINK_SYNTAX_ERROR_MARKERS):
+        return None
+    return dlink_error_lines(response.result)
+
+
+async def dlink_send_config_lines(
+        session: AsyncScrapli, lines: list[str],
+        progress: Callable[[int], Awaitable] | None = None) -> list[str]:
+    """
+    Fallback for switches which can't download config by themselves
+    """
+    alert_chunks = 5
+    threshold = len(lines) // alert_chunks
+    percents = 100 // alert_chunks
+    multiplier = 1
+    errors = []
+    for index, line in enumerate(lines):
+        if progress and index > threshold * multiplier:
+            await progress(percents * multiplier)
+            multiplier += 1
+        response = await session.send_command(line)
+        if dlink_error_lines(response.result):
+            errors.append(line)
+    return errors
@@ -0,0 +1,117 @@
+import asyncio
+import re
+import time
+from collections import defaultdict
+from typing import Callable, NamedTuple
+
+from ..remote_apis.ftp import ContextedFTP
+from .ftp import get_file_bytes, get_file_size
+
+RRQ_REGEX = re.compile(rb'RRQ from (\d+\.\d+\.\d+\.\d+) filename (\S+)')
+# How much of already existing log is read when watcher starts,
+# so requests made just before the task started are not lost
+INITIAL_TAIL_SIZE = 1024 * 1024
+# Requests of devices not heard of for so long are dropped,
+# no ZTP run waits for TFTP longer
+REQUESTS_TTL = 3600
+
+
+class TftpRequest(NamedTuple):
+    ip_address: str
+    filename: str
+
+
+def parse_tftp_requests(chunk: bytes) -> list[TftpRequest]:
+    return [TftpRequest(ip.decode('utf-8'), filename.decode('utf-8'))
+            for ip, filename in RRQ_REGEX.findall(chunk)]
+
+
+class TftpLogWatcher:
+    """
+    Follows TFTP server log over FTP, downloading only newly appended bytes.
+    One watcher is shared by every ZTP task of the process.
+    """
+    def __init__(self, ftp_factory: Callable[[], ContextedFTP],
+                 filename: str,
+                 poll_interval: float = 5,
+                 requests_ttl: float = REQUESTS_TTL):
+        self.ftp_factory = ftp_factory
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.requests_ttl = requests_ttl
+        self.offset: int | None = None
+        self.requests: dict[str, list[str]] = defaultdict(list)
+        # IP address -> time of its last request
+        self.seen_at: dict[str, float] = {}
+        self.bytes_read = 0
+        self._remainder = b''
+        self._last_poll = 0.
+        self._lock: asyncio.Lock | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._waiters: dict[str, list[asyncio.Event]] = defaultdict(list)
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._waiters.clear()
+        return self._lock
+
+    async def poll(self):
+        async with self._get_lock():
+            if time.monotonic() - self._last_poll < self.poll_interval:
+                return
+            async with self.ftp_factory() as ftp_client:
+                size = await get_file_size(self.filename, ftp_client)
+                if self.offset is None:
+                    self.offset = max(0, size - INITIAL_TAIL_SIZE)
+                elif size < self.offset:
+                    # Log was rotated
+                    self.offset = 0
+                    self._remainder = b''
+                if size > self.offset:
+                    chunk = await get_file_bytes(self.filename, ftp_client,
+                                                 offset=self.offset)
+                else:
+                    chunk = b''
+            self._last_poll = time.monotonic()
+            self.offset += len(chunk)
+            self.bytes_read += len(chunk)
+            chunk = self._remainder + chunk
+            complete, _, self._remainder = chunk.rpartition(b'\n')
+            for request in parse_tftp_requests(complete):
+                self.requests[request.ip_address].append(request.filename)
+                self.seen_at[request.ip_address] = self._last_poll
+                for event in self._waiters.pop(request.ip_address, []):
+                    event.set()
+            self._expire()
+
+    def _expire(self):
+        deadline = self._last_poll - self.requests_ttl
+        for ip_address in [ip_address
+                           for ip_address, seen_at in self.seen_at.items()
+                           if seen_at < deadline]:
+            self.forget(ip_address)
+
+    def requested(self, ip_address: str, prefix: str) -> bool:
+        return any(filename.startswith(prefix)
+                   for filename in self.requests.get(ip_address, []))
+
+    async def wait_for_request(self, ip_address: str, prefix: str):
+        await self.poll()
+        while not self.requested(ip_address, prefix):
+            event = asyncio.Event()
+            self._waiters[ip_address].append(event)
+            try:
+                await asyncio.wait_for(event.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                await self.poll()
+
+    def forget(self, ip_address: str):
+        """
+        Called when ZTP of the device is over: next run of the same
+        address must not see old requests
+        """
+        self.requests.pop(ip_address, None)
+        self.seen_at.pop(ip_address, None)
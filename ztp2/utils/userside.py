@@ -1,7 +1,25 @@
+import aiohttp
+import asyncio
 from enum import Enum
 import re
+from typing import Awaitable, Callable
 
 from ..remote_apis.userside import UsersideAPI
+from .cache import TTLCache
+
+# Inventory, devices and nodes are looked up repeatedly within seconds
+userside_cache = TTLCache(maxsize=4096, ttl=60)
+
+# Node names are practically never changed
+node_names_cache = TTLCache(maxsize=8192, ttl=3600)
+NODES_CHUNK_SIZE = 100
+
+USERSIDE_WRITE_CONCURRENCY = 8
+USERSIDE_WRITE_ATTEMPTS = 3
+USERSIDE_WRITE_BACKOFF = 0.5
+
+# (description, method, kwargs)
+UsersideWrite = tuple[str, Callable[..., Awaitable], dict]
 
 
 class InventoryStorage(Enum):
@@ -45,11 +63,15 @@ async def get_node_id(ip_address: str, userside_api: UsersideAPI):
     return node_id
 
 
-async def get_task_prefixes(task_id: int, userside_api: UsersideAPI):
+async def get_task_specification(task_id: int, userside_api: UsersideAPI):
     task_data = await userside_api.task.show(id=task_id)
     additional_data = task_data['additional_data']
     target_field = additional_data['266']
     specification = target_field['value']
+    return specification
+
+
+def parse_task_prefixes(specification: str):
     management_prefix = None
     other_prefixes = []
     for chunk in specification.split(';'):
@@ -64,15 +86,21 @@ async def get_task_prefixes(task_id: int, userside_api: UsersideAPI):
     return [management_prefix] + other_prefixes
 
 
-async def get_task_vlans(task_id: int, userside_api: UsersideAPI):
-    task_data = await userside_api.task.show(id=task_id)
-    additional_data = task_data['additional_data']
-    target_field = additional_data['266']
-    specification = target_field['value']
+def parse_task_vlans(specification: str):
     vlan_ids = re.findall(r'\[(\d+)]', specification)
     return vlan_ids
 
 
+async def get_task_prefixes(task_id: int, userside_api: UsersideAPI):
+    specification = await get_task_specification(task_id, userside_api)
+    return parse_task_prefixes(specification)
+
+
+async def get_task_vlans(task_id: int, userside_api: UsersideAPI):
+    specification = await get_task_specification(task_id, userside_api)
+    return parse_task_vlans(specification)
+
+
 async def get_parent_switch_port(ip_address: str, userside_api: UsersideAPI):
     device_id = await userside_api.device.get_device_id(object_type='switch',
                                                         data_typer='ip',
@@ -137,6 +165,39 @@ async def transfer_inventory_to_node(inventory_id: int,
                                                     employee_id=employee_id)
 
 
+async def run_writes(writes: list[UsersideWrite],
+                     concurrency: int = USERSIDE_WRITE_CONCURRENCY,
+                     attempts: int = USERSIDE_WRITE_ATTEMPTS,
+                     backoff: float = USERSIDE_WRITE_BACKOFF):
+    """
+    Runs (description, method, kwargs) writes concurrently, at most
+    `concurrency` at once. Writes are not idempotent, so only failed
+    connection attempts are retried (with exponential backoff):
+    after a timeout the change may be already applied.
+    Returns (description, error) of failed writes
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write(description: str, method: Callable[..., Awaitable],
+                    kwargs: dict):
+        async with semaphore:
+            for attempt in range(attempts):
+                try:
+                    await method(**kwargs)
+                    return None
+                except aiohttp.ClientConnectorError as exc:
+                    error = exc
+                    if attempt + 1 < attempts:
+                        await asyncio.sleep(backoff * 2 ** attempt)
+                except (aiohttp.ClientError, asyncio.TimeoutError,
+                        RuntimeError) as exc:
+                    return description, exc
+            return description, error
+
+    results = await asyncio.gather(*(write(*item) for item in writes))
+    return [result for result in results if result is not None]
+
+
 async def update_up_down_link(old_uplink: str,
                               old_downlinks: str,
                               movements: dict,
@@ -148,41 +209,45 @@ async def update_up_down_link(old_uplink: str,
     downlinks = old_downlinks.split(',')
     downlinks = [movements.get(u, u) for u in downlinks]
     downlinks = ','.join(downlinks)
-    await userside_api.device.set_data(object_type='switch',
-                                       object_id=device_id,
-                                       param='downlink_port',
-                                       value=downlinks)
-    await userside_api.device.set_data(object_type='switch',
-                                       object_id=device_id,
-                                       param='uplink_port',
-                                       value=uplinks)
+    writes = [
+        (f'downlink_port {downlinks}', userside_api.device.set_data,
+         {'object_type': 'switch', 'object_id': device_id,
+          'param': 'downlink_port', 'value': downlinks}),
+        (f'uplink_port {uplinks}', userside_api.device.set_data,
+         {'object_type': 'switch', 'object_id': device_id,
+          'param': 'uplink_port', 'value': uplinks}),
+    ]
+    return await run_writes(writes)
 
 
 async def update_commutation(old_commutation: dict,
                              movements: dict,
                              device_id: int,
                              userside_api: UsersideAPI):
+    writes = []
     for port_index, commutation_data in old_commutation.items():
+        port = movements.get(port_index, port_index)
         for neighbor in commutation_data:
+            description = f'{port} - {neighbor["object_type"]} ' \
+                          f'{neighbor["object_id"]}'
             if neighbor['object_type'] in ['fiber', 'cross']:
-                await userside_api.commutation.add(
-                    object_type='switch',
-                    object_id=device_id,
-                    object1_port=movements.get(port_index, port_index),
-                    object2_type=neighbor['object_type'],
-                    object2_id=neighbor['object_id'],
-                    object2_side=neighbor['direction'],
-                    object2_port=neighbor['interface'],
-                )
+                params = {'object_type': 'switch',
+                          'object_id': device_id,
+                          'object1_port': port,
+                          'object2_type': neighbor['object_type'],
+                          'object2_id': neighbor['object_id'],
+                          'object2_side': neighbor['direction'],
+                          'object2_port': neighbor['interface']}
             else:
-                await userside_api.commutation.add(
-                    object_type=neighbor['object_type'],
-                    object_id=neighbor['object_id'],
-                    object1_port=neighbor['interface'],
-                    object2_type='switch',
-                    object2_id=device_id,
-                    object2_port=movements.get(port_index, port_index)
-                )
+                params = {'object_type': neighbor['object_type'],
+                          'object_id': neighbor['object_id'],
+                          'object1_port': neighbor['interface'],
+                          'object2_type': 'switch',
+                          'object2_id': device_id,
+                          'object2_port': port}
+            writes.append((description, userside_api.commutation.add,
+                           params))
+    return await run_writes(writes)
 
 
 async def get_node_name(node_id: int, userside_api: UsersideAPI):
@@ -190,3 +255,36 @@ async def get_node_name(node_id: int, userside_api: UsersideAPI):
     node_data = nodes_data[str(node_id)]
     node_name = node_data['name']
     return node_name
+
+
+async def get_node_names(node_ids: list[int],
+                         userside_api: UsersideAPI) -> dict[int, str]:
+    """
+    Names of many nodes: cached ones are taken from cache,
+    others are requested with comma-separated ids in few requests
+    """
+    names = {}
+    missing = []
+    for node_id in dict.fromkeys(node_ids):
+        found, name = node_names_cache.get(node_id)
+        if found:
+            names[node_id] = name
+        else:
+            missing.append(node_id)
+    chunks = [missing[i:i + NODES_CHUNK_SIZE]
+              for i in range(0, len(missing), NODES_CHUNK_SIZE)]
+    responses = await asyncio.gather(
+        *(userside_api.node.get(id=','.join(map(str, chunk)))
+          for chunk in chunks))
+    for nodes_data in responses:
+        for node_id, node_data in nodes_data.items():
+            names[int(node_id)] = node_data['name']
+            node_names_cache.set(int(node_id), node_data['name'])
+    # Userside may ignore some ids of the list
+    lost = [node_id for node_id in missing if node_id not in names]
+    lost_names = await asyncio.gather(
+        *(get_node_name(node_id, userside_api) for node_id in lost))
+    for node_id, name in zip(lost, lost_names):
+        names[node_id] = name
+        node_names_cache.set(node_id, name)
+    return names
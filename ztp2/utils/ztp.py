@@ -1,17 +1,22 @@
+import asyncio
 import logging
 from abc import ABC, abstractmethod
+from typing import Callable
 import aioftp
 import aiohttp
-import aiosnmp
+import aiosnmp.exceptions
 from jinja2 import Template
 from scrapli.driver.core import AsyncIOSXEDriver
 
 from ..remote_apis.snmp import DeviceSNMP
-from .snmp import get_port_vlans, bytes_to_portlist, portlist_to_bytes
+from .snmp import get_switch_snapshot, forget_switch_snapshot, PortList
 from ..db.models.ztp import Model, Entry
 from .netbox import get_vlan, get_default_gateway
 from .ftp import get_file_content, upload_file
 
+VLAN_EGRESS_PORTS_OID = '1.3.6.1.2.1.17.7.1.4.3.1.2.{}'
+VLAN_UNTAGGED_PORTS_OID = '1.3.6.1.2.1.17.7.1.4.3.1.4.{}'
+
 
 class BaseInterface(ABC):
     @abstractmethod
@@ -92,83 +97,98 @@ class DlinkInterface(BaseInterface):
         self.snmp_factory: DeviceSNMP = snmp_factory
         self.snmp: aiosnmp.Snmp | None = None
 
+    async def _read_rows(self, vlans: list[str]) -> dict[str, bytes]:
+        """
+        Egress and untagged rows of all given VLANs in one GET
+        """
+        oids = [template.format(vlan)
+                for vlan in vlans
+                for template in (VLAN_EGRESS_PORTS_OID,
+                                 VLAN_UNTAGGED_PORTS_OID)]
+        response = await self.snmp.get(oids)
+        return {oid: element.value for oid, element in zip(oids, response)}
+
+    async def _apply(self, original: dict[str, bytes],
+                     changes: list[tuple[str, bytes]]):
+        """
+        All changes in one SET; if agent fails partway, original rows
+        are written back
+        """
+        changes = [(oid, value) for oid, value in changes
+                   if original[oid] != value]
+        if not changes:
+            return
+        forget_switch_snapshot(self.ip)
+        try:
+            await self.snmp.set(changes)
+        except aiosnmp.exceptions.SnmpException as exc:
+            try:
+                current = await self._read_rows(list(dict.fromkeys(
+                    oid.split('.')[-1] for oid, _ in changes)))
+                rollback = [(oid, original[oid])
+                            for oid, value in current.items()
+                            if original[oid] != value]
+                if rollback:
+                    logging.error(f'Rolling back {self.ip}: '
+                                  f'{len(rollback)} rows')
+                    await self.snmp.set(rollback)
+            except Exception as rollback_exc:
+                # Caller needs the cause, not the rollback failure
+                logging.error(f'Rollback of {self.ip} failed: '
+                              f'{rollback_exc!r}')
+                raise exc from rollback_exc
+            raise
+
     async def switch_to_management(self):
-        if self.untagged:
-            for vlan in self.untagged:
-                # Remove interface from "untagged ports"
-                resp = await self.snmp.get(f'1.3.6.1.2.1.17.7.1.4.3.1.4.{vlan}')
-                hexlen = len(resp[0].value) * 2
-                plist = bytes_to_portlist(resp[0].value)
-                plist.remove(int(self.interface))
-                await self.snmp.set([(f'1.3.6.1.2.1.17.7.1.4.3.1.4.{vlan}',
-                                      portlist_to_bytes(plist, hexlen))])
-                # Remove interface from "all ports"
-                resp = await self.snmp.get(f'1.3.6.1.2.1.17.7.1.4.3.1.2.{vlan}')
-                hexlen = len(resp[0].value) * 2
-                plist = bytes_to_portlist(resp[0].value)
-                plist.remove(int(self.interface))
-                await self.snmp.set([(f'1.3.6.1.2.1.17.7.1.4.3.1.2.{vlan}',
-                                      portlist_to_bytes(plist, hexlen))])
-        # Add interface to management "all ports"
-        resp = await self.snmp.get(
-            f'1.3.6.1.2.1.17.7.1.4.3.1.2.{self.management_vlan}')
-        hexlen = len(resp[0].value) * 2
-        plist = bytes_to_portlist(resp[0].value)
-        plist = list(set(plist) | {int(self.interface)})
-        await self.snmp.set(
-            [(f'1.3.6.1.2.1.17.7.1.4.3.1.2.{self.management_vlan}',
-              portlist_to_bytes(plist, hexlen))])
-        # Add interface to management "untagged ports"
-        resp = await self.snmp.get(
-            f'1.3.6.1.2.1.17.7.1.4.3.1.4.{self.management_vlan}')
-        hexlen = len(resp[0].value) * 2
-        plist = bytes_to_portlist(resp[0].value)
-        plist = list(set(plist) | {int(self.interface)})
-        await self.snmp.set(
-            [(f'1.3.6.1.2.1.17.7.1.4.3.1.4.{self.management_vlan}',
-              portlist_to_bytes(plist, hexlen))])
+        port = int(self.interface)
+        old_vlans = [str(vlan) for vlan in self.untagged or []
+                     if str(vlan) != self.management_vlan]
+        original = await self._read_rows(old_vlans + [self.management_vlan])
+        changes = []
+        for vlan in old_vlans:
+            # Remove interface from "untagged ports" and "all ports"
+            for template in (VLAN_UNTAGGED_PORTS_OID, VLAN_EGRESS_PORTS_OID):
+                oid = template.format(vlan)
+                ports = PortList.from_bytes(original[oid])
+                ports.discard(port)
+                changes.append((oid, ports.to_bytes()))
+        # Add interface to management "all ports" and "untagged ports"
+        for template in (VLAN_EGRESS_PORTS_OID, VLAN_UNTAGGED_PORTS_OID):
+            oid = template.format(self.management_vlan)
+            ports = PortList.from_bytes(original[oid])
+            ports.add(port)
+            changes.append((oid, ports.to_bytes()))
+        await self._apply(original, changes)
 
     async def switch_back(self):
-        # Remove interface from management "untagged ports"
-        resp = await self.snmp.get(
-                f'1.3.6.1.2.1.17.7.1.4.3.1.4.{self.management_vlan}')
-        hexlen = len(resp[0].value) * 2
-        plist = bytes_to_portlist(resp[0].value)
-        plist.remove(int(self.interface))
-        await self.snmp.set(
-            [(f'1.3.6.1.2.1.17.7.1.4.3.1.4.{self.management_vlan}',
-              portlist_to_bytes(plist, hexlen))])
-        # Add interface to management "all ports" just to be sure
-        resp = await self.snmp.get(
-                f'1.3.6.1.2.1.17.7.1.4.3.1.2.{self.management_vlan}')
-        hexlen = len(resp[0].value) * 2
-        plist = bytes_to_portlist(resp[0].value)
-        plist = list(set(plist) | {int(self.interface)})
-        await self.snmp.set(
-            [(f'1.3.6.1.2.1.17.7.1.4.3.1.2.{self.management_vlan}',
-              portlist_to_bytes(plist, hexlen))])
-        if self.untagged:
-            for vlan in self.untagged:
-                # Add interface to "all ports"
-                resp = await self.snmp.get(
-                    f'1.3.6.1.2.1.17.7.1.4.3.1.2.{vlan}')
-                hexlen = len(resp[0].value) * 2
-                plist = bytes_to_portlist(resp[0].value)
-                plist = list(set(plist) | {int(self.interface)})
-                await self.snmp.set([(f'1.3.6.1.2.1.17.7.1.4.3.1.2.{vlan}',
-                                      portlist_to_bytes(plist, hexlen))])
-                # Add interface to "untagged ports"
-                resp = await self.snmp.get(
-                    f'1.3.6.1.2.1.17.7.1.4.3.1.4.{vlan}')
-                hexlen = len(resp[0].value) * 2
-                plist = bytes_to_portlist(resp[0].value)
-                plist = list(set(plist) | {int(self.interface)})
-                await self.snmp.set([(f'1.3.6.1.2.1.17.7.1.4.3.1.4.{vlan}',
-                                      portlist_to_bytes(plist, hexlen))])
+        port = int(self.interface)
+        old_vlans = [str(vlan) for vlan in self.untagged or []
+                     if str(vlan) != self.management_vlan]
+        original = await self._read_rows([self.management_vlan] + old_vlans)
+        changes = []
+        # Remove interface from management "untagged ports",
+        # add to management "all ports" just to be sure
+        oid = VLAN_UNTAGGED_PORTS_OID.format(self.management_vlan)
+        ports = PortList.from_bytes(original[oid])
+        ports.discard(port)
+        changes.append((oid, ports.to_bytes()))
+        oid = VLAN_EGRESS_PORTS_OID.format(self.management_vlan)
+        ports = PortList.from_bytes(original[oid])
+        ports.add(port)
+        changes.append((oid, ports.to_bytes()))
+        for vlan in old_vlans:
+            # Add interface to "all ports" and "untagged ports"
+            for template in (VLAN_EGRESS_PORTS_OID, VLAN_UNTAGGED_PORTS_OID):
+                oid = template.format(vlan)
+                ports = PortList.from_bytes(original[oid])
+                ports.add(port)
+                changes.append((oid, ports.to_bytes()))
+        await self._apply(original, changes)
 
     async def get_untagged(self):
-        port_vlans = await get_port_vlans(self.ip, self.snmp_factory)
-        untagged = port_vlans[self.interface]['untagged']
+        snapshot = await get_switch_snapshot(self.ip, self.snmp_factory,
+                                             ('egress', 'untagged'))
+        untagged = snapshot.port_vlans()[self.interface]['untagged']
         if untagged:
             self.untagged = untagged
             return self.untagged
@@ -242,3 +262,24 @@ async def generate_full_config(entry: Entry, model: Model,
     params = await gather_full_configuration_parameters(entry, model, netbox)
     config = make_config_from_template(template, **params)
     await upload_file(config_filename, config, ftp)
+
+
+async def generate_configs(jobs: list[tuple[Callable, Entry, Model, str, str]],
+                           base_folder: str,
+                           netbox: aiohttp.ClientSession,
+                           ftp: aioftp.Client):
+    """
+    Renders many configs. Job is (parameters gatherer, entry, model,
+    template filename, config filename). Every template is downloaded once,
+    parameters are gathered concurrently, uploads share one FTP connection
+    """
+    templates = {}
+    for _, _, _, template_filename, _ in jobs:
+        if template_filename not in templates:
+            templates[template_filename] = await get_file_content(
+                base_folder + template_filename, ftp)
+    params = await asyncio.gather(*(gatherer(entry, model, netbox)
+                                    for gatherer, entry, model, _, _ in jobs))
+    for job, job_params in zip(jobs, params):
+        config = make_config_from_template(templates[job[3]], **job_params)
+        await upload_file(base_folder + job[4], config, ftp)